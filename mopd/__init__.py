@@ -21,4 +21,8 @@ See http://data.informaticslab.co.uk/.
 
 """
 
+from download import *
 from get import *
+from prefetch import *
+from interpolate import *
+from index import *
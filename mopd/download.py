@@ -0,0 +1,197 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+HTTP downloads from the AWS store, without wget.
+
+Connections are kept open and re-used (a pool for each host), so
+many small files don't each pay for a new connection (and TLS
+handshake). An interrupted download is resumed with a range request,
+and a finished one is checked against the size (and, where the
+server gives one, the MD5 checksum) before it's installed.
+"""
+
+import os
+import time
+import hashlib
+import threading
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib   # Python 2
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit   # Python 2
+
+from scratch.manifest import get_partial_name
+from scratch.manifest import install_file
+
+class ConnectionPool(object):
+    """Open HTTP(S) connections, kept for re-use - up to 'size' idle
+       connections to each host. Each connection is used by only one
+       thread at a time."""
+
+    def __init__(self, size=8, timeout=60):
+        self.size = size
+        self.timeout = timeout
+        self.idle = {}       # (scheme, host) -> list of connections
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        """A connection to a host - an idle one if there is one."""
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def release(self, scheme, host, connection):
+        """Finished with a connection - keep it for the next request
+           (it must have no unread response)."""
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        """Close all the idle connections."""
+        with self.lock:
+            for idle in self.idle.values():
+                for connection in idle:
+                    connection.close()
+            self.idle = {}
+
+# Connections shared by all downloads
+_pool = ConnectionPool()
+
+def request(url, headers=None, pool=None):
+    """Send a GET request. Returns (connection, response) - read the
+       response, then pass the connection back to pool.release.
+       A kept-alive connection the server has since closed is
+       replaced by a new one."""
+    if pool is None:
+        pool = _pool
+    parts = urlsplit(url)
+    path = parts.path
+    if parts.query:
+        path = "%s?%s" % (path, parts.query)
+    for attempt in (1, 2):
+        connection = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request('GET', path, headers=headers or {})
+            return (connection, connection.getresponse())
+        except (httplib.HTTPException, IOError):
+            connection.close()
+            if attempt == 2:
+                raise
+
+def get_expected_size(response, offset):
+    """Full size of the file, from the response headers (or None)."""
+    content_range = response.getheader('content-range')
+    if content_range is not None and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total != '*':
+            return int(total)
+    length = response.getheader('content-length')
+    if length is None:
+        return None
+    return offset + int(length)
+
+def get_md5(response):
+    """The MD5 checksum of the file, if the server gives it. S3 gives
+       it as the ETag, except for multi-part uploads (with a '-')."""
+    etag = (response.getheader('etag') or '').strip('"')
+    if len(etag) == 32 and '-' not in etag:
+        return etag.lower()
+    return None
+
+def get_file_md5(file_name, block_size=2**20):
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if len(block) == 0:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+def download_file(url, file_name, bandwidth=None, pool=None,
+                  block_size=2**16):
+    """Download a URL to a file.
+
+       The data go to a '.part' file first. If there's one already
+       (an interrupted download), only the rest of the file is
+       requested. The finished file is checked for size (and MD5
+       checksum, if known), then for being netCDF, and renamed into
+       place (see scratch.manifest.install_file). 'bandwidth'
+       (bytes/s) limits the download rate.
+
+       Raises IOError if the download fails - a file that isn't
+       there gives IOError with errno 404."""
+    if pool is None:
+        pool = _pool
+    partial_name = get_partial_name(file_name)
+    offset = 0
+    if os.path.exists(partial_name):
+        offset = os.path.getsize(partial_name)
+    headers = {}
+    if offset > 0:
+        headers['Range'] = "bytes=%d-" % offset
+    parts = urlsplit(url)
+    connection, response = request(url, headers, pool)
+    try:
+        if response.status == 416:
+            # Nothing more to get - the partial file may be bad, so
+            #  start again next time
+            response.read()
+            os.remove(partial_name)
+            raise IOError("Bad partial download of %s" % url)
+        if response.status not in (200, 206):
+            response.read()
+            raise IOError(response.status, "Failed to retrieve %s (%d %s)" %
+                          (url, response.status, response.reason))
+        if response.status == 200:
+            offset = 0   # Range not supported - start again
+        expected_size = get_expected_size(response, offset)
+        md5 = get_md5(response) if response.status == 200 else None
+        start = time.time()
+        got = 0
+        with open(partial_name, 'ab' if offset > 0 else 'wb') as f:
+            while True:
+                block = response.read(block_size)
+                if len(block) == 0:
+                    break
+                f.write(block)
+                got += len(block)
+                if bandwidth is not None:
+                    ahead = got/float(bandwidth) - (time.time()-start)
+                    if ahead > 0:
+                        time.sleep(ahead)
+    except Exception:
+        connection.close()
+        raise
+    pool.release(parts.scheme, parts.netloc, connection)
+    size = os.path.getsize(partial_name)
+    if expected_size is not None and size != expected_size:
+        # Keep the partial file - the next try carries on from here
+        raise IOError("Incomplete download of %s (%d of %d bytes)" %
+                      (url, size, expected_size))
+    if md5 is not None and get_file_md5(partial_name) != md5:
+        os.remove(partial_name)
+        raise IOError("Checksum mismatch for %s" % url)
+    install_file(partial_name, file_name)
@@ -18,13 +18,22 @@ See http://data.informaticslab.co.uk/.
 """
 
 import os
+import time
 import datetime
-import iris
-import iris.time
 import re
+import multiprocessing.pool
 
-# Eliminate incomprehensible warning message
-iris.FUTURE.netcdf_promote='True'
+# iris is imported when first used
+from scratch.lazy import iris
+from scratch.catalogue import get_catalogue
+from scratch.manifest import is_good_file
+from scratch.quota import note_access as note_file_access
+from scratch.quota import register_file
+
+from .download import download_file
+
+# Where the data are fetched from (see set_base_url)
+base_url = "https://s3.eu-west-2.amazonaws.com/"
 
 # Map 20CR names to file variable names
 Names={'mogreps-g': {
@@ -60,7 +69,16 @@ def load(dataset_name, variable,
           'prate', 'uwnd.10m', ...
 
        If 'auto_fetch' is True, fetch files from AWS as needed, if False,
-        throw an exception if they are not already on local disc"""
+        throw an exception if they are not already on local disc
+
+       See interpolate.py for how the interpolation is done - and
+        interpolate.load_at_times to load many times at once."""
+    dataset_name = validate_dataset_name(dataset_name)
+    vdate = (datetime.datetime(year, month, day) +
+             datetime.timedelta(hours=hour))
+    from .interpolate import load_at_validity_time
+    return load_at_validity_time(dataset_name, variable, vdate,
+                                 realization, forecast_period, auto_fetch)
 
 def datetime_to_float(dataset_name,dt):
     """I'm having trouble with iris's date-selection methods.
@@ -90,14 +108,19 @@ def load_simple(dataset_name, variable,
     file_name=make_local_file_name(dataset_name, fdate.year, fdate.month, 
                                    fdate.day, fdate.hour,
                                    realization, forecast_period)
-    # Check file containing data on disc
-    if not os.path.isfile(file_name):
+    if auto_fetch:
+        # Read-ahead (if turned on) - see prefetch.set_prefetch
+        from .prefetch import note_access
+        note_access(dataset_name,fdate,realization,forecast_period)
+    # Check file containing data on disc (and complete)
+    if not is_good_file(file_name):
         if auto_fetch:
             fetch_data(dataset_name,fdate.year,fdate.month,fdate.day,
                        fdate.hour,realization,forecast_period)
         else:
             raise StandardError("No Data for %s, realisation %d, forecast %d" %
                             (vdate, realization, forecast_period) + ' on disc.')
+    note_file_access(file_name) # For the $SCRATCH quota
     # Get the field from the file - want one within 2 minutes
     hslice=load_specific(dataset_name,variable,file_name,
                          year,month,day,ihour,iminute)
@@ -124,7 +147,7 @@ def get_forecast_date_from_validity_date(dataset_name,vdate,forecast_period):
            fdate=fdate-datetime.timedelta(hours=fdate.hour%3)
         return fdate
     if(dataset_name=='mogreps-uk'):
-        if(forecast_period < 3 or forecast_period > 6):
+        if(forecast_period < 3 or forecast_period > 36):
            raise StandardError("Forecast_period outside mogreps-uk range of 3-36")
         if(fdate.hour%3 != 0):
            fdate=fdate+datetime.timedelta(hours=fdate.hour%3)
@@ -193,15 +216,43 @@ def make_local_file_name(dataset_name, year, month, day, hour, realization, fore
                                                    realization, forecast_period)
     return file_name
 
+def get_missing_files(dataset_name, fields):
+    """Which of a list of fields are not on disc.
+
+       'fields' is a list of (year, month, day, hour, realization,
+       forecast_period) tuples (forecast times, as for fetch_data);
+       returns those whose files are missing. Uses the catalogue of
+       $SCRATCH (see scratch.catalogue), rather than looking for
+       each file."""
+    catalogue = get_catalogue()
+    return [field for field in fields
+            if not catalogue.has(make_local_file_name(dataset_name,
+                                                      *field))]
+
 def make_remote_url(dataset_name, year, month, day, hour, realization, forecast_period):
     dataset_name = validate_dataset_name(dataset_name)
     template_string = "prods_op_{}_{:02d}{:02d}{:02d}_{:02d}_{:02d}_{:03d}.nc"
     file_name = template_string.format(dataset_name, year, month, day, hour,
                                        realization, forecast_period)
-    url = "https://s3.eu-west-2.amazonaws.com/" + dataset_name + "/" + file_name
+    url = base_url + dataset_name + "/" + file_name
     return url
 
-def fetch_data(dataset_name, year, month, day, hour, realization, forecast_period):
+def set_base_url(url=None):
+    """Fetch from a different server (a mirror, or a local server for
+       testing) - None for the AWS store."""
+    global base_url
+    if url is None:
+        url = "https://s3.eu-west-2.amazonaws.com/"
+    if not url.endswith('/'):
+        url = url + '/'
+    base_url = url
+
+def fetch_data(dataset_name, year, month, day, hour, realization, forecast_period,
+               bandwidth=None, make_index=False):
+    """Fetch a file from AWS to $SCRATCH. 'bandwidth' (bytes/s) limits
+       the download rate. If 'make_index', also index the file (see
+       index.py - otherwise that's done when it's first loaded).
+       Raises IOError if the download fails."""
     dataset_name = validate_dataset_name(dataset_name)
     if not is_file_for(dataset_name, year, month, day, hour,
                        realization, forecast_period):
@@ -209,20 +260,128 @@ def fetch_data(dataset_name, year, month, day, hour, realization, forecast_perio
                             (hour, realization, forecast_period))
     local_file_name = make_local_file_name(dataset_name, year, month, day, hour,
                                            realization, forecast_period)
-    if os.path.isfile(local_file_name):
+    if is_good_file(local_file_name):
         return('Already fetched') # Already fetched
     local_dir = os.path.dirname(local_file_name)
     if not os.path.isdir(local_dir):
         os.makedirs(local_dir)
     remote_url = make_remote_url(dataset_name, year, month, day, hour,
                                   realization, forecast_period)
-    # urllib.urlretrieve corrupted the file for some reason
-    # so use wget - I like the progress bar anyway.
-    os.system("wget -P %s %s" % (os.path.dirname(local_file_name),
-                                 remote_url))
+    # Download to a '.part' file (resuming an earlier partial
+    #  download), and only rename it into place once it's checked.
+    start = time.time()
+    download_file(remote_url, local_file_name, bandwidth=bandwidth)
+    # Record it for the $SCRATCH quota (may delete older files)
+    register_file(local_file_name, time.time() - start)
+    if make_index:
+        from .index import get_file_index
+        get_file_index(local_file_name)
+
+def fetch_many(dataset_name, fields, workers=4, bandwidth=None, retries=2,
+               progress=True):
+    """Fetch many files at once.
+
+       'fields' is a list of (year, month, day, hour, realization,
+       forecast_period) tuples (as for fetch_data). Files already on
+       disc, and duplicates, are skipped. Up to 'workers' downloads
+       run at once, sharing kept-alive connections, and together
+       using no more than 'bandwidth' (bytes/s). A failed download is
+       resumed up to 'retries' times. If 'progress', each file is
+       reported as it finishes, and the overall throughput at the end.
+       Fields there are no files for (see is_file_for) are reported
+       as 'unavailable' without asking AWS.
+
+       Returns a list of results, one for each file: dicts with the
+       'field', 'status' ('done', 'unavailable' or 'failed'), 'error',
+       'attempts', 'seconds' and 'bytes'."""
+    dataset_name = validate_dataset_name(dataset_name)
+    needed = []
+    results = []
+    for field in fields:
+        field = tuple(field)
+        if field in needed or field in [r['field'] for r in results]:
+            continue
+        if not is_file_for(dataset_name, *field):
+            results.append({'field': field, 'status': 'unavailable',
+                            'error': "No data file for %s %s" %
+                                     (dataset_name, field),
+                            'attempts': 0, 'seconds': 0.0, 'bytes': 0})
+            continue
+        if is_good_file(make_local_file_name(dataset_name, *field)):
+            continue
+        needed.append(field)
+    if bandwidth is not None:
+        bandwidth = bandwidth/float(max(1, min(workers, len(needed))))
+    fetched = 0
+    start = time.time()
+    if len(needed) > 0:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(needed)))
+        try:
+            for result in pool.imap_unordered(_fetch_with_retries,
+                                  [(dataset_name, field, bandwidth, retries)
+                                   for field in needed]):
+                results.append(result)
+                fetched += 1
+                if progress:
+                    print("[%d/%d] %s %s (%.1f MB in %.1fs)" %
+                          (fetched, len(needed), result['status'],
+                           make_local_file_name(dataset_name,
+                                                *result['field']),
+                           result['bytes']/1.0e6, result['seconds']))
+        finally:
+            pool.close()
+            pool.join()
+    if progress:
+        elapsed = max(time.time()-start, 1.0e-6)
+        total = sum(r['bytes'] for r in results)
+        print("Fetched %d of %d (%.1f MB) in %.1fs - %.2f MB/s, %d failed" %
+              (len([r for r in results if r['status'] == 'done']),
+               len(results), total/1.0e6, elapsed, total/1.0e6/elapsed,
+               len([r for r in results if r['status'] != 'done'])))
+    return results
+
+def _fetch_with_retries(args):
+    # Pool.imap takes one argument
+    dataset_name, field, bandwidth, retries = args
+    result = {'field': field, 'attempts': 0, 'error': None, 'bytes': 0}
+    start = time.time()
+    while True:
+        result['attempts'] += 1
+        try:
+            fetch_data(dataset_name, *field, bandwidth=bandwidth)
+            result['status'] = 'done'
+            result['error'] = None
+            result['bytes'] = os.path.getsize(make_local_file_name(
+                                                  dataset_name, *field))
+            break
+        except (IOError, OSError) as e:
+            result['error'] = str(e)
+            if e.errno in (403, 404):
+                # Not there (S3 says 403 if listing isn't allowed)
+                result['status'] = 'unavailable'
+                break
+        if result['attempts'] > retries:
+            result['status'] = 'failed'
+            break
+    result['seconds'] = time.time()-start
+    return result
 
 def load_specific(dataset_name, variable, file_name, 
                   year, month, day, hour, minute=0):
+    """Load a field from a file. The file's index (see index.py - made
+       the first time the file is used) says where the field is, so
+       only that variable is read. If the index can't find it, the
+       file is searched (load_specific_by_search)."""
+    vdate=datetime.datetime(year,month,day,hour,minute)
+    from .index import load_indexed
+    hslice=load_indexed(dataset_name,variable,file_name,vdate)
+    if hslice is not None:
+        return hslice
+    return load_specific_by_search(dataset_name,variable,file_name,
+                                   year,month,day,hour,minute)
+
+def load_specific_by_search(dataset_name, variable, file_name, 
+                            year, month, day, hour, minute=0):
     """Because of the irregular structure of the netCDF files,
        and the peculiarity of iris, loading is fiddly and requires 
        variable-specific code."""
@@ -0,0 +1,400 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+An index of the contents of each MOGREPS file.
+
+Finding a field in a MOGREPS file means loading all the cubes in it
+with iris, and picking one out by name and position. The index
+(a JSON file alongside the data file) records, for each cube, its
+name, netCDF variable, time axis and dimensions - so that's done
+once per file. Later loads find the field from the index, and read
+just that netCDF variable, and just the time wanted, with netCDF4
+(falling back to iris if netCDF4 isn't there, or the file uses CF
+features read_indexed_cube doesn't handle).
+"""
+
+import os
+import re
+import json
+import sqlite3
+
+# iris, numpy and netCDF4 are imported when first used
+from scratch.lazy import iris
+from scratch.lazy import numpy
+from scratch.lazy import netCDF4
+from scratch.quota import add_companion
+
+from .get import datetime_to_float
+
+# Where each variable is in the files: a list of (name, position) -
+#  the cubes with that name (in iris.load order), and which one to
+#  use (None if there should only be one). If there's more than one
+#  entry, the fields are added together.
+Variable_cubes={'mogreps-g': {
+                     'prmsl'    : [('air_pressure_at_sea_level', None)],
+                     'air.2m'   : [('air_temperature', 3)],
+                     'uwnd.10m' : [('x_wind', 2)],
+                     'vwnd.10m' : [('y_wind', 2)],
+                     'prate'    : [('stratiform_rainfall_amount', None),
+                                   ('stratiform_snowfall_amount', None)]
+                    },
+                'mogreps-uk': {
+                     'prmsl'    : [('air_pressure_at_sea_level', None)],
+                     'air.2m'   : [('air_temperature', 3)],
+                     'uwnd.10m' : [('x_wind', 2)],
+                     'vwnd.10m' : [('y_wind', 2)],
+                     'prate'    : [('stratiform_rainfall_rate', None),
+                                   ('stratiform_snowfall_rate', None)]
+                    }
+}
+
+# netCDF attributes that become cube (or coordinate) properties,
+#  rather than attributes
+Cf_properties=('standard_name','long_name','units','calendar','bounds',
+               'axis','coordinates','grid_mapping',
+               'cell_methods','_FillValue','missing_value','scale_factor',
+               'add_offset','valid_min','valid_max','valid_range')
+
+# Indices already read - keyed on file name: (mtime, size, index)
+_file_indices={}
+
+def get_index_file_name(file_name):
+    """Name of the index of a data file."""
+    return "%s.index.json" % file_name
+
+def is_time_selected(dataset_name, variable, file_name):
+    """Does the field have to be picked out by time? (Otherwise it's
+       the whole of the cube found.)"""
+    if dataset_name == 'mogreps-uk':
+        return True
+    # 3-hour data includes multiple times
+    return variable == 'prmsl' and re.search('03.nc', file_name) != None
+
+def make_file_index(file_name):
+    """Load a file with iris, and describe each cube in it - a list
+       of dicts with the 'name', 'var_name', 'dimensions' (coordinate
+       name for each dimension), 'time_dim', and time 'points' and
+       'bounds' (hours since 1970)."""
+    cubes=[]
+    for cube in iris.load(file_name):
+        entry={'name': cube.name(), 'var_name': cube.var_name,
+               'dimensions': [], 'time_dim': None,
+               'points': None, 'bounds': None}
+        for dim in range(cube.ndim):
+            coords=cube.coords(dimensions=dim, dim_coords=True)
+            entry['dimensions'].append(coords[0].name() if coords else None)
+        try:
+            time_coord=cube.coord('time')
+        except iris.exceptions.CoordinateNotFoundError:
+            time_coord=None
+        if time_coord is not None:
+            dims=cube.coord_dims(time_coord)
+            if len(dims) > 0:
+                entry['time_dim']=dims[0]
+            entry['points']=[float(p) for p in time_coord.points]
+            if time_coord.bounds is not None:
+                entry['bounds']=[[float(b) for b in bounds]
+                                 for bounds in time_coord.bounds]
+        cubes.append(entry)
+    return cubes
+
+def write_file_index(file_name, index):
+    """Save the index of a file alongside it - with the file's
+       modification time and size, so a changed file can be
+       spotted. Does nothing if it can't be written."""
+    source=os.stat(file_name)
+    index_file=get_index_file_name(file_name)
+    tmp_name="%s.%d.tmp" % (index_file, os.getpid())
+    try:
+        with open(tmp_name, 'w') as f:
+            json.dump({'mtime': source.st_mtime, 'size': source.st_size,
+                       'cubes': index}, f)
+        os.rename(tmp_name, index_file)
+    except (IOError, OSError):
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+        return
+    # Delete it with the data file, if that goes over the quota
+    try:
+        add_companion(file_name, index_file)
+    except sqlite3.Error:
+        pass   # Quota database not usable - index is just not tracked
+
+def read_file_index(file_name):
+    """The saved index of a file - None if there isn't one, or the
+       file has changed since it was made."""
+    try:
+        source=os.stat(file_name)
+        with open(get_index_file_name(file_name)) as f:
+            saved=json.load(f)
+        if (saved['mtime'] != source.st_mtime or
+                saved['size'] != source.st_size):
+            return None
+        return saved['cubes']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def get_file_index(file_name):
+    """The index of a file - made (and saved) if necessary."""
+    source=os.stat(file_name)
+    memo=_file_indices.get(file_name)
+    if memo is not None and memo[:2] == (source.st_mtime, source.st_size):
+        return memo[2]
+    index=read_file_index(file_name)
+    if index is None:
+        index=make_file_index(file_name)
+        write_file_index(file_name, index)
+    _file_indices[file_name]=(source.st_mtime, source.st_size, index)
+    return index
+
+def is_at_time(entry, time, i):
+    """Does time point i of an index entry match 'time' (as an iris
+       time constraint would)?"""
+    if entry['bounds'] is not None:
+        return entry['bounds'][i][0] <= time <= entry['bounds'][i][1]
+    return abs(entry['points'][i]-time) < 1.0e-6
+
+def find_cubes(index, name, time=None):
+    """The cubes in an index with a name (and, if 'time' is given,
+       data at that time) - a list of (entry, time position)."""
+    found=[]
+    for entry in index:
+        if entry['name'] != name:
+            continue
+        if time is None:
+            found.append((entry, None))
+            continue
+        if entry['points'] is None:
+            continue
+        matches=[i for i in range(len(entry['points']))
+                 if is_at_time(entry, time, i)]
+        if len(matches) == 1:
+            found.append((entry, matches[0]))
+    return found
+
+def select_from_index(index, dataset_name, variable, time=None):
+    """Which cubes (and time positions) make up a variable - a list of
+       (entry, time position), or None if the index can't say."""
+    rules=Variable_cubes.get(dataset_name, {}).get(variable)
+    if rules is None:
+        return None
+    var_names=[entry['var_name'] for entry in index]
+    selected=[]
+    for name, position in rules:
+        found=find_cubes(index, name, time)
+        if position is None:
+            if len(found) != 1:
+                return None
+            selected.append(found[0])
+        else:
+            if len(found) <= position:
+                return None
+            selected.append(found[position])
+    for entry, time_position in selected:
+        # Must be able to load the cube on its own
+        if entry['var_name'] is None or var_names.count(entry['var_name']) > 1:
+            return None
+    return selected
+
+def get_var_name_constraint(var_name):
+    """Constraint matching one netCDF variable - iris can then skip
+       reading the others (NameConstraint, where iris has it)."""
+    if hasattr(iris, 'NameConstraint'):
+        return iris.NameConstraint(var_name=var_name)
+    return iris.Constraint(cube_func=lambda cube: cube.var_name == var_name)
+
+def get_units(attributes):
+    """The units of a netCDF variable - latitude and longitude units
+       are all 'degrees', as iris has them."""
+    units=attributes.get('units', '1')
+    if re.match(r'^degrees?[ _]?(north|east|n|e)?$', units.lower()):
+        return 'degrees'
+    return units
+
+def get_ellipsoid(mapping):
+    """The iris GeogCS for a netCDF grid mapping variable."""
+    attributes=dict((a, mapping.getncattr(a)) for a in mapping.ncattrs())
+    if 'earth_radius' in attributes:
+        return iris.coord_systems.GeogCS(attributes['earth_radius'])
+    if 'semi_major_axis' not in attributes:
+        return None
+    return iris.coord_systems.GeogCS(attributes['semi_major_axis'],
+                   semi_minor_axis=attributes.get('semi_minor_axis'),
+                   inverse_flattening=attributes.get('inverse_flattening'))
+
+def get_coord_system(dataset, variable):
+    """The iris coordinate system of a netCDF variable (None if it has
+       no grid mapping). Raises ValueError for mappings not handled."""
+    if 'grid_mapping' not in variable.ncattrs():
+        return None
+    mapping=dataset.variables[variable.grid_mapping]
+    name=mapping.grid_mapping_name
+    ellipsoid=get_ellipsoid(mapping)
+    if name == 'latitude_longitude':
+        return ellipsoid
+    if name == 'rotated_latitude_longitude':
+        return iris.coord_systems.RotatedGeogCS(
+                          mapping.grid_north_pole_latitude,
+                          mapping.grid_north_pole_longitude,
+                          getattr(mapping, 'north_pole_grid_longitude', 0.0),
+                          ellipsoid)
+    if name == 'transverse_mercator':
+        return iris.coord_systems.TransverseMercator(
+                          mapping.latitude_of_projection_origin,
+                          mapping.longitude_of_central_meridian,
+                          mapping.false_easting, mapping.false_northing,
+                          mapping.scale_factor_at_central_meridian,
+                          ellipsoid)
+    raise ValueError("Grid mapping %s not handled" % name)
+
+def parse_cell_methods(text):
+    """iris CellMethods from a netCDF cell_methods attribute. Raises
+       ValueError for anything but 'name: [name: ...] method' lists."""
+    if not re.match(r'^\s*((\w+:\s*)+\w+\s*)+$', text):
+        raise ValueError("Cell methods %s not handled" % text)
+    methods=[]
+    for names, method in re.findall(r'((?:\w+:\s*)+)(\w+)', text):
+        methods.append(iris.coords.CellMethod(method,
+                  coords=tuple(n.strip() for n in names.split(':')[:-1])))
+    return methods
+
+def read_coord(dataset, variable, name, time_dim, time_position):
+    """An iris coordinate from a netCDF coordinate variable, with the
+       cube dimensions it spans - taking just 'time_position' along
+       'time_dim' (if that's not None)."""
+    source=dataset.variables[name]
+    attributes=dict((a, source.getncattr(a)) for a in source.ncattrs())
+    if attributes.get('calendar', 'standard') not in ('standard',
+                                                      'gregorian'):
+        raise ValueError("Calendar %s not handled" % attributes['calendar'])
+    keys=[slice(None)]*source.ndim
+    dims=[]
+    for i, dim in enumerate(source.dimensions):
+        cube_dim=variable.dimensions.index(dim)
+        if cube_dim == time_dim and time_position is not None:
+            keys[i]=time_position
+        else:
+            dims.append(cube_dim-(time_dim is not None and
+                                  time_position is not None and
+                                  cube_dim > time_dim))
+    points=numpy.asarray(source[tuple(keys)])
+    bounds=None
+    if 'bounds' in attributes:
+        bounds=numpy.asarray(dataset.variables[attributes['bounds']][
+                                         tuple(keys)]).reshape(
+                                         numpy.atleast_1d(points).shape+(-1,))
+    coord_type=iris.coords.AuxCoord
+    if source.dimensions in ((name,), ()):
+        coord_type=iris.coords.DimCoord   # As iris loads (and slices) it
+    coord=coord_type(numpy.atleast_1d(points),
+                     standard_name=attributes.get('standard_name'),
+                     long_name=attributes.get('long_name'), var_name=name,
+                     units=get_units(attributes), bounds=bounds,
+                     attributes=dict((a, v) for a, v in attributes.items()
+                                     if a not in Cf_properties))
+    if coord.standard_name in ('latitude', 'longitude', 'grid_latitude',
+                               'grid_longitude', 'projection_x_coordinate',
+                               'projection_y_coordinate'):
+        coord.coord_system=get_coord_system(dataset, variable)
+    if (coord_type is iris.coords.DimCoord and coord.units == 'degrees' and
+            coord.standard_name in ('longitude', 'grid_longitude')):
+        # Global grids wrap round - as iris marks them when loading
+        coord.circular=iris.util._is_circular(coord.points, 360.0,
+                                              coord.bounds)
+    return (coord, tuple(dims))
+
+def read_indexed_cube(file_name, entry, time_position):
+    """A cube of one netCDF variable (an entry from the file's index),
+       reading only 'time_position' along its time dimension (all of
+       it if None). Raises ValueError if the file's CF metadata isn't
+       handled (then load it with iris)."""
+    time_dim=entry['time_dim'] if time_position is not None else None
+    with netCDF4.Dataset(file_name) as dataset:
+        variable=dataset.variables[entry['var_name']]
+        keys=[slice(None)]*variable.ndim
+        if time_dim is not None:
+            keys[time_dim]=time_position
+        data=variable[tuple(keys)]
+        global_attributes=dict((a, dataset.getncattr(a))
+                               for a in dataset.ncattrs())
+        attributes=dict(global_attributes)
+        attributes.update((a, variable.getncattr(a))
+                          for a in variable.ncattrs())
+        dim_coords=[]
+        aux_coords=[]
+        for i, dim in enumerate(variable.dimensions):
+            if dim in dataset.variables:
+                coord=read_coord(dataset, variable, dim, time_dim,
+                                 time_position)
+                if i == time_dim:
+                    aux_coords.append(coord)   # Now a scalar coordinate
+                else:
+                    dim_coords.append(coord)
+        for name in attributes.get('coordinates', '').split():
+            aux_coords.append(read_coord(dataset, variable, name, time_dim,
+                                         time_position))
+        cube=iris.cube.Cube(data, standard_name=attributes.get(
+                                                       'standard_name'),
+                            long_name=attributes.get('long_name'),
+                            var_name=entry['var_name'],
+                            units=get_units(attributes),
+                            attributes=dict((a, v) for a, v in
+                                            attributes.items()
+                                            if a not in Cf_properties),
+                            cell_methods=parse_cell_methods(
+                                         attributes.get('cell_methods', '')
+                                         ) if 'cell_methods' in attributes
+                                           else None,
+                            dim_coords_and_dims=[(c, d[0]) for c, d
+                                                 in dim_coords],
+                            aux_coords_and_dims=aux_coords)
+        if hasattr(cube.attributes, 'globals'):
+            # Newer iris keeps the file's own attributes separately
+            for a, v in global_attributes.items():
+                if a in Cf_properties:
+                    continue
+                if a not in variable.ncattrs():
+                    del cube.attributes.locals[a]
+                cube.attributes.globals[a]=v
+    return cube
+
+def load_indexed_cube(file_name, entry, time_position):
+    """A cube of one netCDF variable - read directly (see
+       read_indexed_cube), or if that can't be done, with iris."""
+    try:
+        return read_indexed_cube(file_name, entry, time_position)
+    except (ImportError, ValueError, KeyError, AttributeError):
+        pass   # No netCDF4, or metadata not handled - use iris
+    cube=iris.load_cube(file_name, get_var_name_constraint(entry['var_name']))
+    if time_position is not None and entry['time_dim'] is not None:
+        keys=[slice(None)]*cube.ndim
+        keys[entry['time_dim']]=time_position
+        cube=cube[tuple(keys)]
+    return cube
+
+def load_indexed(dataset_name, variable, file_name, vdate):
+    """Load a field using the file's index. Returns None if the index
+       can't find it (then search the file - see
+       get.load_specific_by_search)."""
+    time=None
+    if is_time_selected(dataset_name, variable, file_name):
+        time=datetime_to_float(dataset_name, vdate)
+    selected=select_from_index(get_file_index(file_name), dataset_name,
+                               variable, time)
+    if selected is None:
+        return None
+    fields=[load_indexed_cube(file_name, entry, time_position)
+            for entry, time_position in selected]
+    if len(fields) == 1:
+        return fields[0]
+    return iris.analysis.maths.add(fields[0], fields[1])
@@ -0,0 +1,187 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+MOGREPS fields at any validity time and forecast period.
+
+The files have fields every 3 hours of forecast period, from forecast
+cycles every 6 hours. A field in between is made from up to four
+that are in files: for each of the forecast periods either side,
+the fields from the two forecast cycles whose validity times (at
+that period) are either side of the one wanted. Each pair is
+interpolated in time, and then the two results in forecast period.
+
+Fields loaded from the files are kept in memory (field_cache), so
+nearby times share them rather than loading them again.
+"""
+
+import datetime
+
+# iris is imported when first used
+from scratch.lazy import iris
+from scratch.cache import ByteLRUCache
+
+from .get import is_file_for
+from .get import load_simple
+from .get import validate_dataset_name
+
+# Hours between the forecast periods in the files
+Period_step=3
+
+# Fields loaded - keyed on (dataset, variable, validity time,
+#  realization, forecast period).
+field_cache=ByteLRUCache(max_bytes=2**30)
+
+def set_field_cache_size(max_bytes):
+    """Set the memory budget (in bytes) for cached fields.
+       Set to 0 to disable caching."""
+    field_cache.resize(max_bytes)
+
+def clear_field_cache():
+    """Drop all the cached fields."""
+    field_cache.invalidate()
+
+def get_cycle(dataset_name, dt, realization, forecast_period,
+              direction=-1):
+    """The latest forecast cycle at or before dt (or, if 'direction'
+       is 1, the first after) with a file for this realization and
+       forecast period."""
+    ct = datetime.datetime(dt.year, dt.month, dt.day, dt.hour)
+    if direction > 0:
+        ct = ct+datetime.timedelta(hours=1)
+    for i in range(24):
+        if is_file_for(dataset_name, ct.year, ct.month, ct.day, ct.hour,
+                       realization, forecast_period):
+            return ct
+        ct = ct+datetime.timedelta(hours=direction)
+    raise StandardError("No %s data for realisation %d, forecast %d" %
+                        (dataset_name, realization, forecast_period))
+
+def get_bracketing_fields(dataset_name, vdate, realization, forecast_period):
+    """The fields in files needed for validity time 'vdate' and
+       (real) 'forecast_period' - a list of (validity time, forecast
+       period, weight). Fields with no weight are left out."""
+    period = int(forecast_period//Period_step)*Period_step
+    period_weight = (forecast_period-period)/float(Period_step)
+    periods = [(period, 1.0-period_weight)]
+    if period_weight > 0:
+        periods.append((period+Period_step, period_weight))
+    fields = []
+    for period, period_weight in periods:
+        # Cycles either side of the one this validity time would have
+        start = vdate-datetime.timedelta(hours=period)
+        previous = get_cycle(dataset_name, start, realization, period)
+        time_weight = 0.0
+        if start > previous:
+            next_cycle = get_cycle(dataset_name, previous, realization,
+                                   period, direction=1)
+            time_weight = ((start-previous).total_seconds()/
+                           (next_cycle-previous).total_seconds())
+        fields.append((previous+datetime.timedelta(hours=period), period,
+                       period_weight*(1.0-time_weight)))
+        if time_weight > 0:
+            fields.append((next_cycle+datetime.timedelta(hours=period),
+                           period, period_weight*time_weight))
+    return [field for field in fields if field[2] > 0]
+
+def load_field(dataset_name, variable, vdate, realization, forecast_period,
+               auto_fetch=True):
+    """A field that's in a file (see load_simple) - from the cache
+       if it's there. Don't change the cube returned."""
+    key = (dataset_name, variable, vdate, realization, forecast_period)
+    hslice = field_cache.get(key)
+    if hslice is None:
+        hslice = load_simple(dataset_name, variable, vdate.year,
+                             vdate.month, vdate.day, vdate.hour,
+                             realization, forecast_period, auto_fetch)
+        if field_cache.max_bytes > 0:
+            field_cache.put(key, hslice, hslice.data.nbytes)
+    return hslice
+
+def blend_fields(fields, weights, vdate, forecast_period):
+    """Weighted sum of some fields, labelled with the validity time and
+       forecast period."""
+    result = fields[0].copy()
+    if len(fields) > 1:
+        result.data = result.data*weights[0]
+        for field, weight in zip(fields[1:], weights[1:]):
+            result.data += field.data*weight
+    for name, value in (('time', vdate),
+                        ('forecast_period', forecast_period)):
+        try:
+            coord = result.coord(name)
+        except iris.exceptions.CoordinateNotFoundError:
+            continue
+        if coord.shape != (1,):
+            continue
+        if name == 'time':
+            coord.points = [coord.units.date2num(value)]
+        elif coord.units == 'hours':
+            coord.points = [value]
+        else:
+            continue
+        coord.bounds = None
+    return result
+
+def load_at_validity_time(dataset_name, variable, vdate, realization,
+                          forecast_period, auto_fetch=True):
+    """The field at validity time 'vdate' (a datetime) and 'forecast_period'
+       (hours - need not be a whole number), interpolated from the
+       fields in the files."""
+    dataset_name = validate_dataset_name(dataset_name)
+    bracket = get_bracketing_fields(dataset_name, vdate, realization,
+                                    forecast_period)
+    fields = [load_field(dataset_name, variable, field[0], realization,
+                         field[1], auto_fetch) for field in bracket]
+    return blend_fields(fields, [field[2] for field in bracket], vdate,
+                        forecast_period)
+
+def iter_fields_at_times(dataset_name, variable, times, realization,
+                         forecast_period, auto_fetch=True):
+    """Generate the field for each of a set of validity times (datetimes)
+       - interpolated as necessary. 'forecast_period' is one period for
+       all the times, or a list with one for each.
+
+       Each field from a file is loaded once, and kept until no later
+       time needs it (whatever the size of field_cache)."""
+    dataset_name = validate_dataset_name(dataset_name)
+    if not hasattr(forecast_period, '__len__'):
+        forecast_period = [forecast_period]*len(times)
+    brackets = [get_bracketing_fields(dataset_name, vdate, realization,
+                                      period)
+                for vdate, period in zip(times, forecast_period)]
+    # Last use of each field - so it can be dropped after
+    last_use = {}
+    for i, bracket in enumerate(brackets):
+        for field in bracket:
+            last_use[field[:2]] = i
+    fields = {}
+    for i, bracket in enumerate(brackets):
+        for field in bracket:
+            if field[:2] not in fields:
+                fields[field[:2]] = load_field(dataset_name, variable,
+                                               field[0], realization,
+                                               field[1], auto_fetch)
+        yield blend_fields([fields[field[:2]] for field in bracket],
+                           [field[2] for field in bracket],
+                           times[i], forecast_period[i])
+        for key in list(fields.keys()):
+            if last_use[key] <= i:
+                del fields[key]
+
+def load_at_times(dataset_name, variable, times, realization,
+                  forecast_period, auto_fetch=True):
+    """List of the fields for each of a set of validity times (see
+       iter_fields_at_times)."""
+    return list(iter_fields_at_times(dataset_name, variable, times,
+                                     realization, forecast_period,
+                                     auto_fetch))
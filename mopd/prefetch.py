@@ -0,0 +1,80 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Read-ahead for jobs walking forward in time through MOGREPS data.
+
+Off by default - turn it on with set_prefetch. Then, once
+load_simple (with auto_fetch) moves from one forecast cycle's file
+to the next, the files for the following cycles (same realization
+and forecast period) are fetched in the background.
+"""
+
+import datetime
+
+from scratch.prefetch import Prefetcher
+from scratch.prefetch import warm_file
+
+from .get import fetch_data
+from .get import is_file_for
+from .get import make_local_file_name
+
+# The Prefetcher in use (None if read-ahead is off)
+_prefetcher=None
+
+# Hours between forecast cycles
+Cycle_step=6
+
+def set_prefetch(depth=2, bandwidth=None, warm=False, threads=1):
+    """Turn read-ahead on: keep 'depth' files ahead of the job, fetched
+       in 'threads' background threads, using no more than 'bandwidth'
+       (bytes/s) each. If 'warm', also read each file once it's
+       fetched, so it's in the page cache. depth=0 turns it off."""
+    global _prefetcher
+    if _prefetcher is not None:
+        _prefetcher.stop()
+        _prefetcher=None
+    if depth>0:
+        _prefetcher=Prefetcher(_fetch, _successor, depth, bandwidth,
+                               _warm if warm else None, threads)
+
+def _fetch(stream, fdate, bandwidth):
+    dataset_name, realization, forecast_period = stream
+    if is_file_for(dataset_name, fdate.year, fdate.month, fdate.day,
+                   fdate.hour, realization, forecast_period):
+        fetch_data(dataset_name, fdate.year, fdate.month, fdate.day,
+                   fdate.hour, realization, forecast_period,
+                   bandwidth=bandwidth)
+
+def _successor(stream, fdate):
+    return fdate+datetime.timedelta(hours=Cycle_step)
+
+def _warm(stream, fdate, bandwidth):
+    dataset_name, realization, forecast_period = stream
+    if is_file_for(dataset_name, fdate.year, fdate.month, fdate.day,
+                   fdate.hour, realization, forecast_period):
+        warm_file(make_local_file_name(dataset_name, fdate.year,
+                                       fdate.month, fdate.day, fdate.hour,
+                                       realization, forecast_period),
+                  bandwidth)
+
+def note_access(dataset_name, fdate, realization, forecast_period):
+    """Called by load_simple for each field loaded - starts any
+       read-ahead needed, and waits if the file wanted is still being
+       prefetched."""
+    if _prefetcher is None:
+        return
+    stream = (dataset_name.lower(), realization, forecast_period)
+    _prefetcher.access(stream, fdate)
+    error = _prefetcher.wait_for(stream, fdate)
+    if error is not None:
+        print("Read-ahead of %s %s failed: %s" % (dataset_name, fdate, error))
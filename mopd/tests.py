@@ -18,7 +18,114 @@ Run python on this file to run all the tests.
 import mopd
 import os
 import datetime
+import hashlib
+import shutil
+import tempfile
+import threading
 import unittest
+import weakref
+import scratch
+
+try:
+    import numpy
+except ImportError:
+    numpy = None   # Interpolation not tested
+
+try:
+    import iris
+    import netCDF4
+except ImportError:
+    netCDF4 = None   # Direct reads not tested
+
+try:
+    import http.server as BaseHTTPServer
+    import socketserver as SocketServer
+except ImportError:
+    import BaseHTTPServer   # Python 2
+    import SocketServer
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in for the AWS store - serves 'files' (a dict of
+       path: content) and records each request in 'requests'."""
+    daemon_threads = True
+
+    def __init__(self, files):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StandInHandler)
+        self.files = files
+        self.requests = []
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # Keep-alive
+
+    def do_GET(self):
+        content = self.server.files.get(self.path)
+        self.server.requests.append((self.path, self.headers.get('Range'),
+                                     self.client_address[1]))
+        if content is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        offset = 0
+        if self.headers.get('Range') is not None:
+            offset = int(self.headers.get('Range')[6:].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', "bytes %d-%d/%d" %
+                             (offset, len(content)-1, len(content)))
+        else:
+            self.send_response(200)
+            self.send_header('ETag', '"%s"' % hashlib.md5(content).hexdigest())
+        self.send_header('Content-Length', str(len(content)-offset))
+        self.end_headers()
+        self.wfile.write(content[offset:])
+
+    def log_message(self, *args):
+        pass
+
+class StandInUnits(str):
+    """Enough of an iris unit - 'hours since 1970-01-01'."""
+
+    def date2num(self, dt):
+        return (dt-datetime.datetime(1970, 1, 1)).total_seconds()/3600.0
+
+class StandInCoord(object):
+    """Enough of an iris coordinate for blend_fields."""
+
+    def __init__(self, points, units):
+        self.points = list(points)
+        self.bounds = [[p-3, p] for p in self.points]
+        self.units = StandInUnits(units)
+
+    @property
+    def shape(self):
+        return (len(self.points),)
+
+class CoordinateNotFoundError(Exception):
+    pass
+
+class StandInIris(object):
+    """Just the exceptions blend_fields uses."""
+
+    class exceptions(object):
+        CoordinateNotFoundError = CoordinateNotFoundError
+
+class StandInField(object):
+    """Enough of an iris cube for mopd.interpolate."""
+
+    def __init__(self, data, coords):
+        self.data = data
+        self._coords = coords
+
+    def coord(self, name):
+        if name not in self._coords:
+            raise CoordinateNotFoundError(name)
+        return self._coords[name]
+
+    def copy(self):
+        return StandInField(self.data.copy(),
+                            dict((name, StandInCoord(c.points, c.units))
+                                 for name, c in self._coords.items()))
 
 class TestUM(unittest.TestCase):
  
@@ -111,6 +218,296 @@ class TestUM(unittest.TestCase):
         with self.assertRaises(StandardError):
              mopd.get_forecast_date_from_validity_date('mogreps-w',vdate,3)
 
+    def test_get_bracketing_fields(self):
+        vdate = datetime.datetime(2016, 3, 12, 9)
+        self.assertEqual(mopd.get_bracketing_fields('mogreps-g', vdate, 0, 3),
+                         [(vdate, 3, 1.0)])
+        # Between cycles
+        vdate = datetime.datetime(2016, 3, 12, 12)
+        self.assertEqual(mopd.get_bracketing_fields('mogreps-g', vdate, 0, 3),
+                         [(datetime.datetime(2016, 3, 12, 9), 3, 0.5),
+                          (datetime.datetime(2016, 3, 12, 15), 3, 0.5)])
+        # And between forecast periods
+        self.assertEqual(mopd.get_bracketing_fields('mogreps-g', vdate,
+                                                    0, 4.5),
+                         [(datetime.datetime(2016, 3, 12, 9), 3, 0.25),
+                          (datetime.datetime(2016, 3, 12, 15), 3, 0.25),
+                          (vdate, 6, 0.5)])
+        vdate = datetime.datetime(2016, 3, 12, 13, 30)
+        fields = mopd.get_bracketing_fields('mogreps-uk', vdate, 0, 7)
+        self.assertEqual(len(fields), 4)
+        self.assertAlmostEqual(sum(f[2] for f in fields), 1.0)
+        with self.assertRaises(StandardError):
+            mopd.get_bracketing_fields('mogreps-uk', vdate, 0, 40)
+
+    def test_select_from_index(self):
+        def entry(name, var_name, points=None):
+            return {'name': name, 'var_name': var_name, 'dimensions': [],
+                    'time_dim': 0 if points else None, 'points': points,
+                    'bounds': None}
+        index = ([entry('air_temperature', "air_temperature_%d" % i,
+                        [10.0, 13.0]) for i in range(4)] +
+                 [entry('air_pressure_at_sea_level',
+                        'air_pressure_at_sea_level', [10.0, 13.0])])
+        selected = mopd.select_from_index(index, 'mogreps-g', 'air.2m')
+        self.assertEqual([(e['var_name'], t) for e, t in selected],
+                         [('air_temperature_3', None)])
+        selected = mopd.select_from_index(index, 'mogreps-uk', 'prmsl', 13.0)
+        self.assertEqual([(e['var_name'], t) for e, t in selected],
+                         [('air_pressure_at_sea_level', 1)])
+        # Not there - the file will be searched instead
+        self.assertIsNone(mopd.select_from_index(index, 'mogreps-uk',
+                                                 'prmsl', 16.0))
+        self.assertIsNone(mopd.select_from_index(index, 'mogreps-g',
+                                                 'prate'))
+
+    def test_fetch_many(self):
+        content = b'CDF\x01' + b'\x00'*1000
+        fields = [(2016, 3, 12, 0, 0, 3), (2016, 3, 12, 0, 0, 6),
+                  (2016, 3, 12, 0, 0, 9),
+                  (2016, 3, 12, 3, 0, 3)]   # No run at 3 - no file
+        files = {}
+        for field in fields[:2]:
+            url = mopd.make_remote_url('mogreps-g', *field)
+            files[url[url.index('/mogreps-g/'):]] = content
+        server = StandInServer(files)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        tmp_dir = tempfile.mkdtemp()
+        sctmp = os.getenv('SCRATCH')
+        os.environ['SCRATCH'] = tmp_dir
+        mopd.set_base_url("http://127.0.0.1:%d" % server.server_address[1])
+        try:
+            # An interrupted download, to be resumed
+            partial = mopd.make_local_file_name('mogreps-g',
+                                                *fields[0]) + '.part'
+            os.makedirs(os.path.dirname(partial))
+            with open(partial, 'wb') as f:
+                f.write(content[:100])
+            results = mopd.fetch_many('mogreps-g', fields, workers=1,
+                                      progress=False)
+            self.assertEqual(sorted(r['status'] for r in results),
+                             ['done', 'done', 'unavailable', 'unavailable'])
+            # Only the fields with files are asked for
+            self.assertEqual(len(server.requests), 3)
+            for field in fields[:2]:
+                with open(mopd.make_local_file_name('mogreps-g',
+                                                    *field), 'rb') as f:
+                    self.assertEqual(f.read(), content)
+            self.assertEqual(server.requests[0][1], 'bytes=100-')
+            # One connection, kept alive, for all the requests
+            self.assertEqual(len(set(r[2] for r in server.requests)), 1)
+            # Already on disc - nothing to do
+            self.assertEqual(mopd.fetch_many('mogreps-g', fields[:2],
+                                             progress=False), [])
+        finally:
+            mopd.set_base_url()
+            os.environ['SCRATCH'] = sctmp
+            shutil.rmtree(tmp_dir)
+            server.shutdown()
+            server.server_close()
+
+    @unittest.skipUnless(numpy is not None, "needs numpy")
+    def test_iter_fields_at_times(self):
+        loads = []
+        def load_simple(dataset_name, variable, year, month, day, hour,
+                        realization, forecast_period, auto_fetch):
+            # Stand-in field: the validity hour everywhere
+            vdate = datetime.datetime(year, month, day, hour)
+            loads.append(vdate)
+            field = StandInField(numpy.full((2, 3), float(hour)),
+                                 {'time': StandInCoord(
+                                      [StandInUnits('').date2num(vdate)],
+                                      'hours since 1970-01-01'),
+                                  'forecast_period': StandInCoord(
+                                      [forecast_period], 'hours')})
+            fields.append(weakref.ref(field))
+            return field
+        fields = []
+        originals = (mopd.interpolate.load_simple, mopd.interpolate.iris)
+        mopd.interpolate.load_simple = load_simple
+        mopd.interpolate.iris = StandInIris
+        mopd.clear_field_cache()
+        try:
+            # Loaded once, then from the cache
+            vdate = datetime.datetime(2016, 3, 12, 9)
+            for i in range(2):
+                mopd.load_field('mogreps-g', 'prmsl', vdate, 0, 3)
+            self.assertEqual(loads, [vdate])
+            # Without the cache, each field is still loaded once, and
+            #  dropped after the last time that needs it
+            mopd.set_field_cache_size(0)
+            mopd.clear_field_cache()
+            del loads[:], fields[:]
+            times = [datetime.datetime(2016, 3, 12, h) for h in (9, 12, 15)]
+            blended = []
+            for i, field in enumerate(mopd.iter_fields_at_times(
+                                     'mogreps-g', 'prmsl', times, 0, 3)):
+                blended.append(field)
+                if i == 2:
+                    # 09:00 field not needed after 12:00
+                    self.assertIsNone(fields[0]())
+            self.assertEqual(loads, [times[0], times[2]])
+            self.assertEqual([f.data[0, 0] for f in blended], [9, 12, 15])
+            self.assertEqual(blended[1].coord('time').points,
+                             [StandInUnits('').date2num(times[1])])
+            self.assertIsNone(blended[1].coord('time').bounds)
+            self.assertEqual(blended[1].coord('forecast_period').points,
+                             [3])
+        finally:
+            (mopd.interpolate.load_simple,
+             mopd.interpolate.iris) = originals
+            mopd.set_field_cache_size(2**30)
+            mopd.clear_field_cache()
+
+    def assertReadAsIris(self, file_name):
+        # Same cube as iris.load_cube (and slicing) gives
+        entry = mopd.get_file_index(file_name)[0]
+        self.assertEqual(entry['time_dim'], 0)
+        for time_position in (None, 1):
+            cube = mopd.read_indexed_cube(file_name, entry, time_position)
+            loaded = iris.load_cube(file_name)
+            if time_position is not None:
+                loaded = loaded[time_position]
+            self.assertEqual(cube.summary(), loaded.summary())
+            self.assertEqual(cube.metadata, loaded.metadata)
+            self.assertEqual([(c.name(), type(c)) for c in cube.coords()],
+                             [(c.name(), type(c)) for c in loaded.coords()])
+            for coord in loaded.coords():
+                self.assertEqual(cube.coord(coord.name()), coord)
+                self.assertEqual(cube.coord_dims(coord.name()),
+                                 loaded.coord_dims(coord))
+            self.assertTrue(numpy.array_equal(cube.data, loaded.data))
+            self.assertEqual(cube, loaded)
+        return entry
+
+    def write_field(self, file_name, grid_mapping='latitude_longitude',
+                    scalar_coords=False):
+        # netCDF file like the MOGREPS ones: 3 times, 4x5 grid
+        if grid_mapping == 'rotated_latitude_longitude':
+            names = ('grid_latitude', 'grid_longitude')
+            units = ('degrees', 'degrees')
+        else:
+            names = ('latitude', 'longitude')
+            units = ('degrees_north', 'degrees_east')
+        with netCDF4.Dataset(file_name, 'w') as f:
+            f.source = 'test'
+            for name, size in (('time', 3), (names[0], 4),
+                               (names[1], 5), ('bnds', 2)):
+                f.createDimension(name, size)
+            crs = f.createVariable(grid_mapping, 'i4')
+            crs.grid_mapping_name = grid_mapping
+            crs.earth_radius = 6371229.0
+            if grid_mapping == 'rotated_latitude_longitude':
+                crs.grid_north_pole_latitude = 37.5
+                crs.grid_north_pole_longitude = 177.5
+            for name, unit, values in (
+                      ('time', 'hours since 1970-01-01', [100., 103., 106.]),
+                      (names[0], units[0], [-60., -20., 20., 60.]),
+                      (names[1], units[1], [0., 72., 144., 216., 288.])):
+                coord = f.createVariable(name, 'f8', (name,))
+                coord.standard_name = name
+                coord.units = unit
+                coord[:] = values
+            f.variables['time'].bounds = 'time_bnds'
+            bounds = f.createVariable('time_bnds', 'f8', ('time', 'bnds'))
+            bounds[:] = [[97., 100.], [100., 103.], [103., 106.]]
+            period = f.createVariable('forecast_period', 'f8', ('time',))
+            period.standard_name = 'forecast_period'
+            period.units = 'hours'
+            period[:] = [3., 6., 9.]
+            coordinates = 'forecast_period'
+            if scalar_coords:
+                realization = f.createVariable('realization', 'i4')
+                realization.standard_name = 'realization'
+                realization.units = '1'
+                realization[:] = 11
+                reference = f.createVariable('forecast_reference_time',
+                                             'f8')
+                reference.standard_name = 'forecast_reference_time'
+                reference.units = 'hours since 1970-01-01'
+                reference[:] = 97.
+                height = f.createVariable('height', 'f8')
+                height.standard_name = 'height'
+                height.units = 'm'
+                height.positive = 'up'
+                height.axis = 'Z'
+                height[:] = 1.5
+                coordinates = ('forecast_period forecast_reference_time '
+                               'height realization')
+            rain = f.createVariable('rain', 'f4',
+                                    ('time', names[0], names[1]))
+            rain.standard_name = 'stratiform_rainfall_amount'
+            rain.units = 'kg m-2'
+            rain.cell_methods = 'time: sum'
+            rain.grid_mapping = grid_mapping
+            rain.coordinates = coordinates
+            rain[:] = numpy.arange(60).reshape(3, 4, 5)
+
+    @unittest.skipUnless(netCDF4 is not None, "needs iris and netCDF4")
+    def test_read_indexed_cube(self):
+        tmp_dir = tempfile.mkdtemp()
+        sctmp = os.getenv('SCRATCH')
+        os.environ['SCRATCH'] = tmp_dir
+        file_name = os.path.join(tmp_dir, 'prods_op_mogreps-g_test.nc')
+        self.write_field(file_name)
+        try:
+            self.assertReadAsIris(file_name)
+            # The index goes when the file does
+            scratch.register_file(file_name)
+            scratch.set_quota(0)
+            self.assertEqual(scratch.enforce_quota(), [file_name])
+            self.assertFalse(os.path.exists(
+                                 mopd.get_index_file_name(file_name)))
+        finally:
+            os.environ['SCRATCH'] = sctmp
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(netCDF4 is not None, "needs iris and netCDF4")
+    def test_read_indexed_cube_rotated(self):
+        tmp_dir = tempfile.mkdtemp()
+        sctmp = os.getenv('SCRATCH')
+        os.environ['SCRATCH'] = tmp_dir
+        file_name = os.path.join(tmp_dir, 'prods_op_mogreps-uk_test.nc')
+        self.write_field(file_name, 'rotated_latitude_longitude')
+        try:
+            self.assertReadAsIris(file_name)
+        finally:
+            os.environ['SCRATCH'] = sctmp
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(netCDF4 is not None, "needs iris and netCDF4")
+    def test_read_indexed_cube_scalar_coords(self):
+        # Realization, forecast_reference_time and height, as in
+        #  MOGREPS files
+        tmp_dir = tempfile.mkdtemp()
+        sctmp = os.getenv('SCRATCH')
+        os.environ['SCRATCH'] = tmp_dir
+        file_name = os.path.join(tmp_dir, 'prods_op_mogreps-g_test.nc')
+        self.write_field(file_name, scalar_coords=True)
+        try:
+            self.assertReadAsIris(file_name)
+        finally:
+            os.environ['SCRATCH'] = sctmp
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(netCDF4 is not None, "needs iris and netCDF4")
+    def test_write_file_index_no_database(self):
+        # Quota database can't be opened - the index is still saved
+        tmp_dir = tempfile.mkdtemp()
+        sctmp = os.getenv('SCRATCH')
+        os.environ['SCRATCH'] = tmp_dir
+        file_name = os.path.join(tmp_dir, 'prods_op_mogreps-g_test.nc')
+        self.write_field(file_name)
+        try:
+            os.mkdir(scratch.get_quota_db_name())
+            mopd.write_file_index(file_name, [])
+            self.assertEqual(mopd.read_file_index(file_name), [])
+        finally:
+            os.environ['SCRATCH'] = sctmp
+            shutil.rmtree(tmp_dir)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -17,10 +17,11 @@ Simple plot functions for fast examination of 2d iris cubes.
 from __future__ import (absolute_import, division, print_function)
 from six.moves import (filter, input, map, range, zip)  # noqa
 
-import matplotlib.pyplot as plt
+from scratch.lazy import LazyModule
 
-import iris
-import iris.quickplot as qplt
+# matplotlib and iris are imported when first used
+plt=LazyModule('matplotlib.pyplot')
+qplt=LazyModule('iris.quickplot')
 
 def pplot(cb):
     
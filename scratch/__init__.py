@@ -0,0 +1,29 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+A package for managing the local copies of data on $SCRATCH
+(used by the twcr and mopd packages).
+
+scratch.quota keeps the files fetched within a size quota (set
+with scratch.set_quota).
+
+scratch.lazy has the lazy imports of iris, numpy etc. used by
+twcr, mopd and pbcu.
+
+"""
+
+from cache import *
+from catalogue import *
+from manifest import *
+from prefetch import *
+from quota import *
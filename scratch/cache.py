@@ -0,0 +1,97 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+An in-process cache for loaded data (20CR or MOGREPS).
+
+Holds recently-used items (usually iris cubes) up to a fixed
+memory budget, and discards the least-recently-used items when
+the budget is exceeded.
+"""
+
+import collections
+import threading
+
+class ByteLRUCache(object):
+    """Least-recently-used cache with a size limit in bytes.
+
+       Items are stored with their size (supplied by the caller),
+       and the oldest items are dropped when the total size goes
+       over 'max_bytes'. An item larger than the whole budget is
+       not stored at all."""
+
+    def __init__(self,max_bytes):
+        self.max_bytes=max_bytes
+        self.current_bytes=0
+        self.hits=0
+        self.misses=0
+        self._items=collections.OrderedDict()
+        self._lock=threading.RLock()
+
+    def get(self,key):
+        """Return the cached item, or None if it is not in the cache."""
+        with self._lock:
+            try:
+                value,nbytes=self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # Re-insert to mark as most recently used
+            self._items[key]=(value,nbytes)
+            self.hits += 1
+            return value
+
+    def put(self,key,value,nbytes):
+        """Add an item to the cache, evicting old items as necessary."""
+        with self._lock:
+            if key in self._items:
+                self.current_bytes -= self._items.pop(key)[1]
+            if nbytes>self.max_bytes:
+                return
+            self._items[key]=(value,nbytes)
+            self.current_bytes += nbytes
+            self._evict()
+
+    def invalidate(self,match=None):
+        """Remove items from the cache.
+
+           If 'match' is None, remove everything, otherwise remove
+           items for which match(key) is True."""
+        with self._lock:
+            for key in list(self._items.keys()):
+                if match is None or match(key):
+                    self.current_bytes -= self._items.pop(key)[1]
+
+    def resize(self,max_bytes):
+        """Change the size limit (evicts items if it's reduced)."""
+        with self._lock:
+            self.max_bytes=max_bytes
+            self._evict()
+
+    def stats(self):
+        """Hit and miss counts and current usage, as a dictionary."""
+        with self._lock:
+            return {'hits':self.hits,'misses':self.misses,
+                    'items':len(self._items),
+                    'bytes':self.current_bytes,
+                    'max_bytes':self.max_bytes}
+
+    def _evict(self):
+        while self.current_bytes>self.max_bytes and self._items:
+            self.current_bytes -= self._items.popitem(last=False)[1][1]
+
+    def __contains__(self,key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
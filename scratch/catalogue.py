@@ -0,0 +1,280 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+A catalogue of the data files on $SCRATCH.
+
+The catalogue records every file (with its size and modification
+time) and the modification time of every directory. It's made by a
+parallel walk of the directory tree, and kept in a JSON file.
+Refreshing it only re-reads directories which have changed, and
+questions like 'which of these files are missing?' are then
+answered without touching the filesystem.
+"""
+
+import os
+import re
+import json
+import stat
+import datetime
+import multiprocessing.pool
+
+# Layouts of the files catalogued - paths relative to the root.
+File_patterns=[
+   ('20CR',re.compile(r'^20CR/version_(?P<version>[^/]+)/'+
+                      r'(?P<type>mean|spread|ensemble|first\.guess\.mean|'+
+                      r'first\.guess\.spread)/(?P<year>\d{4})'+
+                      r'(/(?P<month>\d{2}))?/(?P<variable>[^/]+)\.nc$')),
+   ('20CR',re.compile(r'^20CR/version_(?P<version>[^/]+)/'+
+                      r'(?P<type>normal|standard\.deviation)/'+
+                      r'(?P<variable>[^/]+)\.nc$')),
+   ('20CR',re.compile(r'^20CR/version_(?P<version>[^/]+)/'+
+                      r'(?P<variable>observations)/(?P<year>\d{4})/'+
+                      r'((?P<month>\d{2})/psobfile_|prepbufrobs_assim_)'+
+                      r'(?P<time>\d{10})(\.txt)?$')),
+   ('mogreps',re.compile(r'^(?P<dataset>mogreps-g|mogreps-uk)/'+
+                      r'(?P<year>\d{4})/(?P<month>\d{2})/(?P<day>\d{2})/'+
+                      r'(?P<hour>\d{2})/prods_op_(?P=dataset)_\d{8}_\d{2}_'+
+                      r'(?P<realization>\d{2})_(?P<forecast_period>\d{3})'+
+                      r'\.nc$'))]
+
+# Catalogues already loaded - keyed on catalogue file name
+_catalogues={}
+
+def get_scratch_dir():
+    """The root directory of the local data."""
+    if os.getenv('SCRATCH') is None:
+        raise StandardError("SCRATCH environment variable is not defined")
+    return os.environ['SCRATCH']
+
+def get_catalogue_file_name(root):
+    """Where the catalogue of a directory tree is kept."""
+    return "%s/catalogue.json" % root
+
+def parse_file_name(relative_name):
+    """Get the description of a data file from its name (relative
+       to the catalogue root) - or None if it's not a data file.
+
+       Returns a dict of dataset, variable, version, type, year,
+       month, day, hour, realization and forecast_period (None
+       where they don't apply), and the time coverage (start
+       and end) where that's known from the name."""
+    for dataset,pattern in File_patterns:
+        match=pattern.match(relative_name)
+        if match is None:
+            continue
+        fields=match.groupdict()
+        entry={'dataset':fields.get('dataset',dataset)}
+        for name in ('variable','version','type'):
+            entry[name]=fields.get(name)
+        for name in ('year','month','day','hour',
+                     'realization','forecast_period'):
+            value=fields.get(name)
+            entry[name]=None if value is None else int(value)
+        entry['start']=None
+        entry['end']=None
+        if fields.get('time') is not None:
+            # One observation file
+            dt=datetime.datetime.strptime(fields['time'],"%Y%m%d%H")
+            (entry['year'],entry['month'],
+             entry['day'],entry['hour'])=(dt.year,dt.month,dt.day,dt.hour)
+            entry['start']=dt
+            entry['end']=dt
+        elif entry['forecast_period'] is not None:
+            # Forecast field - coverage is the validity time
+            dt=(datetime.datetime(entry['year'],entry['month'],
+                                  entry['day'],entry['hour'])+
+                datetime.timedelta(hours=entry['forecast_period']))
+            entry['start']=dt
+            entry['end']=dt
+        elif entry['month'] is not None:
+            entry['start']=datetime.datetime(entry['year'],entry['month'],1)
+            entry['end']=(entry['start']+
+                          datetime.timedelta(days=32)).replace(day=1)
+        elif entry['year'] is not None:
+            entry['start']=datetime.datetime(entry['year'],1,1)
+            entry['end']=datetime.datetime(entry['year']+1,1,1)
+        return entry
+    return None
+
+def scan_directory(root,relative_dir,previous=None):
+    """Read one directory - (mtime,files,subdirectories).
+
+       If the directory hasn't changed since 'previous' (an earlier
+       scan), its file list is re-used without looking at the files.
+       Returns None if the directory has gone."""
+    path=root if relative_dir=='' else "%s/%s" % (root,relative_dir)
+    try:
+        mtime=os.stat(path).st_mtime
+    except OSError:
+        return None
+    if previous is not None and previous['mtime']==mtime:
+        return previous
+    files={}
+    dirs=[]
+    try:
+        names=os.listdir(path)
+    except OSError:
+        return None
+    for name in names:
+        try:
+            st=os.stat("%s/%s" % (path,name))
+        except OSError:
+            continue   # Removed while we were looking
+        if stat.S_ISDIR(st.st_mode):
+            dirs.append(name)
+        elif name.endswith('.tmp'):
+            continue   # Partly-written
+        else:
+            files[name]=[st.st_size,st.st_mtime]
+    return {'mtime':mtime,'files':files,'dirs':sorted(dirs)}
+
+def _scan_directory(args):
+    # Pool.map takes one argument
+    return scan_directory(*args)
+
+class Catalogue(object):
+    """The files in a directory tree."""
+
+    def __init__(self,root,directories=None):
+        self.root=os.path.normpath(root)
+        # Relative directory name -> scan_directory result
+        self.directories=directories if directories is not None else {}
+        self._files=None
+
+    def refresh(self,threads=8,top=('20CR','mogreps-g','mogreps-uk')):
+        """Bring the catalogue up to date. The tree is walked a level
+           at a time, with the directories at each level read in
+           parallel. Returns True if anything changed."""
+        old=self.directories
+        new={}
+        level=[name for name in top
+                    if os.path.isdir("%s/%s" % (self.root,name))]
+        pool=multiprocessing.pool.ThreadPool(threads)
+        try:
+            while len(level)>0:
+                scans=pool.map(_scan_directory,
+                               [(self.root,d,old.get(d)) for d in level])
+                next_level=[]
+                for relative_dir,scan in zip(level,scans):
+                    if scan is None:
+                        continue
+                    new[relative_dir]=scan
+                    next_level.extend(["%s/%s" % (relative_dir,name)
+                                       for name in scan['dirs']])
+                level=next_level
+        finally:
+            pool.close()
+            pool.join()
+        changed=(set(new.keys())!=set(old.keys()) or
+                 any(new[d] is not old[d] for d in new))
+        self.directories=new
+        if changed:
+            self._files=None
+        return changed
+
+    def files(self):
+        """Dictionary mapping each file (full path) to (size,mtime)."""
+        if self._files is None:
+            self._files={}
+            for relative_dir,scan in self.directories.items():
+                for name,info in scan['files'].items():
+                    self._files["%s/%s/%s" % (self.root,relative_dir,
+                                              name)]=tuple(info)
+        return self._files
+
+    def has(self,file_name):
+        """True if the catalogue has a file (full path)."""
+        return os.path.normpath(file_name) in self.files()
+
+    def missing(self,file_names):
+        """The files from a list that are not in the catalogue."""
+        files=self.files()
+        return [f for f in file_names if os.path.normpath(f) not in files]
+
+    def add_file(self,file_name):
+        """Record a new file (e.g. just fetched) without a refresh."""
+        relative_dir=os.path.relpath(os.path.dirname(
+                                     os.path.normpath(file_name)),self.root)
+        scan=self.directories.get(relative_dir)
+        if scan is None:
+            scan={'mtime':None,'files':{},'dirs':[]}
+        else:
+            # New dict - so refresh rescans this directory
+            scan={'mtime':None,'files':dict(scan['files']),
+                  'dirs':scan['dirs']}
+        st=os.stat(file_name)
+        scan['files'][os.path.basename(file_name)]=[st.st_size,st.st_mtime]
+        self.directories[relative_dir]=scan
+        self._files=None
+
+    def entries(self,**criteria):
+        """Descriptions (see parse_file_name) of the data files
+           matching all the criteria (e.g. dataset='20CR',
+           variable='prmsl'). Each also has 'file_name', 'size' and
+           'mtime'."""
+        result=[]
+        for file_name,info in self.files().items():
+            entry=parse_file_name(file_name[len(self.root)+1:])
+            if entry is None:
+                continue
+            if any(entry.get(k)!=v for k,v in criteria.items()):
+                continue
+            entry['file_name']=file_name
+            entry['size'],entry['mtime']=info
+            result.append(entry)
+        return result
+
+    def save(self,file_name=None):
+        """Save the catalogue (atomically)."""
+        if file_name is None:
+            file_name=get_catalogue_file_name(self.root)
+        tmp_file="%s.%d.tmp" % (file_name,os.getpid())
+        with open(tmp_file,'w') as f:
+            json.dump({'root':self.root,'directories':self.directories},f)
+        os.rename(tmp_file,file_name)
+
+def load_catalogue(file_name):
+    """Load a catalogue saved with Catalogue.save."""
+    with open(file_name) as f:
+        saved=json.load(f)
+    return Catalogue(saved['root'],saved['directories'])
+
+def get_catalogue(root=None,refresh=False,threads=8):
+    """Get the catalogue of a directory tree (default $SCRATCH).
+
+       Uses the saved catalogue if there is one (and only reads it
+       again if it's been changed); otherwise, or if 'refresh' is
+       True, walks the tree to bring it up to date, and saves it."""
+    if root is None:
+        root=get_scratch_dir()
+    file_name=get_catalogue_file_name(os.path.normpath(root))
+    try:
+        mtime=os.path.getmtime(file_name)
+    except OSError:
+        mtime=None
+    cached=_catalogues.get(file_name)
+    if cached is not None and (cached[0]==mtime or mtime is None):
+        catalogue=cached[1]
+    elif mtime is not None:
+        catalogue=load_catalogue(file_name)
+    else:
+        catalogue=Catalogue(root)
+        refresh=True
+    if refresh and catalogue.refresh(threads):
+        try:
+            catalogue.save(file_name)
+            mtime=os.path.getmtime(file_name)
+        except (IOError,OSError):
+            pass   # Can't write - just don't save it
+    _catalogues[file_name]=(mtime,catalogue)
+    return catalogue
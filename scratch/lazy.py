@@ -0,0 +1,77 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Lazy imports of the big packages (iris, numpy, pandas, matplotlib).
+
+Importing iris takes seconds, and a job that only fetches files, or
+looks at the catalogue, never uses it. So the packages use these
+stand-ins instead, which import the real module the first time
+they are used:
+
+    from scratch.lazy import iris
+    cube=iris.load_cube(file_name)   # iris imported here
+"""
+
+import sys
+import importlib
+import threading
+
+# Only one thread does each import
+_lock=threading.RLock()
+
+class LazyModule(object):
+    """A stand-in for a module - it's imported the first time one
+       of its attributes is used.
+
+       'submodules' are imported at the same time (so, for example,
+       iris.cube.Cube works). 'setup' (if given) is called with the
+       module, once, just after it's imported."""
+
+    def __init__(self,name,submodules=(),setup=None):
+        self._name=name
+        self._submodules=submodules
+        self._setup=setup
+        self._module=None
+
+    def _load(self):
+        if self._module is None:
+            with _lock:
+                if self._module is None:
+                    module=importlib.import_module(self._name)
+                    for submodule in self._submodules:
+                        importlib.import_module(submodule)
+                    if self._setup is not None:
+                        self._setup(module)
+                    self._module=module
+        return self._module
+
+    def __getattr__(self,attribute):
+        return getattr(self._load(),attribute)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self._name
+
+def is_imported(name):
+    """True if a module has really been imported."""
+    return name in sys.modules
+
+def _setup_iris(module):
+    # Eliminate incomprehensible warning message
+    module.FUTURE.netcdf_promote='True'
+
+iris=LazyModule('iris',submodules=('iris.time','iris.cube','iris.coords'),
+                setup=_setup_iris)
+numpy=LazyModule('numpy')
+pandas=LazyModule('pandas')
+# Optional - only needed for twcr.rechunk and mopd.index
+netCDF4=LazyModule('netCDF4')
@@ -0,0 +1,272 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+A manifest of verified files on $SCRATCH.
+
+Files are downloaded to a '.part' name, checked, and only then
+renamed into place and recorded in the manifest (with their size
+and modification time). After that, checking a file is just a
+dictionary lookup and one stat.
+
+The manifest is a log file - each process appends one line per
+file, so several processes can fetch at once.
+"""
+
+import os
+import json
+import struct
+import threading
+
+from .catalogue import get_scratch_dir
+
+# Manifests already read - keyed on file name: (offset,entries)
+_manifests={}
+_lock=threading.RLock()
+
+# First bytes of netCDF files - classic, 64-bit offset, CDF5 and HDF5
+Netcdf_signatures=(b'CDF\x01',b'CDF\x02',b'CDF\x05',b'\x89HDF\r\n\x1a\n')
+
+# Bytes per value of each classic netCDF data type (by nc_type)
+Netcdf_type_sizes={1:1,2:1,3:2,4:4,5:4,6:8,7:1,8:2,9:4,10:8,11:8}
+
+def get_manifest_file_name(root=None):
+    """Where the manifest for a directory tree (default $SCRATCH)
+       is kept."""
+    if root is None:
+        root=get_scratch_dir()
+    return "%s/manifest.log" % os.path.normpath(root)
+
+def get_partial_name(file_name):
+    """Name to download a file to, before it's checked."""
+    return "%s.part" % file_name
+
+def read_manifest(manifest_file):
+    """The entries in a manifest - a dict mapping file name to
+       {'size','mtime'} (and 'contents', for a directory - see
+       record_verified_contents). Only the lines added since the last
+       call are read."""
+    with _lock:
+        offset,entries=_manifests.get(manifest_file,(0,{}))
+        try:
+            with open(manifest_file,'rb') as f:
+                f.seek(offset)
+                new=f.read()
+        except IOError:
+            return entries   # No manifest yet
+        # Ignore a last line that's still being written
+        end=new.rfind(b'\n')+1
+        for line in new[:end].decode('utf-8').splitlines():
+            try:
+                entry=json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('removed'):
+                entries.pop(entry['file'],None)
+            else:
+                entries[entry['file']]={'size':entry['size'],
+                                        'mtime':entry['mtime']}
+                if 'contents' in entry:
+                    entries[entry['file']]['contents']=entry['contents']
+        _manifests[manifest_file]=(offset+end,entries)
+        return entries
+
+def append_to_manifest(manifest_file,entry):
+    """Add a line to a manifest - in one write, so lines from
+       different processes don't get mixed up."""
+    line=(json.dumps(entry)+'\n').encode('utf-8')
+    fd=os.open(manifest_file,os.O_WRONLY|os.O_APPEND|os.O_CREAT,0o644)
+    try:
+        os.write(fd,line)
+    finally:
+        os.close(fd)
+
+def record_verified(file_name,root=None):
+    """Add a (checked) file to the manifest."""
+    st=os.stat(file_name)
+    append_to_manifest(get_manifest_file_name(root),
+                       {'file':os.path.normpath(file_name),
+                        'size':st.st_size,'mtime':st.st_mtime})
+
+def forget_file(file_name,root=None):
+    """Remove a file from the manifest (e.g. when it's deleted)."""
+    append_to_manifest(get_manifest_file_name(root),
+                       {'file':os.path.normpath(file_name),'removed':True})
+
+def is_verified(file_name,root=None):
+    """True if a file is in the manifest, and hasn't changed since."""
+    entry=read_manifest(get_manifest_file_name(root)).get(
+                                          os.path.normpath(file_name))
+    if entry is None:
+        return False
+    try:
+        st=os.stat(file_name)
+    except OSError:
+        return False
+    return st.st_size==entry['size'] and st.st_mtime==entry['mtime']
+
+def record_verified_contents(dir_name,names,root=None):
+    """Add a directory to the manifest as complete - holding the files
+       'names' (relative to it), as they are now. For a directory
+       synchronised with a remote one, 'names' is the remote listing,
+       so files the remote doesn't have don't stop it being complete."""
+    contents={}
+    for name in names:
+        st=os.stat(os.path.join(dir_name,name))
+        contents[name]=[st.st_size,st.st_mtime]
+    append_to_manifest(get_manifest_file_name(root),
+                       {'file':os.path.normpath(dir_name),
+                        'size':None,'mtime':None,'contents':contents})
+
+def is_verified_contents(dir_name,root=None):
+    """True if a directory is in the manifest as complete (see
+       record_verified_contents), and none of its files has changed
+       since."""
+    entry=read_manifest(get_manifest_file_name(root)).get(
+                                          os.path.normpath(dir_name))
+    if entry is None or 'contents' not in entry:
+        return False
+    for name,(size,mtime) in entry['contents'].items():
+        try:
+            st=os.stat(os.path.join(dir_name,name))
+        except OSError:
+            return False
+        if st.st_size!=size or st.st_mtime!=mtime:
+            return False
+    return True
+
+def check_netcdf(file_name):
+    """True if a file looks like a complete netCDF file.
+
+       Checks the signature at the start of the file, and that the
+       file is as long as its header says it should be - the end-of-file
+       address in the superblock for netCDF4 (HDF5) files, or the end of
+       the last variable for classic files. This catches truncated
+       downloads."""
+    try:
+        size=os.path.getsize(file_name)
+        with open(file_name,'rb') as f:
+            header=f.read(128)
+    except (IOError,OSError):
+        return False
+    if not header.startswith(Netcdf_signatures):
+        return False
+    if not header.startswith(Netcdf_signatures[-1]):
+        try:
+            with open(file_name,'rb') as f:
+                expected=get_classic_netcdf_size(f)
+        except (IOError,OSError,ValueError,KeyError,struct.error):
+            return False   # Unreadable header
+        return expected is None or size>=expected
+    version=struct.unpack('B',header[8:9])[0]
+    if version in (0,1):
+        offset_size=struct.unpack('B',header[13:14])[0]
+        start=24 if version==0 else 28
+    elif version in (2,3):
+        offset_size=struct.unpack('B',header[9:10])[0]
+        start=12
+    else:
+        return True   # Unknown superblock - can't check the length
+    if offset_size not in (4,8):
+        return False
+    code='<I' if offset_size==4 else '<Q'
+    base=struct.unpack(code,header[start:start+offset_size])[0]
+    eof_start=start+2*offset_size
+    end=struct.unpack(code,header[eof_start:eof_start+offset_size])[0]
+    if end==2**(8*offset_size)-1:
+        return True   # Undefined address
+    return size>=base+end
+
+def get_classic_netcdf_size(f):
+    """How long a classic (CDF1, CDF2 or CDF5) netCDF file should be,
+       from the header read from 'f' - or None if it can't tell (the
+       number of records is still being written).
+
+       Raises ValueError if the header is incomplete."""
+    def read(code):
+        data=f.read(struct.calcsize(code))
+        if len(data)<struct.calcsize(code):
+            raise ValueError("Incomplete netCDF header")
+        return struct.unpack(code,data)[0]
+    def skip(n_bytes):
+        f.seek((n_bytes+3)//4*4,1)   # Padded to 4 bytes
+    version=struct.unpack('B',f.read(4)[3:4])[0]
+    count='>Q' if version==5 else '>I'    # Lengths and counts
+    offset='>I' if version==1 else '>Q'   # File offsets
+    def skip_attributes():
+        read('>I')   # NC_ATTRIBUTE tag (or ABSENT)
+        for i in range(read(count)):
+            skip(read(count))   # Name
+            nc_type=read('>I')
+            skip(read(count)*Netcdf_type_sizes[nc_type])
+    numrecs=read(count)
+    if numrecs==2**(8*struct.calcsize(count))-1:
+        return None   # Streaming - records still being written
+    read('>I')   # NC_DIMENSION tag (or ABSENT)
+    dim_lengths=[]
+    for i in range(read(count)):
+        skip(read(count))   # Name
+        dim_lengths.append(read(count))
+    skip_attributes()   # Global attributes
+    read('>I')   # NC_VARIABLE tag (or ABSENT)
+    variables=[]
+    for i in range(read(count)):
+        skip(read(count))   # Name
+        dim_ids=[read(count) for d in range(read(count))]
+        skip_attributes()
+        nc_type=read('>I')
+        read(count)   # vsize - may be capped, so worked out below
+        begin=read(offset)
+        is_record=len(dim_ids)>0 and dim_lengths[dim_ids[0]]==0
+        n_values=1
+        for dim_id in dim_ids[1 if is_record else 0:]:
+            n_values*=dim_lengths[dim_id]
+        variables.append((is_record,begin,
+                          n_values*Netcdf_type_sizes[nc_type]))
+    expected=f.tell()   # End of the header
+    n_record=len([v for v in variables if v[0]])
+    if n_record>1:
+        # Each variable's part of a record is padded to 4 bytes
+        variables=[(v[0],v[1],(v[2]+3)//4*4 if v[0] else v[2])
+                   for v in variables]
+    record_size=sum(v[2] for v in variables if v[0])
+    for is_record,begin,size in variables:
+        if is_record:
+            if numrecs>0:
+                expected=max(expected,begin+(numrecs-1)*record_size+size)
+        else:
+            expected=max(expected,begin+size)
+    return expected
+
+def is_good_file(file_name,check=check_netcdf,root=None):
+    """True if a file is there and complete: either it's in the
+       manifest, or it passes 'check' (and is then added)."""
+    if is_verified(file_name,root):
+        return True
+    if not os.path.isfile(file_name) or not check(file_name):
+        return False
+    try:
+        record_verified(file_name,root)
+    except (IOError,OSError):
+        pass   # Can't write the manifest - still a good file
+    return True
+
+def install_file(partial_name,file_name,check=check_netcdf,root=None):
+    """Check a downloaded file, and if it's good, rename it into
+       place and add it to the manifest. A bad file is deleted (so
+       the next try starts again) and IOError raised."""
+    if not check(partial_name):
+        os.remove(partial_name)
+        raise IOError("Downloaded file %s is incomplete or corrupt" %
+                      file_name)
+    os.rename(partial_name,file_name)
+    record_verified(file_name,root)
@@ -0,0 +1,151 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Read-ahead for jobs that walk forward in time through data files.
+
+The loaders tell a Prefetcher which file (a 'position' in a
+'stream' - e.g. a month of one variable) each load uses. Once a job
+moves on to the next file, the following few files are fetched in
+background threads, so the copy overlaps with the job's work.
+"""
+
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue   # Python 2
+
+class Prefetcher(object):
+    """Fetch files ahead of a job walking through them in order.
+
+       fetch(stream,position,bandwidth) gets one file;
+       successor(stream,position) is the position after 'position'
+       (or None if there isn't one); warm(stream,position,bandwidth)
+       (optional) is called after each fetch, to read the file
+       into memory. 'depth' is how many files to keep ahead, and
+       'bandwidth' (bytes/s, or None) is passed on to the fetches."""
+
+    def __init__(self,fetch,successor,depth=2,bandwidth=None,
+                 warm=None,threads=1):
+        self.fetch=fetch
+        self.successor=successor
+        self.depth=depth
+        self.bandwidth=bandwidth
+        self.warm=warm
+        self.last={}        # Last position used in each stream
+        self.tasks={}       # (stream,position) -> Event set when done
+        self.errors={}      # (stream,position) -> exception from fetch
+                            #  (until wait_for reports it)
+        self.lock=threading.Lock()
+        self.queue=queue.Queue()
+        self.workers=[]
+        for i in range(threads):
+            worker=threading.Thread(target=self._work)
+            worker.daemon=True
+            worker.start()
+            self.workers.append(worker)
+
+    def access(self,stream,position):
+        """Note that a load is using 'position'. If that's the one
+           after the last position used in the stream, the job is
+           walking forward - so start fetching the next 'depth'."""
+        with self.lock:
+            last=self.last.get(stream)
+            self.last[stream]=position
+            if last is None or position==last:
+                return
+            if position!=self.successor(stream,last):
+                self._prune(stream,[position])
+                return   # Not sequential
+            wanted=[position]
+            ahead=position
+            for i in range(self.depth):
+                ahead=self.successor(stream,ahead)
+                if ahead is None:
+                    break
+                wanted.append(ahead)
+                if (stream,ahead) in self.tasks:
+                    continue
+                self.tasks[(stream,ahead)]=threading.Event()
+                self.queue.put((stream,ahead))
+            self._prune(stream,wanted)
+
+    def _prune(self,stream,wanted):
+        # Forget finished prefetches in a stream that the job has
+        #  moved away from (call with the lock held)
+        for task in list(self.tasks.keys()):
+            if (task[0]==stream and task[1] not in wanted and
+                    self.tasks[task].is_set()):
+                del self.tasks[task]
+                self.errors.pop(task,None)
+
+    def wait_for(self,stream,position,timeout=None):
+        """If 'position' is being prefetched, wait until it's done.
+
+           Returns the exception raised by the prefetch, if it failed
+           (otherwise None)."""
+        task=(stream,position)
+        with self.lock:
+            done=self.tasks.get(task)
+        if done is None or not done.wait(timeout):
+            return None
+        with self.lock:
+            # Done with it - the job is using it now
+            self.tasks.pop(task,None)
+            return self.errors.pop(task,None)
+
+    def _work(self):
+        while True:
+            task=self.queue.get()
+            if task is None:
+                break
+            try:
+                self.fetch(task[0],task[1],self.bandwidth)
+                if self.warm is not None:
+                    self.warm(task[0],task[1],self.bandwidth)
+            except Exception as e:
+                # Reported by wait_for
+                with self.lock:
+                    self.errors[task]=e
+            finally:
+                self.tasks[task].set()
+                self.queue.task_done()
+
+    def wait(self):
+        """Wait until all the prefetches started have finished."""
+        self.queue.join()
+
+    def stop(self):
+        """Finish the prefetches started, then stop the threads."""
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+def warm_file(file_name,bandwidth=None,block_size=2**20):
+    """Read a file, so it's in the page cache when it's loaded.
+       Reading is slowed to 'bandwidth' bytes/s if that's given."""
+    start=time.time()
+    total=0
+    with open(file_name,'rb') as f:
+        while True:
+            block=f.read(block_size)
+            if len(block)==0:
+                break
+            total+=len(block)
+            if bandwidth is not None:
+                ahead=total/float(bandwidth)-(time.time()-start)
+                if ahead>0:
+                    time.sleep(ahead)
@@ -0,0 +1,274 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Keep the fetched data on $SCRATCH within a size quota.
+
+The fetchers register each file they fetch (with its size and how
+long it took to get), and the loaders register each use. When the
+files registered add up to more than the quota, the least recently
+used are deleted - or, with the 'cost' policy, the least recently
+used allowing for how long they take to fetch again.
+
+Files made from a fetched file (indices, sidecars) can be added as its
+companions - they're deleted along with it.
+
+Running jobs can pin files they still need, so they aren't deleted.
+The records are kept in an sqlite database, so several processes
+can use it at once.
+"""
+
+import os
+import time
+import errno
+import socket
+import sqlite3
+import contextlib
+
+from .catalogue import get_scratch_dir
+from .manifest import forget_file
+
+# Eviction policies
+Quota_policies=('lru','cost')
+
+# With the 'cost' policy, each second a file took to fetch counts
+#  as this many seconds more recent use.
+Cost_weight=3600.0
+
+# Don't record another use of the same file within this many seconds
+Access_interval=60.0
+
+# Seconds a use waits for the database - don't hold up reads
+Access_timeout=1.0
+
+# Time of the last use recorded, by this process, of each file
+_last_access={}
+
+def get_quota_db_name(root=None):
+    """The database for a directory tree (default $SCRATCH)."""
+    if root is None:
+        root=get_scratch_dir()
+    return "%s/quota.sqlite" % os.path.normpath(root)
+
+def connect(root=None,timeout=60):
+    """Open the database (making it if necessary). 'timeout' is how
+       long (seconds) to wait for another process's lock."""
+    db=sqlite3.connect(get_quota_db_name(root),timeout=timeout)
+    db.execute("CREATE TABLE IF NOT EXISTS files (file TEXT PRIMARY KEY,"+
+               " size INTEGER, last_access REAL, fetch_seconds REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS pins (file TEXT, host TEXT,"+
+               " pid INTEGER)")
+    db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY,"+
+               " value TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS companions (file TEXT,"+
+               " companion TEXT PRIMARY KEY)")
+    return db
+
+def set_quota(max_bytes,policy='lru',root=None):
+    """Set the quota (bytes - None for no limit), and the policy used
+       to choose which files to delete. Applies to all processes."""
+    if policy not in Quota_policies:
+        raise StandardError("Unsupported quota policy %s" % policy)
+    db=connect(root)
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO settings VALUES (?,?)",
+                       ('quota',None if max_bytes is None
+                                     else str(int(max_bytes))))
+            db.execute("INSERT OR REPLACE INTO settings VALUES (?,?)",
+                       ('policy',policy))
+    finally:
+        db.close()
+
+def get_quota(root=None):
+    """The quota - (max_bytes,policy)."""
+    db=connect(root)
+    try:
+        settings=dict(db.execute("SELECT name,value FROM settings"))
+    finally:
+        db.close()
+    max_bytes=settings.get('quota')
+    return (None if max_bytes is None else int(max_bytes),
+            settings.get('policy','lru'))
+
+def register_file(file_name,fetch_seconds=0.0,root=None):
+    """Record a file just fetched, then delete old files if the
+       quota is exceeded."""
+    file_name=os.path.normpath(file_name)
+    now=time.time()
+    db=connect(root)
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?)",
+                       (file_name,os.path.getsize(file_name),now,
+                        fetch_seconds))
+    finally:
+        db.close()
+    _last_access[file_name]=now
+    enforce_quota(root=root,keep=(file_name,))
+
+def add_companion(file_name,companion,root=None):
+    """Record a file made from a fetched one (an index, say), so it's
+       deleted when that is."""
+    db=connect(root)
+    try:
+        with db:
+            db.execute("INSERT OR REPLACE INTO companions VALUES (?,?)",
+                       (os.path.normpath(file_name),
+                        os.path.normpath(companion)))
+    finally:
+        db.close()
+
+def remove_companions(db,file_name):
+    """Delete the companions of a file (see add_companion)."""
+    for (companion,) in db.execute(
+              "SELECT companion FROM companions WHERE file=?",
+              (file_name,)).fetchall():
+        try:
+            os.remove(companion)
+        except OSError as e:
+            if e.errno!=errno.ENOENT:
+                continue   # Can't delete it - leave it recorded
+        db.execute("DELETE FROM companions WHERE companion=?",(companion,))
+
+def note_access(file_name,root=None):
+    """Record a use of a file (if it's one that was registered).
+       This is only bookkeeping, so it's skipped (not an error) if the
+       database is locked or can't be written."""
+    file_name=os.path.normpath(file_name)
+    now=time.time()
+    if now-_last_access.get(file_name,0)<Access_interval:
+        return
+    _last_access[file_name]=now
+    try:
+        db=connect(root,timeout=Access_timeout)
+        try:
+            with db:
+                db.execute("UPDATE files SET last_access=? WHERE file=?",
+                           (now,file_name))
+        finally:
+            db.close()
+    except sqlite3.Error:
+        pass   # Use not recorded - the file may be deleted a bit early
+
+def pin(file_name,root=None):
+    """Stop a file being deleted, until unpin is called, or this
+       process ends."""
+    db=connect(root)
+    try:
+        with db:
+            db.execute("INSERT INTO pins VALUES (?,?,?)",
+                       (os.path.normpath(file_name),socket.gethostname(),
+                        os.getpid()))
+    finally:
+        db.close()
+
+def unpin(file_name,root=None):
+    """Remove this process's pin on a file."""
+    db=connect(root)
+    try:
+        with db:
+            db.execute("DELETE FROM pins WHERE file=? AND host=? AND pid=?",
+                       (os.path.normpath(file_name),socket.gethostname(),
+                        os.getpid()))
+    finally:
+        db.close()
+
+@contextlib.contextmanager
+def pinned(file_names,root=None):
+    """Pin some files for the duration of a with block."""
+    for file_name in file_names:
+        pin(file_name,root)
+    try:
+        yield
+    finally:
+        for file_name in file_names:
+            unpin(file_name,root)
+
+def is_running(host,pid):
+    """True unless a process is known to have finished - processes on
+       other hosts can't be checked, so are assumed to be running."""
+    if host!=socket.gethostname():
+        return True
+    try:
+        os.kill(pid,0)
+    except OSError as e:
+        return e.errno==errno.EPERM
+    return True
+
+def get_pinned_files(db):
+    """Files pinned by running processes (and drop pins left by
+       processes that have gone)."""
+    pinned=set()
+    for file_name,host,pid in db.execute("SELECT file,host,pid FROM pins"):
+        if is_running(host,pid):
+            pinned.add(file_name)
+        else:
+            db.execute("DELETE FROM pins WHERE host=? AND pid=?",(host,pid))
+    return pinned
+
+def enforce_quota(max_bytes=None,policy=None,root=None,keep=()):
+    """Delete files (not pinned, or in 'keep') - and their companions -
+       until the total size is within the quota. Returns the list of
+       files deleted."""
+    if max_bytes is None or policy is None:
+        quota=get_quota(root)
+        max_bytes=quota[0] if max_bytes is None else max_bytes
+        policy=quota[1] if policy is None else policy
+    if max_bytes is None:
+        return []
+    if policy=='cost':
+        order="last_access+fetch_seconds*%f" % Cost_weight
+    else:
+        order="last_access"
+    deleted=[]
+    db=connect(root)
+    try:
+        with db:
+            total=db.execute("SELECT SUM(size) FROM files").fetchone()[0] or 0
+            if total<=max_bytes:
+                return []
+            pinned=get_pinned_files(db)
+            for file_name,size in db.execute(
+                      "SELECT file,size FROM files ORDER BY %s" % order
+                                                            ).fetchall():
+                if total<=max_bytes:
+                    break
+                if file_name in pinned or file_name in keep:
+                    continue
+                try:
+                    os.remove(file_name)
+                except OSError as e:
+                    if e.errno!=errno.ENOENT:
+                        continue   # Can't delete it - leave it registered
+                db.execute("DELETE FROM files WHERE file=?",(file_name,))
+                remove_companions(db,file_name)
+                total-=size
+                deleted.append(file_name)
+    finally:
+        db.close()
+    for file_name in deleted:
+        try:
+            forget_file(file_name,root)
+        except (IOError,OSError):
+            pass
+    return deleted
+
+def get_usage(root=None):
+    """Total size and number of files registered."""
+    db=connect(root)
+    try:
+        total,count=db.execute("SELECT SUM(size),COUNT(*) FROM files"
+                               ).fetchone()
+    finally:
+        db.close()
+    return {'bytes':total or 0,'files':count}
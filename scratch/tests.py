@@ -0,0 +1,213 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Test cases for the scratch module.
+
+Run python on this file to run all the tests.
+"""
+import scratch
+import os
+import struct
+import datetime
+import shutil
+import tempfile
+import unittest
+
+def make_file(root,name,content=b'x'):
+    file_name="%s/%s" % (root,name)
+    if not os.path.isdir(os.path.dirname(file_name)):
+        os.makedirs(os.path.dirname(file_name))
+    with open(file_name,'wb') as f:
+        f.write(content)
+    return file_name
+
+class TestScratch(unittest.TestCase):
+
+    def setUp(self):
+        self.root=tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_parse_file_name(self):
+        entry=scratch.parse_file_name(
+                  '20CR/version_4.5.1/ensemble/1903/02/prmsl.nc')
+        self.assertEqual((entry['dataset'],entry['variable'],
+                          entry['version'],entry['type'],
+                          entry['year'],entry['month']),
+                         ('20CR','prmsl','4.5.1','ensemble',1903,2))
+        self.assertEqual(entry['end'],datetime.datetime(1903,3,1))
+        entry=scratch.parse_file_name(
+                  '20CR/version_4.5.1/observations/1903/02/'+
+                  'psobfile_1903021006')
+        self.assertEqual(entry['start'],datetime.datetime(1903,2,10,6))
+        entry=scratch.parse_file_name(
+                  'mogreps-g/2016/01/01/06/'+
+                  'prods_op_mogreps-g_20160101_06_03_012.nc')
+        self.assertEqual((entry['realization'],entry['forecast_period']),
+                         (3,12))
+        self.assertEqual(entry['start'],datetime.datetime(2016,1,1,18))
+        self.assertIsNone(scratch.parse_file_name(
+                  '20CR/version_4.5.1/store/ensemble/prmsl/index.json'))
+
+    def test_catalogue(self):
+        f1=make_file(self.root,'20CR/version_3.5.1/ensemble/1903/prmsl.nc')
+        make_file(self.root,'20CR/version_3.5.1/ensemble/1903/x.nc.12.tmp')
+        catalogue=scratch.get_catalogue(self.root)
+        self.assertTrue(catalogue.has(f1))
+        self.assertEqual(len(catalogue.files()),1)
+        f2="%s/20CR/version_3.5.1/ensemble/1904/prmsl.nc" % self.root
+        self.assertEqual(catalogue.missing([f1,f2]),[f2])
+        # Saved, and reloaded
+        catalogue=scratch.load_catalogue(
+                       scratch.get_catalogue_file_name(self.root))
+        self.assertTrue(catalogue.has(f1))
+        # Refresh finds new files, and re-uses unchanged directories
+        make_file(self.root,'20CR/version_3.5.1/ensemble/1904/prmsl.nc')
+        unchanged=catalogue.directories['20CR/version_3.5.1/ensemble/1903']
+        self.assertTrue(catalogue.refresh())
+        self.assertTrue(catalogue.has(f2))
+        self.assertIs(catalogue.directories[
+                          '20CR/version_3.5.1/ensemble/1903'],unchanged)
+        self.assertFalse(catalogue.refresh())
+        self.assertEqual(len(catalogue.entries(year=1904)),1)
+        # Removed files go on refresh
+        shutil.rmtree(os.path.dirname(f1))
+        catalogue.refresh()
+        self.assertFalse(catalogue.has(f1))
+
+    def test_check_netcdf(self):
+        # HDF5 version 0 superblock, with end-of-file address 200
+        header=(b'\x89HDF\r\n\x1a\n'+b'\x00'*5+b'\x08\x08'+b'\x00'*9+
+                b'\x00'*8+b'\xff'*8+struct.pack('<Q',200)+b'\xff'*8)
+        complete=make_file(self.root,'complete.nc',header+b'\x00'*144)
+        self.assertTrue(scratch.check_netcdf(complete))
+        truncated=make_file(self.root,'truncated.nc',header+b'\x00'*100)
+        self.assertFalse(scratch.check_netcdf(truncated))
+        self.assertTrue(scratch.check_netcdf(
+                  make_file(self.root,'classic.nc',b'CDF\x01'+b'\x00'*60)))
+        # Classic, with one int variable of 3 values - data at byte 80
+        name=struct.pack('>I',1)+b'x\x00\x00\x00'
+        header=(b'CDF\x01'+struct.pack('>III',0,10,1)+name+
+                struct.pack('>III',3,0,0)+struct.pack('>II',11,1)+name+
+                struct.pack('>IIII',1,0,0,0)+struct.pack('>III',4,12,80))
+        self.assertTrue(scratch.check_netcdf(
+                  make_file(self.root,'classic.nc',header+b'\x00'*12)))
+        self.assertFalse(scratch.check_netcdf(
+                  make_file(self.root,'classic.nc',header+b'\x00'*8)))
+        self.assertFalse(scratch.check_netcdf(
+                  make_file(self.root,'classic.nc',header[:50])))
+        self.assertFalse(scratch.check_netcdf(
+                  make_file(self.root,'error.nc',b'<html>Not found</html>')))
+
+    def test_manifest(self):
+        partial=scratch.get_partial_name("%s/a.nc" % self.root)
+        make_file(self.root,os.path.basename(partial),b'CDF\x01'+b'\x00'*60)
+        scratch.install_file(partial,"%s/a.nc" % self.root,root=self.root)
+        self.assertFalse(os.path.exists(partial))
+        self.assertTrue(scratch.is_verified("%s/a.nc" % self.root,
+                                            root=self.root))
+        # Changed file is no longer verified
+        make_file(self.root,'a.nc',b'CDF\x01')
+        self.assertFalse(scratch.is_verified("%s/a.nc" % self.root,
+                                             root=self.root))
+        # Bad download is removed
+        make_file(self.root,os.path.basename(partial),b'<html>')
+        with self.assertRaises(IOError):
+            scratch.install_file(partial,"%s/a.nc" % self.root,
+                                 root=self.root)
+        self.assertFalse(os.path.exists(partial))
+        # A directory, complete with the files it had
+        make_file(self.root,'obs/x',b'1')
+        make_file(self.root,'obs/y',b'2')
+        dir_name="%s/obs" % self.root
+        self.assertFalse(scratch.is_verified_contents(dir_name,self.root))
+        scratch.record_verified_contents(dir_name,['x','y'],self.root)
+        self.assertTrue(scratch.is_verified_contents(dir_name,self.root))
+        make_file(self.root,'obs/y',b'22')
+        self.assertFalse(scratch.is_verified_contents(dir_name,self.root))
+
+    def test_prefetch(self):
+        fetched=[]
+        def fetch(stream,position,bandwidth):
+            fetched.append((stream,position))
+        prefetcher=scratch.Prefetcher(fetch,lambda stream,p: p+1,depth=2)
+        prefetcher.access('a',1)
+        prefetcher.access('a',1)
+        prefetcher.wait()
+        self.assertEqual(fetched,[])     # Not moving forward yet
+        prefetcher.access('a',2)
+        prefetcher.wait()
+        self.assertEqual(fetched,[('a',3),('a',4)])
+        prefetcher.access('a',3)
+        prefetcher.wait_for('a',3)
+        prefetcher.access('b',7)
+        prefetcher.access('b',5)         # Not sequential
+        prefetcher.wait()
+        self.assertEqual(fetched,[('a',3),('a',4),('a',5)])
+        # Finished prefetches the job has passed are forgotten
+        self.assertEqual(sorted(prefetcher.tasks.keys()),
+                         [('a',4),('a',5)])
+        prefetcher.stop()
+
+    def test_prefetch_error(self):
+        def fetch(stream,position,bandwidth):
+            if position==3:
+                raise IOError("Remote data not available")
+        prefetcher=scratch.Prefetcher(fetch,lambda stream,p: p+1,depth=1)
+        prefetcher.access('a',1)
+        prefetcher.access('a',2)
+        prefetcher.wait()
+        prefetcher.access('a',3)
+        self.assertIsInstance(prefetcher.wait_for('a',3),IOError)
+        self.assertIsNone(prefetcher.wait_for('a',3))   # Reported once
+        self.assertEqual(prefetcher.errors,{})
+        prefetcher.stop()
+
+    def test_quota(self):
+        files=[make_file(self.root,"%d.nc" % i,b'x'*10) for i in range(4)]
+        scratch.set_quota(25,root=self.root)
+        scratch.register_file(files[0],root=self.root)
+        scratch.register_file(files[1],root=self.root)
+        index=make_file(self.root,'1.nc.index.json')
+        scratch.add_companion(files[1],index,root=self.root)
+        scratch.pin(files[0],root=self.root)
+        # Over quota - oldest not pinned goes (with its index)
+        scratch.register_file(files[2],root=self.root)
+        self.assertEqual([os.path.exists(f) for f in files],
+                         [True,False,True,True])
+        self.assertFalse(os.path.exists(index))
+        self.assertEqual(scratch.get_usage(self.root),
+                         {'bytes':20,'files':2})
+        # Once unpinned, it can go
+        scratch.unpin(files[0],root=self.root)
+        scratch.register_file(files[3],root=self.root)
+        self.assertFalse(os.path.exists(files[0]))
+        self.assertTrue(os.path.exists(files[2]))
+        # Cost-aware: slow-to-fetch files are kept longer
+        slow=make_file(self.root,'slow.nc',b'x'*10)
+        scratch.set_quota(None,root=self.root)
+        scratch.register_file(slow,fetch_seconds=10,root=self.root)
+        scratch.register_file(files[3],root=self.root)
+        scratch.set_quota(10,policy='cost',root=self.root)
+        self.assertEqual(scratch.enforce_quota(root=self.root),
+                         [files[2],files[3]])
+        self.assertTrue(os.path.exists(slow))
+
+    def test_note_access_no_database(self):
+        # Can't open the database - the use just isn't recorded
+        os.mkdir(scratch.get_quota_db_name(self.root))
+        scratch.note_access(make_file(self.root,'a.nc'),root=self.root)
+
+if __name__ == '__main__':
+    unittest.main()
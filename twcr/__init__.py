@@ -17,3 +17,11 @@ A package for handling data from the 20th Century Reanalysis.
 
 from load import *
 from fetch import *
+from obs_index import *
+from store import *
+from extract import *
+from anomaly import *
+from stats import *
+from derived import *
+from prefetch import *
+from rechunk import *
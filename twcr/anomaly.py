@@ -0,0 +1,136 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Anomalies and standardised anomalies of 20CR data, with respect
+to the 20CR normals and standard deviations.
+
+The climatology files (which have 1981 dates) are each read once,
+and kept in memory indexed by (month,day,hour). Version 2 has one
+file for the year, version 3 one for each month.
+"""
+
+import os
+from scratch.lazy import iris
+from scratch.lazy import numpy as np
+
+from scratch.cache import ByteLRUCache
+from .load import get_data_file_name
+from .load import get_slices_for_range
+from .load import subset_cube
+
+# Climatologies read - keyed on file name, modification time and region
+climatology_cache=ByteLRUCache(max_bytes=2**30)
+
+def get_climatology(variable,version,type='normal',region=None,month=1):
+    """Get the normals (or standard deviations) for a variable - for
+       version 3, those for 'month'.
+
+       Returns a tuple (cube,index): the cube contains all the times
+       in the climatology file, and index maps (month,day,hour) to
+       the position along the time dimension."""
+    if type != 'normal' and type != 'standard.deviation':
+        raise StandardError("Unsupported climatology type %s" % type)
+    file_name=get_data_file_name(variable,1981,month,1,0,version,type)
+    key=(file_name,os.path.getmtime(file_name),str(region))
+    climatology=climatology_cache.get(key)
+    if climatology is None:
+        cube=subset_cube(iris.load_cube(file_name),region=region)
+        time_coord=cube.coord('time')
+        index={}
+        for idx,ct in enumerate(time_coord.units.num2date(
+                                                time_coord.points)):
+            index[(ct.month,ct.day,ct.hour)]=idx
+        climatology=(cube,index)
+        climatology_cache.put(key,climatology,cube.data.nbytes)
+    return climatology
+
+def get_climatology_for_times(climatology,times):
+    """Positions, along the time dimension of the climatology,
+       matching each of a list of times."""
+    cube,index=climatology
+    positions=[]
+    for ct in times:
+        day=ct.day
+        if ct.month==2 and day==29:
+            day=28   # Climatology is for 1981
+        try:
+            positions.append(index[(ct.month,day,ct.hour)])
+        except KeyError:
+            raise StandardError("No climatology for %02d-%02d:%02d" %
+                                (ct.month,day,ct.hour))
+    return np.array(positions)
+
+def align_climatology(climatology,cube):
+    """The climatology for each time in the cube, as an array
+       that can be broadcast against the cube's data."""
+    clim_cube=climatology[0]
+    names=('time','latitude','longitude')
+    clim_dims=[clim_cube.coord_dims(name)[0] for name in names]
+    cube_dims=[cube.coord_dims(name)[0] for name in names]
+    # Put the climatology dimensions in the same order as the cube's
+    order=[clim_dims[i] for i in np.argsort(cube_dims)]
+    data=np.transpose(clim_cube.data,order)
+    time_coord=cube.coord('time')
+    positions=get_climatology_for_times(climatology,
+                   time_coord.units.num2date(time_coord.points))
+    time_axis=sorted(cube_dims).index(cube_dims[0])
+    data=np.take(data,positions,axis=time_axis)
+    # Add length-1 dimensions for any others (ensemble member)
+    for dim in range(cube.ndim):
+        if dim not in cube_dims:
+            data=np.expand_dims(data,dim)
+    return data
+
+def get_climatology_for_cube(variable,version,type,cube,region=None):
+    """The climatology for each time in the cube (see
+       align_climatology) - from each month's file, for version 3."""
+    if version[0]!='4':
+        return align_climatology(get_climatology(variable,version,type,
+                                                 region),cube)
+    time_coord=cube.coord('time')
+    months=np.array([ct.month for ct in
+                     time_coord.units.num2date(time_coord.points)])
+    time_dim=cube.coord_dims(time_coord)[0]
+    aligned=None
+    for month in sorted(set(months)):
+        keys=[slice(None)]*cube.ndim
+        keys[time_dim]=np.where(months==month)[0]
+        part=align_climatology(get_climatology(variable,version,type,
+                                               region,month),
+                               cube[tuple(keys)])
+        if aligned is None:
+            shape=list(part.shape)
+            shape[time_dim]=len(months)
+            aligned=np.empty(shape,dtype=part.dtype)
+        aligned[tuple(keys)]=part
+    return aligned
+
+def get_anomalies(variable,start,end,version,type='ensemble',
+                  standardise=False,member=None,region=None):
+    """Get a cube of anomalies, for all the data timesteps between
+       start and end (start<=time<end).
+
+       If 'standardise' is True, the anomalies are divided by the
+       standard deviation (so have units of '1'). The climatologies
+       are read once (and cached) and the anomalies for all the times
+       are calculated together."""
+    cube=get_slices_for_range(variable,start,end,version,type,
+                              member,region)
+    anomalies=cube.copy(data=cube.data-get_climatology_for_cube(
+                  variable,version,'normal',cube,region))
+    if standardise:
+        anomalies.data/=get_climatology_for_cube(variable,version,
+                                                 'standard.deviation',
+                                                 cube,region)
+        anomalies.units='1'
+    return anomalies
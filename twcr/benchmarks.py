@@ -0,0 +1,175 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Timing benchmarks for the twcr module.
+
+Run python on this file to run all the benchmarks.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import numpy
+import pandas
+
+import twcr
+
+def make_synthetic_obs_file(file_name,format,n_obs,seed=0):
+    """Write a file of random observations, in the layout
+       of the 20CR 'v2' or 'v3' feedback files."""
+    layout=twcr.Obs_formats[format]
+    colspecs=layout['colspecs']
+    rng=random.Random(seed)
+    line_length=max(c[1] for c in colspecs)
+    with open(file_name,'w') as f:
+        for i in range(n_obs):
+            line=[' ']*line_length
+            for idx,name in enumerate(layout['names']):
+                start,end=colspecs[idx]
+                if idx+1<len(colspecs):
+                    # Some fields overlap - keep out of the next one
+                    end=min(end,colspecs[idx+1][0])
+                width=end-start
+                converter=layout['converters'][name]
+                field=random_field(rng,converter,max(1,width-1))
+                if converter is str:
+                    field=field.ljust(width)
+                else:
+                    field=field.rjust(width)
+                line[start:end]=list(field[:width])
+            f.write(''.join(line).rstrip()+'\n')
+
+def random_field(rng,converter,width):
+    """A random value as a string of at most 'width' characters:
+       occasionally missing."""
+    if rng.random()<0.1:
+        missing=[v for v in twcr.Obs_na_values if len(v)<=width]
+        if len(missing)>0:
+            return rng.choice(missing)
+    if converter is int:
+        return str(rng.randint(0,10**width-1))
+    if converter is float:
+        if width<4:
+            return str(rng.randint(0,10**width-1))
+        return ('%%.%df' % min(3,width-3)) % rng.uniform(-9,9)
+    return ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
+                   for i in range(rng.randint(1,width)))
+
+def frames_match(a,b):
+    """Do two observations DataFrames contain the same data?"""
+    if list(a.columns)!=list(b.columns) or len(a)!=len(b):
+        return False
+    for name in a.columns:
+        missing=pandas.isnull(a[name]).values
+        if (missing!=pandas.isnull(b[name]).values).any():
+            return False
+        va=a[name].values[~missing]
+        vb=b[name].values[~missing]
+        try:
+            if not numpy.allclose(va.astype(float),vb.astype(float)):
+                return False
+        except (ValueError,TypeError):
+            if (va!=vb).any():
+                return False
+    return True
+
+def benchmark_obs_parser(n_obs=20000,repeats=3):
+    """Compare the 'pandas' and 'numpy' obs file parsers."""
+    tmp_dir=tempfile.mkdtemp()
+    try:
+        for format in ('v2','v3'):
+            file_name=os.path.join(tmp_dir,'obs.%s.txt' % format)
+            make_synthetic_obs_file(file_name,format,n_obs)
+            timings={}
+            for engine in ('pandas','numpy'):
+                start=time.time()
+                for i in range(repeats):
+                    o=twcr.read_obs_file(file_name,format,engine=engine,
+                                        use_sidecar=False)
+                timings[engine]=(time.time()-start)/repeats
+            o_pandas=twcr.read_obs_file(file_name,format,'pandas',
+                                        use_sidecar=False)
+            o_numpy=twcr.read_obs_file(file_name,format,'numpy',
+                                       use_sidecar=False)
+            if not frames_match(o_pandas,o_numpy):
+                raise StandardError("Parsers disagree for %s" % format)
+            print("Obs parser %s, %d obs: pandas %.3fs, numpy %.3fs (x%.1f)" %
+                  (format,n_obs,timings['pandas'],timings['numpy'],
+                   timings['pandas']/timings['numpy']))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def benchmark_obs_sidecar(n_obs=20000,repeats=3):
+    """Compare parsing obs files with reading their binary sidecars."""
+    # Sidecars are only made on $SCRATCH
+    tmp_dir=tempfile.mkdtemp(dir=os.environ['SCRATCH'])
+    try:
+        file_name=os.path.join(tmp_dir,'obs.v2.txt')
+        make_synthetic_obs_file(file_name,'v2',n_obs)
+        twcr.read_obs_file(file_name,'v2','numpy')   # Make the sidecar
+        timings={}
+        for label,columns in (('all columns',None),
+                              ('4 columns',['Longitude','Latitude',
+                                            'SLP','Assimilation.indicator'])):
+            start=time.time()
+            for i in range(repeats):
+                o=twcr.read_obs_file(file_name,'v2','numpy',columns=columns)
+            timings[label]=(time.time()-start)/repeats
+        start=time.time()
+        for i in range(repeats):
+            o=twcr.read_obs_file(file_name,'v2','numpy',use_sidecar=False)
+        print("Obs sidecar, %d obs: parse %.3fs, sidecar %.3fs, "
+              "sidecar 4 columns %.3fs" %
+              (n_obs,(time.time()-start)/repeats,timings['all columns'],
+               timings['4 columns']))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+# Modules which should not be imported just by importing a package
+Heavy_modules=('iris','numpy','pandas','matplotlib')
+
+def time_import(package):
+    """Import a package in a new interpreter.
+
+       Returns (seconds,heavy) - heavy is the list of Heavy_modules
+       that got imported along with it."""
+    code=("import sys,time; start=time.time(); import %s; "
+          "print(time.time()-start); "
+          "print(','.join(m for m in %r if m in sys.modules))" %
+          (package,Heavy_modules))
+    package_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output=subprocess.check_output([sys.executable,'-c',code],
+                                   cwd=package_dir).decode().split('\n')
+    return (float(output[0]),[m for m in output[1].split(',') if m!=''])
+
+def benchmark_import(packages=('twcr','mopd','pbcu'),repeats=3):
+    """Time importing each package in a new interpreter."""
+    for package in packages:
+        try:
+            timings=[time_import(package) for i in range(repeats)]
+        except subprocess.CalledProcessError:
+            print("Import %s: failed" % package)
+            continue
+        print("Import %s: %.3fs, heavy modules imported: %s" %
+              (package,min(t[0] for t in timings),
+               ','.join(timings[0][1]) or 'none'))
+
+if __name__ == '__main__':
+    benchmark_import()
+    benchmark_obs_parser()
+    benchmark_obs_sidecar()
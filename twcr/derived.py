@@ -0,0 +1,132 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Ensemble mean and spread files for version 3, made locally.
+
+There are no means or spreads on NERSC $SCRATCH for version 3, so
+they are calculated from the ensemble files, and saved where
+get_data_file_name expects them. After that they load like any
+other mean or spread.
+"""
+
+import os
+import multiprocessing
+from scratch.lazy import iris
+from scratch.lazy import numpy as np
+
+from .load import get_data_file_name
+from .load import get_member_dim
+from .load import iter_data_blocks
+
+Derived_types=('mean','spread')
+
+def is_derived(version,type):
+    """True if files of this type are made locally from the ensemble."""
+    return version[0]=='4' and type in Derived_types
+
+def is_derived_current(variable,year,month,version,type):
+    """True if the mean or spread file for a month exists, and is
+       newer than the ensemble file it was made from."""
+    file_name=get_data_file_name(variable,year,month,1,0,version,type)
+    ensemble_file=get_data_file_name(variable,year,month,1,0,
+                                     version,'ensemble')
+    if not os.path.isfile(file_name):
+        return False
+    if not os.path.isfile(ensemble_file):
+        return True   # Nothing to remake it from
+    return os.path.getmtime(file_name)>=os.path.getmtime(ensemble_file)
+
+def make_mean_and_spread(variable,year,month,version,block_size=8):
+    """Make the mean and spread files for a month from the
+       ensemble file.
+
+       The ensemble is read 'block_size' timesteps at a time, so
+       only a few fields of every member are in memory at once."""
+    ensemble_file=get_data_file_name(variable,year,month,1,0,
+                                     version,'ensemble')
+    if not os.path.isfile(ensemble_file):
+        raise IOError("No ensemble data for %s %04d-%02d" %
+                      (variable,year,month))
+    cube=iris.load_cube(ensemble_file)
+    member_dim=get_member_dim(cube)
+    member_names=[c.name() for c in cube.coords(dimensions=member_dim)]
+    # Metadata for the results - the ensemble without the member dimension
+    keys=[slice(None)]*cube.ndim
+    keys[member_dim]=0
+    template=cube[tuple(keys)]
+    for name in member_names:
+        template.remove_coord(name)
+    n_time=cube.shape[cube.coord_dims('time')[0]]
+    shape=(n_time,cube.shape[cube.coord_dims('latitude')[0]],
+           cube.shape[cube.coord_dims('longitude')[0]])
+    mean=np.empty(shape,dtype=cube.dtype)
+    spread=np.empty(shape,dtype=cube.dtype)
+    for first,last,block in iter_data_blocks(cube,block_size):
+        mean[first:last]=np.mean(block,axis=1)
+        spread[first:last]=np.std(block,axis=1,ddof=1)
+    # Back into the dimension order of the ensemble file
+    dims=[template.coord_dims(name)[0] for name in ('time','latitude',
+                                                    'longitude')]
+    order=np.argsort(dims)
+    for type,data,method in (('mean',mean,'mean'),
+                             ('spread',spread,'standard_deviation')):
+        derived=template.copy(data=np.transpose(data,order))
+        if len(member_names)>0:
+            derived.add_cell_method(iris.coords.CellMethod(method,
+                                                coords=member_names[0]))
+        save_derived(derived,get_data_file_name(variable,year,month,1,0,
+                                                version,type))
+
+def save_derived(cube,file_name):
+    """Save a cube to netCDF - via a temporary file, so no-one
+       sees a partly-written file."""
+    dir_name=os.path.dirname(file_name)
+    if not os.path.isdir(dir_name):
+        try:
+            os.makedirs(dir_name)
+        except OSError:
+            pass   # Made by another process meanwhile
+    tmp_file="%s.%d.tmp" % (file_name,os.getpid())
+    iris.save(cube,tmp_file,saver='nc')
+    os.rename(tmp_file,file_name)
+
+def make_derived_if_needed(variable,year,month,version,type):
+    """Make the mean and spread files for a month, unless they are
+       already there and up to date."""
+    if not is_derived(version,type):
+        return
+    if not is_derived_current(variable,year,month,version,type):
+        make_mean_and_spread(variable,year,month,version)
+
+def _make_derived_if_needed(args):
+    # Pool.map takes one argument
+    return make_derived_if_needed(*args)
+
+def make_derived_for_year(variable,year,version,processes=4):
+    """Make the mean and spread files for every month of a year
+       that has ensemble data - one month per process.
+
+       Returns the list of months done."""
+    if version[0]!='4':
+        raise StandardError("Means and spreads are only made for version 3")
+    months=[month for month in range(1,13) if os.path.isfile(
+               get_data_file_name(variable,year,month,1,0,
+                                  version,'ensemble'))]
+    pool=multiprocessing.Pool(processes)
+    try:
+        pool.map(_make_derived_if_needed,
+                 [(variable,year,month,version,'mean') for month in months])
+    finally:
+        pool.close()
+        pool.join()
+    return months
@@ -0,0 +1,77 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Extract 20CR data at a set of points (e.g. station locations).
+"""
+
+from scratch.lazy import numpy as np
+
+from .load import get_slices_for_range
+from .load import iter_data_blocks
+
+def get_bilinear_weights(grid_lats,grid_lons,lats,lons):
+    """Weights for bilinear interpolation from a regular global
+       lat:lon grid to a set of points.
+
+       Returns (indices,weights) - both (4,n_points). The indices are
+       into the flattened (lat,lon) field, so the interpolated values
+       are (field.ravel()[indices]*weights).sum(axis=0)."""
+    grid_lats=np.asarray(grid_lats,dtype=np.float64)
+    grid_lons=np.asarray(grid_lons,dtype=np.float64)
+    lats=np.asarray(lats,dtype=np.float64)
+    lons=np.asarray(lons,dtype=np.float64)
+    n_lat=len(grid_lats)
+    n_lon=len(grid_lons)
+    # Latitude - grid may run north to south
+    flip=grid_lats[0]>grid_lats[-1]
+    ascending=grid_lats[::-1] if flip else grid_lats
+    lat=np.clip(lats,ascending[0],ascending[-1])
+    j0=np.clip(np.searchsorted(ascending,lat,side='right')-1,0,n_lat-2)
+    wy=(lat-ascending[j0])/(ascending[j0+1]-ascending[j0])
+    j1=j0+1
+    if flip:
+        j0,j1=n_lat-1-j0,n_lat-1-j1
+    # Longitude - periodic
+    spacing=(grid_lons[-1]-grid_lons[0])/(n_lon-1)
+    position=((lons-grid_lons[0])%360)/spacing
+    i0=np.floor(position).astype(np.int64)%n_lon
+    wx=position-np.floor(position)
+    i1=(i0+1)%n_lon
+    indices=np.array([j0*n_lon+i0,j0*n_lon+i1,
+                      j1*n_lon+i0,j1*n_lon+i1])
+    weights=np.array([(1-wy)*(1-wx),(1-wy)*wx,
+                      wy*(1-wx),wy*wx])
+    return (indices,weights)
+
+def extract_points(variable,lats,lons,start,end,version,
+                   type='ensemble',block_size=8):
+    """Get the data at a set of points, for all the data timesteps
+       between start and end (start<=time<end), by bilinear
+       interpolation.
+
+       Returns an array (time,member,point). The interpolation weights
+       are calculated once, and the data are read 'block_size'
+       timesteps at a time, so at most one block of global fields is
+       held in memory."""
+    span=get_slices_for_range(variable,start,end,version,type)
+    indices,weights=get_bilinear_weights(span.coord('latitude').points,
+                                         span.coord('longitude').points,
+                                         lats,lons)
+    result=None
+    for first,last,block in iter_data_blocks(span,block_size):
+        if result is None:
+            result=np.empty((span.shape[span.coord_dims('time')[0]],
+                             block.shape[1],indices.shape[1]))
+        block=block.reshape(block.shape[:2]+(-1,))
+        result[first:last]=(block[:,:,indices]*weights).sum(axis=2)
+    return result
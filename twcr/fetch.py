@@ -19,9 +19,32 @@ at NERSC - it will only work for Philip.
 """
 
 import os
+import time
+import fcntl
+import tempfile
+import functools
+import collections
+import threading
 import subprocess
+import multiprocessing.pool
 
 from . import get_data_file_name
+from . import get_data_dir
+from . import get_field_times
+from . import get_obs_file_times
+from .derived import is_derived
+from .derived import is_derived_current
+from .derived import make_derived_if_needed
+from .rechunk import rechunk_if_needed
+from scratch.catalogue import get_catalogue
+from scratch.manifest import get_partial_name
+from scratch.manifest import install_file
+from scratch.manifest import is_good_file
+from scratch.manifest import is_verified
+from scratch.manifest import is_verified_contents
+from scratch.manifest import record_verified
+from scratch.manifest import record_verified_contents
+from scratch.quota import register_file
 
 def get_remote_file_name(variable,year,month,version,type,source=None):
 
@@ -193,10 +216,13 @@ def get_remote_file_name_released(variable,year,month,version,type):
     return(remote_file)
 
 
-def fetch_data_for_month(variable,year,month,
-                         version,type='ensemble',source=None):
-    """Version 3 specific - for version 2 use fetch_data_for_year."""
-    
+def get_fetch_job(variable,year,month,version,type='ensemble',source=None):
+    """What has to be copied to get the data for a month (or year,
+       for version 2).
+
+       Returns a dict of the 'remote' and 'local' file (or directory,
+       if 'recursive'), and the 'host' - or None if the data is
+       already on disc."""
     if(version[0]!='4' and month is not None):
         raise StandardError("Use 'fetch_data_for_year' for version 2")
     if(month is None):
@@ -204,41 +230,561 @@ def fetch_data_for_month(variable,year,month,
     # Day and hour also set arbtrarily to 1 and 6
     local_file=get_data_file_name(variable,year,month,1,6,version,type)
 
-    if ((variable != 'observations') and os.path.isfile(local_file)): 
+    if ((variable != 'observations') and is_good_file(local_file)): 
         # Got this data already
-        return
-
-    if not os.path.exists(os.path.dirname(local_file)):
-        os.makedirs(os.path.dirname(local_file))
+        return None
 
     remote_file=get_remote_file_name(variable,year,month,version,type,source)
-
+    recursive=False
     if(variable=='observations'):
-        # Multiple files - use rsync
+        # Multiple files - copy the directory
         local_file=os.path.dirname(local_file)
-        cmd="rsync -Lr %s/ %s" % (remote_file,local_file)
-        #print(cmd)
-        scp_retvalue=subprocess.call(cmd,shell=True) # Why need shell=True?
-        if scp_retvalue==3:
-            raise StandardError("Remote data not available")
-        if scp_retvalue!=0:
-            raise StandardError("Failed to retrieve data")
-        
+        recursive=True
+        if is_verified_contents(local_file):
+            # Complete as of the last listing (see sync_obs)
+            return None
+    return {'remote':remote_file,'local':local_file,
+            'recursive':recursive,'host':get_remote_host(remote_file),
+            'root':get_data_dir(version)}
+
+def get_remote_host(remote_file):
+    """The host part of a remote file name ('user@host:path')."""
+    if ':' not in remote_file:
+        return None
+    return remote_file.split(':',1)[0].split('@')[-1]
+
+# Extra ssh options for scp and rsync (see set_ssh_multiplexing)
+ssh_options=''
+
+def set_ssh_multiplexing(on=True,persist=600):
+    """Make scp and rsync share one ssh connection to each host
+       (ssh ControlMaster), instead of logging in again for each
+       copy. The connection stays open for 'persist' seconds after
+       its last use."""
+    global ssh_options
+    if on:
+        ssh_options=("-o ControlMaster=auto "+
+                     "-o ControlPath=~/.ssh/twcr-%%r@%%h:%%p "+
+                     "-o ControlPersist=%d") % persist
+    else:
+        ssh_options=''
+
+def get_rsync_options():
+    """rsync options to use the ssh_options."""
+    if ssh_options=='':
+        return ''
+    return "-e 'ssh %s'" % ssh_options
+
+def run_transfer(remote_file,local_file,recursive=False,bwlimit=None):
+    """Copy a file from NERSC, or, if 'recursive', a directory.
+       Uses rsync, so an interrupted copy of a file is resumed by
+       the next try. 'bwlimit' is a bandwidth limit (KB/s).
+       Returns the exit status."""
+    options=get_rsync_options()
+    if bwlimit is not None:
+        options="%s --bwlimit=%d" % (options,bwlimit)
+    if recursive:
+        cmd="rsync -Lr %s %s/ %s" % (options,remote_file,local_file)
     else:
-        # Single file - use scp
-        cmd="scp %s %s" % (remote_file,local_file)
+        cmd="rsync -L --partial --append-verify %s %s %s" % (
+                                          options,remote_file,local_file)
+    #print(cmd)
+    return subprocess.call(cmd,shell=True) # Why need shell=True?
+
+def split_remote_name(remote_file):
+    """Split 'user@host:path' into ('user@host:','path')."""
+    if ':' not in remote_file:
+        return ('',remote_file)
+    source,path=remote_file.split(':',1)
+    return (source+':',path)
+
+def run_batch_transfer(source,paths,staging_dir,append=True):
+    """Copy many files (or directories) from one host with a single
+       rsync. 'source' is 'user@host:' and 'paths' the full remote
+       paths - each is copied to the same path under 'staging_dir'.
+
+       If 'append', a file already there is an interrupted copy, and
+       only the rest of it is copied. Otherwise files already there
+       may have changed (even shrunk), so are brought up to date, and
+       modification times are kept, so later changes can be spotted
+       (see sync_obs). Returns the exit status of rsync."""
+    # List of files - one for each process, so they don't collide
+    fd,list_file=tempfile.mkstemp(prefix='.files.',dir=staging_dir)
+    try:
+        with os.fdopen(fd,'w') as f:
+            for path in paths:
+                f.write("%s\n" % path.strip('/'))
+        options="--partial --append-verify" if append else "-t --partial"
+        cmd="rsync -Lr %s %s --files-from=%s %s/ %s" % (options,
+                                          get_rsync_options(),list_file,
+                                          source,staging_dir)
         #print(cmd)
-        scp_retvalue=subprocess.call(cmd,shell=True)
-        if scp_retvalue==6:
-            raise StandardError("Remote data not available")
-        if scp_retvalue!=0:
-            raise StandardError("Failed to retrieve data")
+        return subprocess.call(cmd,shell=True)
+    finally:
+        os.remove(list_file)
+
+def is_unavailable(status,recursive=False):
+    """True if a transfer exit status means the remote data isn't
+       there (no point trying again)."""
+    if recursive:
+        return status==3
+    return status==23
+
+def check_transfer_status(status,recursive=False):
+    """Raise an exception if a transfer failed."""
+    if is_unavailable(status,recursive):
+        raise StandardError("Remote data not available")
+    if status!=0:
+        raise StandardError("Failed to retrieve data")
+
+def run_fetch_job(job,transfer=None):
+    """Do the copy for a job from get_fetch_job - returns the
+       exit status of the transfer.
+
+       A file is copied to a '.part' name, checked, and then renamed
+       into place (so a failed copy never leaves a bad file with the
+       real name). IOError if the copied file is bad."""
+    if transfer is None:
+        transfer=run_transfer
+    local_dir=job['local'] if job['recursive'] else os.path.dirname(
+                                                             job['local'])
+    if not os.path.exists(local_dir):
+        try:
+            os.makedirs(local_dir)
+        except OSError:
+            pass   # Made by another thread meanwhile
+    if job['recursive']:
+        return transfer(job['remote'],job['local'],True)
+    partial=get_partial_name(job['local'])
+    start=time.time()
+    status=transfer(job['remote'],partial,False)
+    if status==0:
+        install_file(partial,job['local'])
+        register_file(job['local'],time.time()-start)
+    return status
+
+def fetch_data_for_month(variable,year,month,
+                         version,type='ensemble',source=None,
+                         transfer=None):
+    """Version 3 specific - for version 2 use fetch_data_for_year.
+
+       'transfer' is the function that does the copy (default
+       run_transfer)."""
+    if is_derived(version,type):
+        if is_derived_current(variable,year,month,version,type):
+            return
+        # No v3 means or spreads at NERSC - make them from the ensemble
+        fetch_data_for_month(variable,year,month,version,'ensemble',source,
+                             transfer)
+        make_derived_if_needed(variable,year,month,version,type)
+        return
+    job=get_fetch_job(variable,year,month,version,type,source)
+    if job is None:
+        return
+    if job['recursive']:
+        # Observations - only copy the files not already here
+        check_transfer_status(sync_obs(job),True)
+        return
+    check_transfer_status(run_fetch_job(job,transfer),job['recursive'])
 
 def fetch_data_for_year(variable,year,
-                         version,type='ensemble',source=None):
-    """Version 2 series specific - for version 3 use fetch_data_for_month."""
+                         version,type='ensemble',source=None,
+                         rechunk=False):
+    """Version 2 series specific - for version 3 use fetch_data_for_month.
+
+       If 'rechunk', the file is then rewritten for fast reads of
+       one time (see rechunk.rechunk_file - needs netCDF4)."""
     if(version[0]=='4'):
         raise StandardError("Use 'fetch_data_for_month' for version 3")
     
-    return fetch_data_for_month(variable,year,None,
+    fetch_data_for_month(variable,year,None,
                          version,type,source)
+    if rechunk and variable!='observations':
+        rechunk_if_needed(get_data_file_name(variable,year,1,1,6,
+                                             version,type))
+
+def fetch_obs_for_cycle(year,month,day,hour,version,source=None):
+    """Make sure the observations file for one assimilation run is
+       on disc. If the manifest has it, there's no remote access at
+       all - otherwise the month's (year's for version 2) directory
+       is synchronised (see sync_obs)."""
+    if is_verified(get_data_file_name('observations',year,month,day,hour,
+                                      version)):
+        return
+    if version[0]!='4':
+        month=None
+    fetch_data_for_month('observations',year,month,version,source=source)
+
+def list_remote_dir(remote_dir):
+    """The files in a remote directory (and its subdirectories) -
+       returns (rsync exit status,{relative name: (size,mtime)})."""
+    cmd="rsync -rL --list-only %s %s/" % (get_rsync_options(),remote_dir)
+    proc=subprocess.Popen(cmd,shell=True,stdout=subprocess.PIPE)
+    output=proc.communicate()[0].decode('utf-8','replace')
+    return (proc.returncode,parse_rsync_listing(output))
+
+def parse_rsync_listing(output):
+    """Files (not directories) in rsync --list-only output -
+       {name: (size,mtime)}. rsync lists times (to the second) in
+       local time."""
+    files={}
+    for line in output.splitlines():
+        fields=line.split(None,4)
+        if len(fields)<5 or not fields[0].startswith('-'):
+            continue
+        mtime=time.mktime(time.strptime("%s %s" % (fields[2],fields[3]),
+                                        "%Y/%m/%d %H:%M:%S"))
+        files[fields[4]]=(int(fields[1].replace(',','')),mtime)
+    return files
+
+def is_as_listed(local_file,size,mtime):
+    """True if a file is here with the size and modification time
+       (to the second) from a remote listing."""
+    try:
+        st=os.stat(local_file)
+    except OSError:
+        return False
+    return st.st_size==size and abs(st.st_mtime-mtime)<1
+
+def get_obs_to_sync(local_dir,listing):
+    """The files in a remote listing that aren't here, or are a
+       different size or modification time here (changed, or not
+       completely copied). Files already here as listed are added to
+       the manifest (if they aren't in it already)."""
+    needed=[]
+    for name,(size,mtime) in sorted(listing.items()):
+        local_file=os.path.join(local_dir,name)
+        if is_as_listed(local_file,size,mtime):
+            if not is_verified(local_file):
+                record_verified(local_file)
+            continue
+        needed.append(name)
+    return needed
+
+def sync_obs(job,list_remote=None,batch_transfer=None):
+    """Bring a local observations directory (a recursive job from
+       get_fetch_job) up to date - listing the remote directory, and
+       copying only the files that are missing or changed, in one
+       transfer. Each file copied is added to the manifest, and once
+       all the listed files are here, the directory is too, with the
+       files it holds - get_fetch_job won't look at it again unless
+       one of them changes (see scratch.manifest.is_verified_contents).
+       Runs missing from the remote directory don't stop it being
+       complete.
+
+       'list_remote' and 'batch_transfer' do the remote access
+       (default list_remote_dir and run_batch_transfer). Returns an
+       exit status, as for a directory copy with run_transfer."""
+    if list_remote is None:
+        list_remote=list_remote_dir
+    if batch_transfer is None:
+        batch_transfer=run_batch_transfer
+    status,listing=list_remote(job['remote'])
+    if status==23:
+        return 3   # No remote directory - as rsync -r reports it
+    if status!=0:
+        return status
+    local_dir=job['local']
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    needed=get_obs_to_sync(local_dir,listing)
+    if len(needed)>0:
+        start=time.time()
+        # Replacing changed files, not appending to them
+        status=batch_transfer(job['remote'].rstrip('/'),needed,local_dir,
+                              False)
+        for name in needed:
+            local_file=os.path.join(local_dir,name)
+            if is_as_listed(local_file,*listing[name]):
+                record_verified(local_file)
+        if status!=0:
+            return status
+        print("Copied %d observations files to %s in %.1fs" %
+              (len(needed),local_dir,time.time()-start))
+    if len(get_obs_to_sync(local_dir,listing))==0:
+        record_verified_contents(local_dir,listing.keys())
+    return 0
+
+def get_local_size(local_file):
+    """Bytes on disc in a file, or in all the files in a directory."""
+    if os.path.isfile(local_file):
+        return os.path.getsize(local_file)
+    total=0
+    for dir_name,dirs,files in os.walk(local_file):
+        for name in files:
+            try:
+                total+=os.path.getsize(os.path.join(dir_name,name))
+            except OSError:
+                pass
+    return total
+
+def fetch_with_retries(job,transfer,host_limits,retries=3,backoff=5.0):
+    """Do a fetch job, trying again (after backoff, 2*backoff, ...
+       seconds) if it fails. Returns a result dict (see fetch_many)."""
+    result={'job':job,'attempts':0,'error':None,'bytes':0}
+    start=time.time()
+    while True:
+        result['attempts']+=1
+        with host_limits[job['host']]:
+            try:
+                status=run_fetch_job(job,transfer)
+            except (OSError,IOError) as e:
+                status=None
+                result['error']=str(e)
+        if status==0:
+            result['status']='done'
+            result['error']=None
+            result['bytes']=get_local_size(job['local'])
+            break
+        if status is not None and is_unavailable(status,job['recursive']):
+            result['status']='unavailable'
+            result['error']="Remote data not available"
+            break
+        if status is not None:
+            result['error']="Failed to retrieve data (status %d)" % status
+        if result['attempts']>retries:
+            result['status']='failed'
+            break
+        time.sleep(backoff*2**(result['attempts']-1))
+    result['seconds']=time.time()-start
+    return result
+
+def fetch_many(requests,workers=4,per_host=2,retries=3,backoff=5.0,
+               transfer=None,progress=True):
+    """Fetch the data for many months (or years) at once.
+
+       'requests' is a list of argument tuples for fetch_data_for_month:
+       (variable,year,month,version[,type[,source]]). Data already on
+       disc, and duplicate requests, are skipped. Up to 'workers'
+       copies run at once, but no more than 'per_host' from any one
+       host. Failed copies are tried again up to 'retries' times.
+       'transfer' is the function that does each copy (default
+       run_transfer). If 'progress', each copy is reported as it
+       finishes, and the overall throughput at the end.
+
+       Returns a list of results, one for each copy: dicts with the
+       'job' (see get_fetch_job), 'status' ('done', 'unavailable' or
+       'failed'), 'error', 'attempts', 'seconds' and 'bytes'."""
+    if transfer is None:
+        transfer=run_transfer
+    jobs,derived=get_fetch_jobs(requests)
+    host_limits={}
+    for job in jobs:
+        if job['host'] not in host_limits:
+            host_limits[job['host']]=threading.BoundedSemaphore(per_host)
+    results=[]
+    start=time.time()
+    if len(jobs)>0:
+        pool=multiprocessing.pool.ThreadPool(min(workers,len(jobs)))
+        try:
+            for result in pool.imap_unordered(functools.partial(
+                                     fetch_with_retries,transfer=transfer,
+                                     host_limits=host_limits,
+                                     retries=retries,backoff=backoff),jobs):
+                results.append(result)
+                if progress:
+                    print("[%d/%d] %s %s (%.1f MB in %.1fs)" %
+                          (len(results),len(jobs),result['status'],
+                           result['job']['local'],result['bytes']/1.0e6,
+                           result['seconds']))
+        finally:
+            pool.close()
+            pool.join()
+    if progress:
+        report_fetch_summary(results,start)
+    make_derived_after_fetch(derived)
+    return results
+
+def fetch_batched(requests,transfer=None,progress=True):
+    """Fetch the data for many months (or years) with one transfer
+       for everything from each host (instead of one scp per file).
+
+       'requests' are as for fetch_many. 'transfer' is the function
+       that copies each batch (default run_batch_transfer). Returns
+       a list of results as for fetch_many."""
+    if transfer is None:
+        transfer=run_batch_transfer
+    jobs,derived=get_fetch_jobs(requests)
+    batches=collections.OrderedDict()
+    for job in jobs:
+        source=split_remote_name(job['remote'])[0]
+        batches.setdefault((source,job['root']),[]).append(job)
+    results=[]
+    start=time.time()
+    for (source,root),batch in batches.items():
+        batch_results=fetch_batch(source,root,batch,transfer)
+        results.extend(batch_results)
+        if progress:
+            print("%s %d files: %d done, %d not available, %d failed" %
+                  (source,len(batch),
+                   len([r for r in batch_results if r['status']=='done']),
+                   len([r for r in batch_results
+                                    if r['status']=='unavailable']),
+                   len([r for r in batch_results
+                                    if r['status']=='failed'])))
+    if progress:
+        report_fetch_summary(results,start)
+    make_derived_after_fetch(derived)
+    return results
+
+def fetch_batch(source,root,jobs,transfer):
+    """Copy all the files for a set of fetch jobs from one host, in
+       one transfer, into a staging directory (under 'root', so on the
+       same filesystem as the data); then check each file that arrived
+       and move it into place.
+
+       Partly-copied files stay in the staging directory, so the next
+       try carries on from where this one stopped. Only one process at
+       a time uses a staging directory - others wait their turn."""
+    staging_dir=os.path.join(root,'.fetch.%s' % get_remote_host(
+                                               jobs[0]['remote']))
+    if not os.path.isdir(staging_dir):
+        try:
+            os.makedirs(staging_dir)
+        except OSError:
+            # Fine if another process made it meanwhile
+            if not os.path.isdir(staging_dir):
+                raise IOError("Can't make staging directory %s" %
+                              staging_dir)
+    # Kept (not removed with the staging directory) - see remove_empty_dirs
+    lock=open(os.path.join(staging_dir,'.lock'),'a')
+    fcntl.flock(lock,fcntl.LOCK_EX)
+    start=time.time()
+    try:
+        try:
+            status=transfer(source,[split_remote_name(job['remote'])[1]
+                                    for job in jobs],staging_dir)
+        except (OSError,IOError):
+            status=None
+        results=[]
+        for job in jobs:
+            remote_path=split_remote_name(job['remote'])[1]
+            staged=os.path.join(staging_dir,remote_path.strip('/'))
+            result={'job':job,'attempts':1,'error':None,'bytes':0}
+            if not job['recursive'] and os.path.exists(staged):
+                try:
+                    move_into_place(staged,job['local'],
+                                    fetch_seconds=(time.time()-start)/
+                                                  len(jobs))
+                    result['status']='done'
+                    result['bytes']=get_local_size(job['local'])
+                except IOError as e:
+                    result['status']='failed'
+                    result['error']=str(e)
+            elif os.path.exists(staged):
+                move_into_place(staged,job['local'],True)
+                result['bytes']=get_local_size(job['local'])
+                if status!=0:
+                    # Don't know if the directory is complete
+                    result['status']='failed'
+                    result['error']=("Failed to retrieve data (status %s)" %
+                                     status)
+                else:
+                    result['status']='done'
+            elif status in (0,23,24):
+                # rsync worked, apart from missing files
+                result['status']='unavailable'
+                result['error']="Remote data not available"
+            else:
+                result['status']='failed'
+                result['error']=("Failed to retrieve data (status %s)" %
+                                 status)
+            result['seconds']=time.time()-start
+            results.append(result)
+    finally:
+        remove_empty_dirs(staging_dir)
+        lock.close()   # Releases the lock
+    return results
+
+def remove_empty_dirs(dir_name):
+    """Remove the empty directories in a tree."""
+    for sub_dir,dirs,files in os.walk(dir_name,topdown=False):
+        try:
+            os.rmdir(sub_dir)
+        except OSError:
+            pass   # Not empty
+
+def move_into_place(staged,local_file,recursive=False,fetch_seconds=0.0):
+    """Move a file (or the files in a directory) copied to a staging
+       directory to where it belongs. A file is checked first (see
+       scratch.manifest.install_file), and registered with the
+       $SCRATCH quota (scratch.quota)."""
+    if not recursive:
+        if not os.path.isdir(os.path.dirname(local_file)):
+            os.makedirs(os.path.dirname(local_file))
+        install_file(staged,local_file)
+        register_file(local_file,fetch_seconds)
+        return
+    for dir_name,dirs,files in os.walk(staged):
+        target=os.path.normpath(os.path.join(local_file,
+                                        os.path.relpath(dir_name,staged)))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            os.rename(os.path.join(dir_name,name),os.path.join(target,name))
+
+def get_fetch_jobs(requests):
+    """Fetch jobs (see get_fetch_job) for a list of requests (see
+       fetch_many), without duplicates or data already on disc.
+
+       Returns (jobs,derived) - derived is the list of v3 mean and
+       spread requests, to be made once their ensembles are fetched."""
+    jobs=[]
+    seen=set()
+    derived=[]
+    for request in requests:
+        variable,year,month,version=request[:4]
+        type=request[4] if len(request)>4 else 'ensemble'
+        source=request[5] if len(request)>5 else None
+        if is_derived(version,type):
+            # Fetch the ensemble, and make these from it afterwards
+            derived.append((variable,year,month,version,type))
+            type='ensemble'
+        job=get_fetch_job(variable,year,month,version,type,source)
+        if job is None or job['local'] in seen:
+            continue
+        seen.add(job['local'])
+        jobs.append(job)
+    return (jobs,derived)
+
+def make_derived_after_fetch(derived):
+    """Make the v3 means and spreads whose ensembles are now on disc."""
+    for args in derived:
+        if os.path.isfile(get_data_file_name(args[0],args[1],args[2],1,6,
+                                             args[3],'ensemble')):
+            make_derived_if_needed(*args)
+
+def report_fetch_summary(results,start):
+    """Print the overall result and throughput of a set of fetches."""
+    elapsed=max(time.time()-start,1.0e-6)
+    total=sum(r['bytes'] for r in results)
+    print("Fetched %d of %d (%.1f MB) in %.1fs - %.2f MB/s, %d failed" %
+          (len([r for r in results if r['status']=='done']),
+           len(results),total/1.0e6,elapsed,total/1.0e6/elapsed,
+           len([r for r in results if r['status']!='done'])))
+
+def get_missing_files(variable,start,end,version,type='ensemble'):
+    """The local files needed for the data between start and end
+       (start<=time<end) which are not on disc.
+
+       Uses the catalogue of $SCRATCH (see scratch.catalogue), rather
+       than looking for each file - refresh the catalogue
+       (get_catalogue(refresh=True)) to see files added since."""
+    if variable=='observations':
+        times=get_obs_file_times(start,end)
+    else:
+        times=get_field_times(start,end,version)
+    file_names=[]
+    seen=set()
+    for ct in times:
+        file_name=get_data_file_name(variable,ct.year,ct.month,ct.day,
+                                     ct.hour,version,type)
+        if file_name not in seen:
+            seen.add(file_name)
+            file_names.append(file_name)
+    catalogue=get_catalogue()
+    if not os.path.normpath(get_data_dir(version)).startswith(
+                                                  catalogue.root+'/'):
+        # Data not on $SCRATCH - not catalogued
+        return [f for f in file_names if not os.path.isfile(f)]
+    return catalogue.missing(file_names)
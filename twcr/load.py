@@ -17,14 +17,38 @@ The functions in this module provide the main way to load
 
 import os
 import os.path
-import iris
-import iris.time
 import datetime
-import numpy as np
-import pandas
+import collections
+import multiprocessing
 
-# Eliminate incomprehensible warning message
-iris.FUTURE.netcdf_promote='True'
+# iris, numpy and pandas are imported when first used
+from scratch.lazy import iris
+from scratch.lazy import numpy as np
+from scratch.lazy import pandas
+from scratch.quota import note_access as note_file_access
+
+from scratch.cache import ByteLRUCache
+
+# Recently loaded slices - keyed on file name, file modification
+#  time and the time loaded.
+slice_cache=ByteLRUCache(max_bytes=2**30)
+
+def set_slice_cache_size(max_bytes):
+    """Set the memory budget (in bytes) for cached slices.
+       Set to 0 to disable caching."""
+    slice_cache.resize(max_bytes)
+
+def clear_slice_cache(file_name=None):
+    """Discard cached slices - all of them, or only those
+       loaded from the given file."""
+    if file_name is None:
+        slice_cache.invalidate()
+    else:
+        slice_cache.invalidate(lambda key: key[0]==file_name)
+
+def get_slice_cache_stats():
+    """Hits, misses and memory use of the slice cache."""
+    return slice_cache.stats()
 
 def get_data_dir(version):
     """Return the root directory containing 20CR netCDF files"""
@@ -65,14 +89,34 @@ def get_data_file_name(variable,year,month,day=None,hour=None,
         return name
     raise StandardError("Unsupported type %s" % type)
 
+def get_field_step(version):
+    """Hours between stored fields (3 for v3, 6 for v2)."""
+    if version[0]=='4':
+        return 3
+    return 6
+
+def get_field_times(start,end,version):
+    """All the times between start and end (start<=time<end)
+       which are data timesteps (no interpolation needed)."""
+    step=get_field_step(version)
+    ct=datetime.datetime(start.year,start.month,start.day,
+                         int(start.hour/step)*step)
+    if ct<start:
+        ct=ct+datetime.timedelta(hours=step)
+    times=[]
+    while ct<end:
+        times.append(ct)
+        ct=ct+datetime.timedelta(hours=step)
+    return times
+
 def is_in_file(variable,version,hour):
     """Is the variable available for this time?
        Or will it have to be interpolated?"""
     if(version[0]=='4' and hour%3==0):
-        return 'True'
+        return True
     if hour%6==0:
-        return 'True'
-    return 'False'
+        return True
+    return False
 
 def get_previous_field_time(variable,year,month,day,hour,version):
     """Get the latest time, before the given time,
@@ -90,22 +134,101 @@ def get_next_field_time(variable,year,month,day,hour,version):
     if dr['hour']>=24:
         d_next= ( datetime.date(dr['year'],dr['month'],dr['day']) 
                  + datetime.timedelta(1) )
-        dr = {'year':d1.year,'month':d1.month,'day':d1.day,
+        dr = {'year':d_next.year,'month':d_next.month,'day':d_next.day,
               'hour':dr['hour']-24}
     return dr
 
+def get_member_dim(cube):
+    """Which dimension of the cube is the ensemble member."""
+    used=set()
+    for name in ('time','latitude','longitude'):
+        try:
+            used.update(cube.coord_dims(name))
+        except iris.exceptions.CoordinateNotFoundError:
+            pass
+    others=[dim for dim in range(cube.ndim) if dim not in used]
+    if len(others)!=1:
+        raise StandardError("No ensemble member dimension")
+    return others[0]
+
+def subset_cube(cube,member=None,region=None):
+    """Select ensemble members and/or a region from a cube.
+
+       'member' is an index (or list of indices, or slice) along the
+       ensemble member dimension. 'region' is a tuple
+       (lat_min,lat_max,lon_min,lon_max) - the region may cross the
+       0/360 line (e.g. (30,80,340,20)).
+
+       Done by indexing the cube, so for a cube with lazy data only the
+       selected part of the data will be read."""
+    if member is not None:
+        keys=[slice(None)]*cube.ndim
+        keys[get_member_dim(cube)]=member
+        cube=cube[tuple(keys)]
+    if region is not None:
+        lat_min,lat_max,lon_min,lon_max=region
+        lat_coord=cube.coord('latitude')
+        selected=np.where((lat_coord.points>=lat_min) &
+                          (lat_coord.points<=lat_max))[0]
+        if len(selected)==0:
+            raise ValueError("No latitudes in region")
+        keys=[slice(None)]*cube.ndim
+        keys[cube.coord_dims(lat_coord)[0]]=slice(selected.min(),
+                                                  selected.max()+1)
+        cube=cube[tuple(keys)]
+        lon_coord=cube.coord('longitude')
+        if lon_max-lon_min>=360:
+            lon_min=0
+            width=360   # All longitudes
+        else:
+            lon_min=lon_min%360
+            width=(lon_max-lon_min)%360
+        selected=np.where((lon_coord.points-lon_min)%360<=width)[0]
+        if len(selected)==0:
+            raise ValueError("No longitudes in region")
+        if selected.max()-selected.min()+1==len(selected):
+            keys=[slice(None)]*cube.ndim
+            keys[cube.coord_dims(lon_coord)[0]]=slice(selected.min(),
+                                                      selected.max()+1)
+            cube=cube[tuple(keys)]
+        else:
+            # Region wraps round the end of the longitude coordinate
+            cube=cube.intersection(longitude=(lon_min,lon_min+width))
+    return cube
+
 def get_slice_at_hour_at_timestep(variable,year,month,day,hour,version,
-                                  type='ensemble'):
+                                  type='ensemble',member=None,region=None):
     """Get the cube with the data, given that the specified time
-       matches a data timestep."""
+       matches a data timestep.
+
+       'member' and 'region' select part of the field (see
+       subset_cube) - only that part is read from the file."""
     if not is_in_file(variable,version,hour):
         raise ValueError("Invalid hour - data not in file")
     file_name=get_data_file_name(variable,year,month,day,hour,
                                  version,type)
+    # Read-ahead (if turned on) - see prefetch.set_prefetch
+    from .prefetch import note_access
+    note_access(variable,year,month,version,type)
     if type == 'normal' or type == 'standard.deviation':
         year=1981
         if month==2 and day==29:
             day=28
+    # Use the array store instead of the netCDF file if it has the data
+    from .store import get_slice_from_store
+    hslice=get_slice_from_store(variable,year,month,day,hour,version,type)
+    if hslice is not None:
+        return subset_cube(hslice,member,region)
+    try:
+        cache_key=(file_name,os.path.getmtime(file_name),
+                   year,month,day,hour,str(member),str(region))
+    except OSError:
+        cache_key=None   # No file - let iris report the problem
+    if cache_key is not None:
+        hslice=slice_cache.get(cache_key)
+        if hslice is not None:
+            return hslice.copy()
+    note_file_access(file_name)   # For the $SCRATCH quota
     time_constraint=iris.Constraint(time=iris.time.PartialDateTime(
                                    year=year,
                                    month=month,
@@ -118,16 +241,27 @@ def get_slice_at_hour_at_timestep(variable,year,month,day,hour,version,
     # This isn't the right error to catch
     except iris.exceptions.ConstraintMismatchError:
        print("Data not available")
+       raise
+    hslice=subset_cube(hslice,member,region)
+    if cache_key is not None and slice_cache.max_bytes>0:
+        # Size from the shape - the data isn't read until it's used
+        slice_cache.put(cache_key,hslice,
+                        int(np.prod(hslice.shape))*hslice.dtype.itemsize)
+        return hslice.copy()
     return hslice
 
 def get_slice_at_hour(variable,year,month,day,hour,version,
-                      type='ensemble'):
+                      type='ensemble',member=None,region=None):
     """Get the cube with the data, interpolating between timesteps
-       if necessary."""
+       if necessary.
+
+       'member' and 'region' select part of the field (see
+       subset_cube) - only that part is read from the file."""
     if is_in_file(variable,version,hour):
         return(get_slice_at_hour_at_timestep(variable,year,
                                              month,day,
-                                             hour,version,type))
+                                             hour,version,type,
+                                             member,region))
     previous_step=get_previous_field_time(variable,year,month,
                                           day,hour,version)
     next_step=get_next_field_time(variable,year,month,
@@ -148,57 +282,204 @@ def get_slice_at_hour(variable,year,month,day,hour,version,
                                              previous_step['month'],
                                              previous_step['day'],
                                              previous_step['hour'],
-                                             version,type)
+                                             version,type,member,region)
     s_next=get_slice_at_hour_at_timestep(variable,
                                          next_step['year'],
                                          next_step['month'],
                                          next_step['day'],
                                          next_step['hour'],
-                                         version,type)
+                                         version,type,member,region)
     s_next.data=s_next.data*weight+s_previous.data*(1-weight)
     return s_next
 
-def get_obs_1file(year,month,day,hour,version):
-    """Retrieve all the observations for an individual assimilation run"""
-    if(version[0]=='4'):
-      return get_obs_1file_v3(year,month,day,hour,version=version)
-    else:
-      return get_obs_1file_v2(year,month,day,hour,version=version)
+def get_slices_for_range(variable,start,end,version,
+                         type='ensemble',member=None,region=None):
+    """Get a single cube, with a time dimension, containing
+       all the data timesteps between start and end
+       (start<=time<end).
 
-def get_obs_1file_v2(year,month,day,hour,version):
-    """Retrieve all the observations for an individual assimilation run
-     Version for v2 format data."""
-    base_dir=get_data_dir(version)
-    of_name=get_data_file_name('observations',year,month,day,hour,version)
-    if not os.path.isfile(of_name):
-        raise IOError("No obs file for given version and date")
+       Each data file is opened once, and the times wanted from it
+       are read as contiguous blocks. 'member' and 'region' select
+       part of the field (see subset_cube)."""
+    if type == 'normal' or type == 'standard.deviation':
+        raise StandardError("Use get_slice_at_hour for %s" % type)
+    times=get_field_times(start,end,version)
+    if len(times)==0:
+        raise ValueError("No data timesteps between %s and %s" %
+                         (start,end))
+    by_file=collections.OrderedDict()
+    for ct in times:
+        file_name=get_data_file_name(variable,ct.year,ct.month,ct.day,
+                                     ct.hour,version,type)
+        by_file.setdefault(file_name,[]).append(ct)
+    slices=iris.cube.CubeList()
+    for file_name,file_times in by_file.items():
+        slices.extend(get_times_from_file(file_name,file_times,
+                                          member,region))
+    return slices.concatenate_cube()
+
+def get_times_from_file(file_name,times,member=None,region=None):
+    """Get the data for the given times from one file.
+
+       Returns a list of cubes, one for each run of consecutive
+       timesteps in the file. Data are not read until used."""
+    note_file_access(file_name)
+    cube=subset_cube(iris.load_cube(file_name),member,region)
+    time_coord=cube.coord('time')
+    time_dim=cube.coord_dims(time_coord)[0]
+    file_times=time_coord.units.num2date(time_coord.points)
+    file_index={}
+    for idx,ft in enumerate(file_times):
+        file_index[(ft.year,ft.month,ft.day,ft.hour)]=idx
+    indices=[]
+    for ct in times:
+        try:
+            indices.append(file_index[(ct.year,ct.month,ct.day,ct.hour)])
+        except KeyError:
+            raise StandardError("Data for %s not in %s" % (ct,file_name))
+    result=[]
+    run_start=0
+    for i in range(1,len(indices)+1):
+        if i==len(indices) or indices[i]!=indices[i-1]+1:
+            keys=[slice(None)]*cube.ndim
+            keys[time_dim]=slice(indices[run_start],indices[i-1]+1)
+            result.append(cube[tuple(keys)])
+            run_start=i
+    return result
+
+def iter_data_blocks(cube,block_size=8):
+    """Generate the data in a cube with a time dimension, a few
+       timesteps at a time, as (first,last,block) - block is
+       an array (time,member,lat,lon) of timesteps first:last.
+
+       If the cube's data are lazy, each block is read only when
+       it is reached."""
+    time_dim=cube.coord_dims('time')[0]
+    lat_dim=cube.coord_dims('latitude')[0]
+    lon_dim=cube.coord_dims('longitude')[0]
+    try:
+        dims=[time_dim,get_member_dim(cube),lat_dim,lon_dim]
+    except StandardError:
+        dims=[time_dim,lat_dim,lon_dim]   # No members (mean or spread)
+    n_time=cube.shape[time_dim]
+    for first in range(0,n_time,block_size):
+        last=min(n_time,first+block_size)
+        keys=[slice(None)]*cube.ndim
+        keys[time_dim]=slice(first,last)
+        block=np.transpose(np.ma.filled(cube[tuple(keys)].data,np.nan),
+                           dims)
+        if len(dims)==3:
+            block=block[:,np.newaxis]
+        yield (first,last,block)
+
+def get_interpolation_weights(times,version):
+    """Map each of a set of times to the data timesteps either side.
 
-    o=pandas.read_fwf(of_name,
-                       colspecs=[(0,19),(20,23),(24,25),(26,33),(34,40),(41,46),(47,52),
+       Returns three arrays: the previous and next data timesteps
+       (as datetime64), and the weight to give the next timestep
+       when interpolating (0 if the time is a data timestep)."""
+    step=get_field_step(version)
+    targets=np.array(times,dtype='datetime64[s]')
+    # Same rounding as get_previous_field_time & get_next_field_time
+    hours=targets.astype('datetime64[h]').astype(np.int64)
+    previous=((hours//step)*step).astype('datetime64[h]')
+    previous=previous.astype('datetime64[s]')
+    next_step=previous+np.timedelta64(step,'h')
+    weight=(targets-previous)/np.timedelta64(step,'h')
+    return (previous,next_step,weight)
+
+def iter_slices_at_times(variable,times,version,type='ensemble',
+                         member=None,region=None):
+    """Generate a cube for each of a set of times, interpolating
+       between timesteps where necessary.
+
+       Each data timestep needed is read once, and dropped as soon as
+       no later time needs it, so memory use stays small however
+       many times are requested."""
+    targets=np.array(times,dtype='datetime64[s]')
+    previous,next_step,weight=get_interpolation_weights(targets,version)
+    needed=np.union1d(previous,next_step[weight>0])
+    first=needed[0]
+    step=np.timedelta64(get_field_step(version),'h')
+    # Lazy cube covering all the times - data read as used
+    span=get_slices_for_range(variable,
+                              first.astype(datetime.datetime),
+                              (needed[-1]+step).astype(datetime.datetime),
+                              version,type,member,region)
+    time_dim=span.coord_dims(span.coord('time'))[0]
+    # Last use of each field - so it can be dropped after
+    last_use={}
+    for i in range(len(weight)):
+        last_use[previous[i]]=i
+        if weight[i]>0:
+            last_use[next_step[i]]=i
+    fields={}
+    def get_field(ft):
+        if ft not in fields:
+            keys=[slice(None)]*span.ndim
+            keys[time_dim]=int((ft-first)/step)
+            field=span[tuple(keys)]
+            field.data   # Read it
+            fields[ft]=field
+        return fields[ft]
+    scratch=None
+    for i in range(len(weight)):
+        frame=get_field(previous[i]).copy()
+        if weight[i]>0:
+            # frame=previous*(1-weight)+next*weight, without temporaries
+            if scratch is None:
+                scratch=np.empty(frame.data.shape,dtype=frame.data.dtype)
+            frame.data*=(1-weight[i])
+            np.multiply(get_field(next_step[i]).data,weight[i],out=scratch)
+            frame.data+=scratch
+            time_coord=frame.coord('time')
+            time_coord.points=[time_coord.units.date2num(
+                                   targets[i].astype(datetime.datetime))]
+        # No bounds on any frame, so they merge whether interpolated or not
+        frame.coord('time').bounds=None
+        for ft in list(fields.keys()):
+            if last_use[ft]<=i:
+                del fields[ft]
+        yield frame
+
+def get_slices_at_times(variable,times,version,type='ensemble',
+                        member=None,region=None):
+    """Get a single cube, with a time dimension, containing data for
+       each of a set of (increasing) times, interpolated as necessary."""
+    slices=iris.cube.CubeList(iter_slices_at_times(variable,times,
+                                                   version,type,
+                                                   member,region))
+    return slices.merge_cube()
+
+# Layouts of the observation feedback files
+Obs_na_values=['NA','*','***','*****','*******','**********',
+               '-99','9999','-999','9999.99','10000.0',
+               '-9.99','999999999999999999999999999999',
+               '999999999999','9']
+Obs_formats={'v2': {
+                    'colspecs': [(0,19),(20,23),(24,25),(26,33),(34,40),(41,46),(47,52),
                                  (53,61),(60,67),(68,75),(76,83),(84,94),(95,100),
                                  (101,106),(107,108),(109,110),(111,112),(113,114),
                                  (115,116),(117,127),(128,138),(139,149),(150,160),
-                                 (161,191),(192,206)],          
-                       header=None,
-                       encoding="ISO-8859-1",
-                       names=['UID','NCEP.Type','Variable','Longitude','Latitude',
-                               'Elevation','Model.Elevation','Time.Offset',
-                               'Pressure.after.bias.correction',
-                               'Pressure.after.vertical.interpolation',
-                               'SLP','Bias',
-                               'Error.in.surface.pressure',
-                               'Error.in.vertically.interpolated.pressure',
-                               'Assimilation.indicator',
-                               'Usability.check',
-                               'QC.flag',
-                               'Background.check',
-                               'Buddy.check',
-                               'Mean.first.guess.pressure.difference',
-                               'First.guess.pressure.spread',
-                               'Mean.analysis.pressure.difference',
-                               'Analysis.pressure.spread',
-                               'Name','ID'],
-                       converters={'UID': str, 'NCEP.Type': int, 'Variable' : str,
+                                 (161,191),(192,206)],
+                    'names': ['UID','NCEP.Type','Variable','Longitude','Latitude',
+                              'Elevation','Model.Elevation','Time.Offset',
+                              'Pressure.after.bias.correction',
+                              'Pressure.after.vertical.interpolation',
+                              'SLP','Bias',
+                              'Error.in.surface.pressure',
+                              'Error.in.vertically.interpolated.pressure',
+                              'Assimilation.indicator',
+                              'Usability.check',
+                              'QC.flag',
+                              'Background.check',
+                              'Buddy.check',
+                              'Mean.first.guess.pressure.difference',
+                              'First.guess.pressure.spread',
+                              'Mean.analysis.pressure.difference',
+                              'Analysis.pressure.spread',
+                              'Name','ID'],
+                    'converters': {'UID': str, 'NCEP.Type': int, 'Variable' : str,
                                    'Longitude': float,'Latitude': float,'Elevation': int,
                                    'Model.Elevation': int, 'Time.Offset': float,
                                    'Pressure.after.bias.correction': float,
@@ -213,55 +494,289 @@ def get_obs_1file_v2(year,month,day,hour,version):
                                    'First.guess.pressure.spread': float,
                                    'Mean.analysis.pressure.difference': float,
                                    'Analysis.pressure.spread': float,
-                                   'Name': str, 'ID': str},
-                       na_values=['NA','*','***','*****','*******','**********',
-                                          '-99','9999','-999','9999.99','10000.0',
-                                          '-9.99','999999999999999999999999999999',
-                                          '999999999999','9'],
-                       comment=None)
-    return(o)
+                                   'Name': str, 'ID': str}
+                   },
+             'v3': {
+                    'colspecs': [(0,19),(20,23),(24,25),(26,33),(34,40),(41,46),
+                                 (47,53),(55,62),(63,71),(72,77),(78,134)],
+                    'names': ['UID','NCEP.Type','Variable','Longitude','Latitude',
+                              'Un1','Un2','Un3','Un4','Un5','Name'],
+                    'converters': {'UID': str, 'NCEP.Type': int, 'Variable' : str,
+                                   'Longitude': float, 'Latitude': float, 'Un1': int,
+                                   'Un2': float, 'Un3': float, 'Un4': float,
+                                   'Un5': float, 'Name': str}
+                   }
+}
 
-def get_obs_1file_v3(year,month,day,hour,version):
+def get_obs_1file(year,month,day,hour,version,engine='pandas',
+                  columns=None,use_sidecar=True):
+    """Retrieve all the observations for an individual assimilation run
+
+       'engine' is the file parser to use: 'pandas' (read_fwf) or
+       'numpy' (faster - see read_fwf_numpy).
+
+       'columns' is a list of the columns wanted (default all).
+
+       If 'use_sidecar' is True, keep a binary copy of the
+       parsed file (if it's on $SCRATCH), and use that instead
+       of the text file when it's up to date (see read_obs_file)."""
+    if(version[0]=='4'):
+      return get_obs_1file_v3(year,month,day,hour,version=version,
+                              engine=engine,columns=columns,
+                              use_sidecar=use_sidecar)
+    else:
+      return get_obs_1file_v2(year,month,day,hour,version=version,
+                              engine=engine,columns=columns,
+                              use_sidecar=use_sidecar)
+
+def get_obs_1file_v2(year,month,day,hour,version,engine='pandas',
+                     columns=None,use_sidecar=True):
+    """Retrieve all the observations for an individual assimilation run
+     Version for v2 format data."""
+    of_name=get_data_file_name('observations',year,month,day,hour,version)
+    if not os.path.isfile(of_name):
+        raise IOError("No obs file for given version and date")
+    return read_obs_file(of_name,'v2',engine,columns,use_sidecar)
+
+def get_obs_1file_v3(year,month,day,hour,version,engine='pandas',
+                     columns=None,use_sidecar=True):
     """Retrieve all the observations for an individual assimilation run
      Version for v3 format data."""
     of_name=get_data_file_name('observations',year,month,day,hour,version)
     if not os.path.isfile(of_name):
         raise IOError("No obs file for given version and date")
+    return read_obs_file(of_name,'v3',engine,columns,use_sidecar)
 
-    o=pandas.read_fwf(of_name,
-                       colspecs=[(0,19),(20,23),(24,25),(26,33),(34,40),(41,46),
-                                 (47,53),(55,62),(63,71),(72,77),(78,134)],
-                       usecols=[0,1,2,3,4,5,6,7,8,9,10],
-                       header=None,
-                       encoding="ISO-8859-1",
-                       names=['UID','NCEP.Type','Variable','Longitude','Latitude',
-                              'Un1','Un2','Un3','Un4','Un5','Name'],
-                       converters={'UID': str, 'NCEP.Type': int, 'Variable' : str,
-                                   'Longitude': float, 'Latitude': float, 'Un1': int,
-                                   'Un2': float, 'Un3': float, 'Un4': float,
-                                   'Un5': float, 'Name': str},
-                       na_values=['NA','*','***','*****','*******','**********',
-                                          '-99','9999','-999','9999.99','10000.0',
-                                          '-9.99','999999999999999999999999999999',
-                                          '999999999999','9'],
-                       comment=None)
+def read_obs_file(file_name,format,engine='pandas',columns=None,
+                  use_sidecar=True):
+    """Read an observations file in the given format ('v2' or 'v3').
+
+       If 'use_sidecar' is True, the parsed data are saved in a
+       binary sidecar file (file_name.npz), and later reads with the
+       same engine use the sidecar, unless the text file has changed
+       since. Only the 'columns' asked for are read from the sidecar.
+       Sidecars are only written on $SCRATCH - not alongside the
+       shared copies of the files."""
+    if use_sidecar:
+        o=read_obs_sidecar(file_name,columns,format,engine)
+        if o is not None:
+            return o
+    layout=Obs_formats[format]
+    if engine=='numpy':
+        o=read_fwf_numpy(file_name,layout['colspecs'],
+                         layout['names'],layout['converters'],
+                         Obs_na_values)
+    elif engine=='pandas':
+        o=pandas.read_fwf(file_name,
+                           colspecs=layout['colspecs'],
+                           header=None,
+                           encoding="ISO-8859-1",
+                           names=layout['names'],
+                           converters=layout['converters'],
+                           na_values=Obs_na_values,
+                           comment=None)
+    else:
+        raise ValueError("Unsupported engine %s" % engine)
+    if use_sidecar:
+        write_obs_sidecar(file_name,o,format,engine)
+    if columns is not None:
+        o=o[list(columns)]
     return(o)
+
+def get_obs_sidecar_name(file_name):
+    """Name of the binary copy of an observations file."""
+    return "%s.npz" % file_name
+
+def is_on_scratch(file_name):
+    """Is the file in the $SCRATCH directory tree?"""
+    scratch=os.environ.get('SCRATCH')
+    if scratch is None:
+        return False
+    return os.path.realpath(file_name).startswith(
+                      os.path.join(os.path.realpath(scratch),''))
+
+def write_obs_sidecar(file_name,o,format,engine):
+    """Save parsed observations as a sidecar to their text file.
+
+       One array per column, with the text file's modification time
+       and size, so a changed file can be spotted, and the format and
+       engine it was parsed with. Does nothing if the text file isn't
+       on $SCRATCH, or the sidecar can't be written."""
+    if not is_on_scratch(file_name):
+        return
+    source=os.stat(file_name)
+    arrays=obs_to_arrays(o)
+    arrays['__source__']=np.array([source.st_mtime,source.st_size],
+                                  dtype=np.float64)
+    arrays['__parser__']=np.array([format,engine],dtype='U')
+    sidecar=get_obs_sidecar_name(file_name)
+    tmp_name="%s.%d.tmp" % (sidecar,os.getpid())
+    try:
+        with open(tmp_name,'wb') as f:
+            np.savez(f,**arrays)
+        os.rename(tmp_name,sidecar)
+    except (IOError,OSError):
+        if os.path.isfile(tmp_name):
+            os.remove(tmp_name)
+
+def read_obs_sidecar(file_name,columns=None,format=None,engine=None):
+    """Read observations from the sidecar of a text file.
+
+       Returns None if there is no sidecar, the text file has been
+       changed since it was made, or it was parsed with a different
+       format or engine from those given."""
+    sidecar=get_obs_sidecar_name(file_name)
+    if not os.path.isfile(sidecar):
+        return None
+    try:
+        source=os.stat(file_name)
+        with np.load(sidecar) as saved:
+            mtime,size=saved['__source__']
+            if mtime!=source.st_mtime or size!=source.st_size:
+                return None
+            parser=list(saved['__parser__'])
+            if (format is not None and parser[0]!=format or
+                engine is not None and parser[1]!=engine):
+                return None
+            return arrays_to_obs(saved,columns)
+    except (IOError,OSError,KeyError,ValueError):
+        return None
+
+def obs_to_arrays(o):
+    """Convert an observations DataFrame to a dictionary of
+       numpy arrays suitable for numpy.savez (no object arrays)."""
+    arrays={'__columns__':np.array(list(o.columns),dtype='U')}
+    for name in o.columns:
+        if o[name].dtype.kind in 'biuf':
+            arrays[name]=o[name].values
+        else:
+            # Text - store missing values as empty strings
+            values=np.array(o[name],dtype=object)
+            values[pandas.isnull(values)]=''
+            arrays[name]=values.astype('U')
+    return arrays
+
+def arrays_to_obs(arrays,columns=None):
+    """Convert arrays made by obs_to_arrays (or loaded from a
+       file saved from them) back into a DataFrame."""
+    names=list(arrays['__columns__'])
+    if columns is not None:
+        names=list(columns)
+    data={}
+    for name in names:
+        values=arrays[name]
+        if values.dtype.kind=='U':
+            values=values.astype(object)
+            values[values=='']=np.nan
+        data[name]=values
+    return pandas.DataFrame(data,columns=names)
+
+def read_fwf_numpy(file_name,colspecs,names,converters,na_values):
+    """Read a fixed-width text file into a DataFrame, slicing the
+       columns out of a byte array with numpy instead of converting
+       each field separately.
+
+       Blank fields, and fields matching 'na_values' (as text or as
+       numbers), become NaN. Columns with an int converter are
+       returned as float if they have any missing values."""
+    with open(file_name,'rb') as f:
+        lines=[l for l in f.read().splitlines() if l.strip()]
+    width=max(c[1] for c in colspecs)
+    chars=np.array(lines,dtype='S%d' % width).view('S1')
+    chars=chars.reshape(len(lines),width)
+    na_bytes=np.array([v.encode('ISO-8859-1') for v in na_values]+[b''])
+    na_numbers=[]
+    for v in na_values:
+        try:
+            na_numbers.append(float(v))
+        except ValueError:
+            pass
+    columns={}
+    for (start,end),name in zip(colspecs,names):
+        field=np.ascontiguousarray(chars[:,start:end])
+        field=np.char.strip(field.view('S%d' % (end-start)).ravel())
+        missing=np.isin(field,na_bytes)
+        converter=converters.get(name,str)
+        if converter is str:
+            values=np.char.decode(field,'ISO-8859-1').astype(object)
+            values[missing]=np.nan
+        else:
+            values=np.empty(len(field),dtype=np.float64)
+            values[~missing]=field[~missing].astype(np.float64)
+            missing|=np.isin(values,na_numbers)
+            values[missing]=np.nan
+            if converter is int and not missing.any():
+                values=values.astype(np.int64)
+        columns[name]=values
+    return pandas.DataFrame(columns,columns=names)
  
-def get_obs(start,end,version):
-    """Retrieve all the observations between start and end"""
-    base_dir=get_data_dir(version)
-    result=None
+def get_obs_file_times(start,end):
+    """The times of the observation files (every 6 hours)
+       needed for the observations between start and end."""
+    times=[]
     ct=start
     while(ct<end):
-        if(int(ct.hour)%6!=0):
-           ct=ct+datetime.timedelta(hours=1)
-           continue 
-        o=get_obs_1file(ct.year,ct.month,ct.day,ct.hour,version)
-        dtm=pandas.to_datetime(o.UID.str.slice(0,10),format="%Y%m%d%H")
-        o2=o[(dtm>=start) & (dtm<end)]
-        if(result is None):
-            result=o2
-        else:
-            result=pandas.concat([result,o2])
+        if(int(ct.hour)%6==0):
+            times.append(datetime.datetime(ct.year,ct.month,ct.day,ct.hour))
         ct=ct+datetime.timedelta(hours=1)
-    return(result)
+    return times
+
+def get_obs_time_key(dt):
+    """Integer YYYYMMDDHH for the first whole hour at or after dt -
+       for comparing with the first 10 characters of the obs UID."""
+    if dt.minute!=0 or dt.second!=0 or dt.microsecond!=0:
+        dt=dt+datetime.timedelta(hours=1)
+    return ((dt.year*100+dt.month)*100+dt.day)*100+dt.hour
+
+def select_obs_in_range(o,start,end):
+    """The observations in o with times between start and end.
+       Observations with no UID (NaN) are left out."""
+    key=pandas.to_numeric(o.UID.str.slice(0,10),errors='coerce')
+    return o[(key>=get_obs_time_key(start)) & (key<get_obs_time_key(end))]
+
+def get_obs_1file_in_range(year,month,day,hour,version,start,end,
+                           columns=None,engine='pandas'):
+    """Retrieve the observations, from an individual assimilation
+       run, with times between start and end."""
+    read_columns=columns
+    if columns is not None and 'UID' not in columns:
+        read_columns=['UID']+list(columns)
+    o=get_obs_1file(year,month,day,hour,version,engine=engine,
+                    columns=read_columns)
+    o=select_obs_in_range(o,start,end)
+    if read_columns is not columns:
+        o=o[list(columns)]
+    return o
+
+def _get_obs_1file_in_range(args):
+    # Pool.map takes one argument
+    return get_obs_1file_in_range(*args)
+
+def iter_obs(start,end,version,columns=None,engine='pandas'):
+    """Generate the observations between start and end - one
+       DataFrame for each assimilation run."""
+    for ct in get_obs_file_times(start,end):
+        yield get_obs_1file_in_range(ct.year,ct.month,ct.day,ct.hour,
+                                     version,start,end,columns,engine)
+
+def get_obs(start,end,version,columns=None,engine='pandas',
+            processes=1):
+    """Retrieve all the observations between start and end
+
+       If 'processes' is more than 1, read the files in parallel
+       with that many worker processes."""
+    if processes>1:
+        pool=multiprocessing.Pool(processes)
+        try:
+            frames=pool.map(_get_obs_1file_in_range,
+                            [(ct.year,ct.month,ct.day,ct.hour,version,
+                              start,end,columns,engine)
+                             for ct in get_obs_file_times(start,end)])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        frames=list(iter_obs(start,end,version,columns,engine))
+    if len(frames)==0:
+        return None
+    return(pandas.concat(frames))
@@ -0,0 +1,245 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+A spatial index for 20CR observations.
+
+Observations are sorted into lat:lon grid boxes, so queries for
+the obs in a region only look at the obs in nearby boxes,
+instead of scanning the whole DataFrame.
+"""
+
+import os
+from scratch.lazy import numpy as np
+
+from .load import get_data_file_name
+from .load import get_obs
+from .load import get_obs_file_times
+from .load import obs_to_arrays
+from .load import arrays_to_obs
+
+# Mean radius of the Earth (km)
+Earth_radius=6371.0
+
+class ObsIndex(object):
+    """Observations, indexed by position.
+
+       Longitudes can be given in either -180:180 or 0:360, and
+       regions can cross the date line or the meridian."""
+
+    def __init__(self,obs,resolution=1.0,sources=None):
+        self.obs=obs.reset_index(drop=True)
+        self.resolution=resolution
+        # Modification time and size of the obs files (see get_obs_sources)
+        self.sources=sources
+        self.n_lat=int(np.ceil(180.0/resolution))
+        self.n_lon=int(np.ceil(360.0/resolution))
+        lat=self.obs['Latitude'].values.astype(np.float64)
+        lon=self.obs['Longitude'].values.astype(np.float64)%360
+        valid=np.isfinite(lat) & np.isfinite(lon)
+        bucket=np.full(len(lat),-1,dtype=np.int64)
+        bucket[valid]=(self.lat_row(lat[valid])*self.n_lon+
+                       self.lon_column(lon[valid]))
+        # Obs sorted by bucket, and where each bucket starts
+        self.order=np.argsort(bucket,kind='mergesort')
+        self.offsets=np.searchsorted(bucket[self.order],
+                                     np.arange(self.n_lat*self.n_lon+1))
+        self.lat=lat
+        self.lon=lon
+
+    def lat_row(self,lat):
+        return np.clip(((np.asarray(lat)+90)/self.resolution).astype(np.int64),
+                       0,self.n_lat-1)
+
+    def lon_column(self,lon):
+        return (((np.asarray(lon)%360)/self.resolution).astype(np.int64)
+                %self.n_lon)
+
+    def candidates(self,lat_min,lat_max,lon_min,lon_max):
+        """Indices of the obs in all the grid boxes touching a region."""
+        rows=np.arange(self.lat_row(lat_min),self.lat_row(lat_max)+1)
+        if lon_max-lon_min>=360:
+            columns=np.arange(self.n_lon)
+        else:
+            first=self.lon_column(lon_min)
+            last=self.lon_column(lon_max)
+            if last>=first:
+                columns=np.arange(first,last+1)
+            else:
+                # Region crosses the 0/360 line
+                columns=np.concatenate((np.arange(first,self.n_lon),
+                                        np.arange(0,last+1)))
+                columns=np.unique(columns)
+        buckets=(rows[:,None]*self.n_lon+columns[None,:]).ravel()
+        starts=self.offsets[buckets]
+        ends=self.offsets[buckets+1]
+        if len(buckets)==0 or (ends-starts).sum()==0:
+            return np.array([],dtype=np.int64)
+        return np.concatenate([self.order[s:e] for s,e in zip(starts,ends)
+                               if e>s])
+
+    def in_box(self,lat_min,lat_max,lon_min,lon_max):
+        """The obs inside a lat:lon box.
+
+           If lon_min is greater than lon_max (after converting both
+           to 0:360), the box crosses the 0/360 line - so
+           (30,80,340,20) is the box around the UK. A box 360
+           degrees (or more) wide has all longitudes."""
+        if lon_max-lon_min>=360:
+            lon_min=0
+            width=360
+        else:
+            lon_min=lon_min%360
+            width=(lon_max%360-lon_min)%360
+        idx=self.candidates(lat_min,lat_max,lon_min,lon_min+width)
+        lat=self.lat[idx]
+        lon_offset=(self.lon[idx]-lon_min)%360
+        idx=idx[(lat>=lat_min) & (lat<=lat_max) & (lon_offset<=width)]
+        return self.obs.iloc[np.sort(idx)]
+
+    def within(self,lat,lon,radius):
+        """The obs within 'radius' km of a point."""
+        idx=self.candidates_near(lat,lon,radius)
+        distance=great_circle_distance(lat,lon,self.lat[idx],self.lon[idx])
+        idx=idx[distance<=radius]
+        return self.obs.iloc[np.sort(idx)]
+
+    def nearest(self,lat,lon,k=1):
+        """The k obs nearest to a point, nearest first. The distances
+           (km) are added as column 'Distance'."""
+        n_valid=self.offsets[-1]-self.offsets[0]
+        k=min(k,n_valid)
+        radius=self.resolution*111.0
+        while True:
+            idx=self.candidates_near(lat,lon,radius)
+            distance=great_circle_distance(lat,lon,
+                                           self.lat[idx],self.lon[idx])
+            inside=distance<=radius
+            # Searched far enough if there are k obs within the radius
+            if inside.sum()>=k or radius>=np.pi*Earth_radius:
+                break
+            radius=radius*2
+        order=np.argsort(distance,kind='mergesort')[:k]
+        result=self.obs.iloc[idx[order]].copy()
+        result['Distance']=distance[order]
+        return result
+
+    def candidates_near(self,lat,lon,radius):
+        """Indices of the obs in all the grid boxes within
+           'radius' km of a point."""
+        dlat=np.degrees(radius/Earth_radius)
+        lat_min=max(-90.0,lat-dlat)
+        lat_max=min(90.0,lat+dlat)
+        if lat_min<=-90 or lat_max>=90 or dlat>=90:
+            return self.candidates(lat_min,lat_max,0,360)
+        # Widest longitude range of a circle on the sphere
+        dlon=np.degrees(np.arcsin(min(1.0,np.sin(radius/Earth_radius)/
+                                      np.cos(np.radians(lat)))))
+        if dlon>=90:
+            return self.candidates(lat_min,lat_max,0,360)
+        return self.candidates(lat_min,lat_max,
+                               (lon-dlon)%360,(lon-dlon)%360+2*dlon)
+
+    def save(self,file_name):
+        """Save the index (and obs) to a file."""
+        arrays=obs_to_arrays(self.obs)
+        arrays['__resolution__']=np.array([self.resolution])
+        if self.sources is not None:
+            arrays['__sources__']=self.sources
+        dir_name=os.path.dirname(file_name)
+        if dir_name!='' and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+        tmp_name="%s.%d.tmp" % (file_name,os.getpid())
+        with open(tmp_name,'wb') as f:
+            np.savez(f,**arrays)
+        os.rename(tmp_name,file_name)
+
+def great_circle_distance(lat1,lon1,lat2,lon2):
+    """Distance (km) between points - haversine formula."""
+    lat1=np.radians(lat1)
+    lat2=np.radians(lat2)
+    dlat=lat2-lat1
+    dlon=np.radians(lon2)-np.radians(lon1)
+    a=np.sin(dlat/2)**2+np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+    return 2*Earth_radius*np.arcsin(np.sqrt(np.clip(a,0,1)))
+
+def load_obs_index(file_name):
+    """Load an index saved with ObsIndex.save."""
+    with np.load(file_name) as saved:
+        resolution=float(saved['__resolution__'][0])
+        obs=arrays_to_obs(saved)
+        sources=None
+        if '__sources__' in saved.files:
+            sources=saved['__sources__']
+    return ObsIndex(obs,resolution,sources)
+
+def get_obs_index_file_name(start,end,version):
+    """Where to keep the index for the obs between start and end -
+       always on $SCRATCH (even if the obs are in the project
+       directory). None if $SCRATCH isn't set."""
+    scratch=os.environ.get('SCRATCH')
+    if scratch is None:
+        return None
+    return "%s/20CR/version_%s/observations/index/%s-%s.npz" % (scratch,
+                                    version,
+                                    start.strftime("%Y%m%d%H%M"),
+                                    end.strftime("%Y%m%d%H%M"))
+
+def get_obs_sources(start,end,version):
+    """Modification time and size of each of the obs files for the
+       period - an array (file,2), with -1 for a missing file."""
+    sources=[]
+    for ct in get_obs_file_times(start,end):
+        try:
+            source=os.stat(get_data_file_name('observations',ct.year,
+                                              ct.month,ct.day,ct.hour,
+                                              version))
+            sources.append((source.st_mtime,source.st_size))
+        except OSError:
+            sources.append((-1,-1))
+    return np.array(sources,dtype=np.float64).reshape(-1,2)
+
+def get_obs_index(start,end,version,resolution=1.0,columns=None,
+                  processes=1):
+    """Get an index of the observations between start and end.
+
+       If an index for that period has been saved, and the obs files
+       haven't changed since, use it, otherwise make one and save it."""
+    file_name=get_obs_index_file_name(start,end,version)
+    sources=get_obs_sources(start,end,version)
+    if file_name is not None and os.path.isfile(file_name):
+        index=load_obs_index(file_name)
+        if (index.resolution==resolution and
+                index.sources is not None and
+                np.array_equal(index.sources,sources) and
+                (columns is None or
+                 set(columns).issubset(index.obs.columns))):
+            return index
+    read_columns=columns
+    if columns is not None:
+        read_columns=list(columns)
+        for name in ('Latitude','Longitude'):
+            if name not in read_columns:
+                read_columns.append(name)
+    obs=get_obs(start,end,version,columns=read_columns,
+                processes=processes)
+    if obs is None:
+        raise StandardError("No observations between %s and %s" %
+                            (start,end))
+    index=ObsIndex(obs,resolution,sources)
+    if file_name is None:
+        return index   # No $SCRATCH - nowhere to save it
+    try:
+        index.save(file_name)
+    except (IOError,OSError):
+        pass   # Can't write - just don't save it
+    return index
@@ -0,0 +1,85 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Read-ahead for jobs walking forward in time through 20CR data.
+
+Off by default - turn it on with set_prefetch. Then, once
+get_slice_at_hour moves from one month's file (one year's, for
+version 2) to the next, the files for the following months are
+fetched in the background.
+"""
+
+import functools
+
+from scratch.prefetch import Prefetcher
+from scratch.prefetch import warm_file
+
+from .load import get_data_file_name
+from .fetch import fetch_data_for_month
+from .fetch import run_transfer
+
+# The Prefetcher in use (None if read-ahead is off)
+_prefetcher=None
+
+# Types fetched a month (or year) at a time
+Prefetch_types=('ensemble','mean','spread','first.guess.mean',
+                'first.guess.spread')
+
+def set_prefetch(depth=2,bandwidth=None,warm=False,threads=1):
+    """Turn read-ahead on: keep 'depth' files ahead of the job, fetched
+       in 'threads' background threads, using no more than 'bandwidth'
+       (bytes/s) each. If 'warm', also read each file once it's
+       fetched, so it's in the page cache. depth=0 turns it off."""
+    global _prefetcher
+    if _prefetcher is not None:
+        _prefetcher.stop()
+        _prefetcher=None
+    if depth>0:
+        _prefetcher=Prefetcher(_fetch,_successor,depth,bandwidth,
+                               _warm if warm else None,threads)
+
+def _fetch(stream,position,bandwidth):
+    variable,version,type=stream
+    transfer=run_transfer
+    if bandwidth is not None:
+        transfer=functools.partial(run_transfer,
+                                   bwlimit=max(1,int(bandwidth/1024)))
+    fetch_data_for_month(variable,position[0],position[1],version,type,
+                         transfer=transfer)
+
+def _successor(stream,position):
+    year,month=position
+    if month is None:
+        return (year+1,None)   # Version 2 - files are by year
+    if month==12:
+        return (year+1,1)
+    return (year,month+1)
+
+def _warm(stream,position,bandwidth):
+    variable,version,type=stream
+    month=position[1] if position[1] is not None else 1
+    warm_file(get_data_file_name(variable,position[0],month,1,6,
+                                 version,type),bandwidth)
+
+def note_access(variable,year,month,version,type):
+    """Called by the loader for each field loaded - starts any
+       read-ahead needed, and waits if the file wanted is still being
+       prefetched."""
+    if _prefetcher is None or type not in Prefetch_types:
+        return
+    stream=(variable,version,type)
+    position=(year,month if version[0]=='4' else None)
+    _prefetcher.access(stream,position)
+    error=_prefetcher.wait_for(stream,position)
+    if error is not None:
+        print("Read-ahead of %s %s failed: %s" % (variable,position,error))
@@ -0,0 +1,238 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Rewrite fetched netCDF files for fast reads of one time.
+
+The version 2 files are a year long, and not laid out for reading
+one 6-hourly field (all members, whole grid). These functions
+rewrite a file as netCDF4 with one chunk per time, compressed,
+keeping all the dimensions, variables and attributes - so
+get_slice_at_hour etc. read it just as before.
+
+Needs the netCDF4 package (only imported when used).
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+import random
+import multiprocessing
+
+from scratch.lazy import netCDF4
+from scratch.catalogue import get_catalogue
+from scratch.manifest import record_verified
+
+def get_time_dim(dataset,variable):
+    """The time dimension of a variable (None if it has none)."""
+    for name in variable.dimensions:
+        if name=='time' or dataset.dimensions[name].isunlimited():
+            return name
+    return None
+
+def get_time_slice_chunks(dataset,variable):
+    """Chunk sizes for a variable - 1 along time, whole along the
+       others (None if it doesn't vary in time)."""
+    time_dim=get_time_dim(dataset,variable)
+    if time_dim is None or len(variable.dimensions)<2:
+        return None
+    return [1 if name==time_dim else max(1,len(dataset.dimensions[name]))
+            for name in variable.dimensions]
+
+def is_rechunked(file_name):
+    """True if a file already has one chunk per time."""
+    with netCDF4.Dataset(file_name) as dataset:
+        for variable in dataset.variables.values():
+            chunks=get_time_slice_chunks(dataset,variable)
+            if chunks is not None and variable.chunking()!=chunks:
+                return False
+    return True
+
+def copy_variable(source,target,name,complevel):
+    """Copy one variable (with its attributes) - a time at a time."""
+    variable=source.variables[name]
+    chunks=get_time_slice_chunks(source,variable)
+    attributes=dict((a,variable.getncattr(a)) for a in variable.ncattrs())
+    fill_value=attributes.pop('_FillValue',None)
+    copy=target.createVariable(name,variable.datatype,variable.dimensions,
+                               zlib=complevel>0,complevel=max(complevel,1),
+                               shuffle=complevel>0,chunksizes=chunks,
+                               fill_value=fill_value)
+    copy.setncatts(attributes)
+    # Copy the stored values (packed, unmasked) - no conversions
+    variable.set_auto_maskandscale(False)
+    copy.set_auto_maskandscale(False)
+    if chunks is None:
+        copy[...]=variable[...]
+        return
+    time_index=variable.dimensions.index(get_time_dim(source,variable))
+    for i in range(variable.shape[time_index]):
+        index=[slice(None)]*len(variable.dimensions)
+        index[time_index]=i
+        copy[tuple(index)]=variable[tuple(index)]
+
+def rechunk_file(file_name,complevel=4):
+    """Rewrite a netCDF file, in place, as netCDF4 with one chunk per
+       time and compression level 'complevel' (0 for none). The new
+       file is written alongside and renamed into place when done."""
+    tmp_file="%s.%d.tmp" % (file_name,os.getpid())
+    try:
+        with netCDF4.Dataset(file_name) as source:
+            with netCDF4.Dataset(tmp_file,'w',format='NETCDF4') as target:
+                target.setncatts(dict((a,source.getncattr(a))
+                                      for a in source.ncattrs()))
+                for name,dimension in source.dimensions.items():
+                    target.createDimension(name,None if
+                                      dimension.isunlimited() else
+                                      len(dimension))
+                for name in source.variables:
+                    copy_variable(source,target,name,complevel)
+    except Exception:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    os.rename(tmp_file,file_name)
+    try:
+        record_verified(file_name)
+    except (IOError,OSError):
+        pass   # Can't write the manifest - will be checked on next use
+
+# posix_fadvise advice to drop cached pages (Linux value)
+POSIX_FADV_DONTNEED=4
+
+def get_posix_fadvise():
+    """posix_fadvise from the C library (Python 2's os module doesn't
+       have it) - None if there isn't one (e.g. OS X)."""
+    try:
+        libc=ctypes.CDLL(ctypes.util.find_library('c'))
+        fadvise=libc.posix_fadvise
+    except (OSError,AttributeError):
+        return None
+    fadvise.argtypes=[ctypes.c_int,ctypes.c_long,ctypes.c_long,ctypes.c_int]
+    return fadvise
+
+def drop_page_cache(file_name):
+    """Ask the OS to forget its cached copy of a file, so the next
+       read comes from disc. Returns False if that can't be done."""
+    fadvise=get_posix_fadvise()
+    if fadvise is None:
+        return False
+    fd=os.open(file_name,os.O_RDONLY)
+    try:
+        os.fsync(fd)   # Dirty pages aren't dropped
+        return fadvise(fd,0,0,POSIX_FADV_DONTNEED)==0
+    finally:
+        os.close(fd)
+
+def time_slice_reads(file_name,count=4,seed=0):
+    """Mean time (seconds) to read one time of the biggest variable in
+       a file - the read get_slice_at_hour does."""
+    with netCDF4.Dataset(file_name) as dataset:
+        variables=[v for v in dataset.variables.values()
+                   if get_time_slice_chunks(dataset,v) is not None]
+        if len(variables)==0:
+            return None
+        variable=max(variables,key=lambda v: v.size)
+        time_index=variable.dimensions.index(get_time_dim(dataset,variable))
+        n_times=variable.shape[time_index]
+        rng=random.Random(seed)
+        start=time.time()
+        for i in range(count):
+            index=[slice(None)]*len(variable.dimensions)
+            index[time_index]=rng.randrange(n_times)
+            variable[tuple(index)]
+        return (time.time()-start)/count
+
+def rechunk_if_needed(file_name,complevel=4,measure=False):
+    """Rechunk a file unless that's already been done. Returns a dict
+       with the file's 'status' (rechunked, unchanged or failed),
+       'error', 'bytes_before' and 'bytes_after', and (if 'measure')
+       the mean time to read a time slice 'read_before' and
+       'read_after'. The page cache is dropped before each (see
+       drop_page_cache) so the reads are from disc; if it can't be,
+       'read_warm' is True - the times are reads of cached data."""
+    result={'file':file_name,'error':None,
+            'read_before':None,'read_after':None,'read_warm':False}
+    result['bytes_before']=os.path.getsize(file_name)
+    try:
+        if is_rechunked(file_name):
+            result['status']='unchanged'
+        else:
+            if measure:
+                if not drop_page_cache(file_name):
+                    result['read_warm']=True
+                result['read_before']=time_slice_reads(file_name)
+            rechunk_file(file_name,complevel)
+            if measure:
+                if not drop_page_cache(file_name):
+                    result['read_warm']=True
+                result['read_after']=time_slice_reads(file_name)
+            result['status']='rechunked'
+    except (IOError,OSError,RuntimeError) as e:
+        result['status']='failed'
+        result['error']=str(e)
+    result['bytes_after']=os.path.getsize(file_name)
+    return result
+
+def _rechunk_if_needed(args):
+    # Pool.map takes one argument
+    return rechunk_if_needed(*args)
+
+def rechunk_files(file_names,complevel=4,measure=True,processes=4):
+    """Rechunk a list of files, one per process. Returns the list of
+       results from rechunk_if_needed, and prints a summary."""
+    pool=multiprocessing.Pool(processes)
+    try:
+        results=pool.map(_rechunk_if_needed,
+                         [(f,complevel,measure) for f in file_names])
+    finally:
+        pool.close()
+        pool.join()
+    report_rechunk_summary(results)
+    return results
+
+def rechunk_backlog(version,type='ensemble',variable=None,complevel=4,
+                    measure=True,processes=4):
+    """Rechunk all the files of a version (and type, and variable if
+       given) already fetched to $SCRATCH (found from the catalogue -
+       see scratch.catalogue)."""
+    criteria={'dataset':'20CR','version':version,'type':type}
+    if variable is not None:
+        criteria['variable']=variable
+    file_names=sorted(entry['file_name'] for entry in
+                      get_catalogue(refresh=True).entries(**criteria))
+    return rechunk_files(file_names,complevel,measure,processes)
+
+def report_rechunk_summary(results):
+    """Print the sizes and read times before and after rechunking."""
+    done=[r for r in results if r['status']=='rechunked']
+    print("Rechunked %d of %d files, %d already done, %d failed" %
+          (len(done),len(results),
+           len([r for r in results if r['status']=='unchanged']),
+           len([r for r in results if r['status']=='failed'])))
+    if len(done)==0:
+        return
+    before=sum(r['bytes_before'] for r in done)
+    after=sum(r['bytes_after'] for r in done)
+    print("Size %.1f MB -> %.1f MB" % (before/1.0e6,after/1.0e6))
+    timed=[r for r in done if r['read_before'] is not None and
+                              r['read_after'] is not None]
+    if len(timed)==0:
+        return
+    read_before=sum(r['read_before'] for r in timed)/len(timed)
+    read_after=sum(r['read_after'] for r in timed)/len(timed)
+    print("Time slice read %.1f ms -> %.1f ms (x%.1f speed)%s" %
+          (read_before*1000,read_after*1000,
+           read_before/max(read_after,1.0e-9),
+           " - warm reads (page cache not dropped)"
+           if any(r['read_warm'] for r in timed) else ""))
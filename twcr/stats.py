@@ -0,0 +1,227 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Streaming ensemble statistics.
+
+Statistics over all members and times in a period are accumulated
+one block of fields at a time, so memory use does not depend on the
+length of the period. Partial statistics (e.g. for separate months)
+can be merged.
+"""
+
+import datetime
+import multiprocessing
+from scratch.lazy import numpy as np
+
+from .load import get_field_times
+from .load import get_slices_for_range
+from .load import iter_data_blocks
+
+class EnsembleStats(object):
+    """Running statistics at each grid point.
+
+       Always: count, mean and variance (Welford/Chan updates).
+       Optionally:
+        thresholds - count of values over each threshold
+                     (for exceedance probabilities).
+        bins - edges of a histogram of values (for quantiles).
+        n_members - size of a rank histogram: the rank of a reference
+                    field (e.g. observations) among the members. (If
+                    not given, it's set by the first update with a
+                    reference.)"""
+
+    def __init__(self,thresholds=(),bins=None,n_members=None):
+        self.thresholds=np.array(thresholds,dtype=np.float64)
+        self.bins=None if bins is None else np.asarray(bins,dtype=np.float64)
+        self.n_members=n_members
+        self.count=None
+        self.mean=None
+        self.m2=None
+        self.exceedances=None
+        self.histogram=None
+        self.ranks=None if n_members is None else np.zeros(n_members+1,
+                                                           dtype=np.int64)
+
+    def update(self,values,reference=None):
+        """Add a batch of fields: 'values' is (n,...) - n fields
+           (members and/or times) on the same grid. If this has a rank
+           histogram, 'values' must be the members at one time, and
+           'reference' the matching reference field."""
+        values=np.ma.filled(values,np.nan).astype(np.float64)
+        valid=np.isfinite(values)
+        count=valid.sum(axis=0)
+        if self.count is None:
+            shape=values.shape[1:]
+            self.count=np.zeros(shape,dtype=np.int64)
+            self.mean=np.zeros(shape)
+            self.m2=np.zeros(shape)
+            self.exceedances=np.zeros((len(self.thresholds),)+shape,
+                                      dtype=np.int64)
+            if self.bins is not None:
+                self.histogram=np.zeros((len(self.bins)+1,)+shape,
+                                        dtype=np.int64)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean=np.where(count>0,np.nansum(values,axis=0)/count,0)
+            m2=np.nansum((values-mean)**2,axis=0)
+        self.combine(count,mean,m2)
+        for i,threshold in enumerate(self.thresholds):
+            self.exceedances[i]+=(values>threshold).sum(axis=0)
+        if self.bins is not None:
+            # Bin 0 is below the first edge, bin len(bins) above the last
+            bin_index=np.searchsorted(self.bins,values,side='right')
+            n_points=self.count.size
+            flat=(bin_index.reshape(len(values),-1)*n_points+
+                  np.arange(n_points))[valid.reshape(len(values),-1)]
+            self.histogram+=np.bincount(flat,
+                       minlength=self.histogram.size).reshape(
+                                                 self.histogram.shape)
+        if reference is not None:
+            if self.ranks is None:
+                self.n_members=len(values)
+                self.ranks=np.zeros(self.n_members+1,dtype=np.int64)
+            if len(values)!=self.n_members:
+                raise StandardError("Rank histogram is for %d members, not %d"
+                                    % (self.n_members,len(values)))
+            below=(values<reference).sum(axis=0)
+            use=np.isfinite(reference) & (count==len(values))
+            self.ranks+=np.bincount(below[use],
+                                    minlength=len(self.ranks))
+
+    def combine(self,count,mean,m2):
+        """Combine partial moments (Chan et al.) into these."""
+        total=self.count+count
+        with np.errstate(invalid='ignore',divide='ignore'):
+            delta=mean-self.mean
+            fraction=np.where(total>0,count/total.astype(np.float64),0)
+            self.mean=self.mean+delta*fraction
+            self.m2=self.m2+m2+delta**2*self.count*fraction
+        self.count=total
+
+    def merge(self,other):
+        """Add in the statistics from another EnsembleStats (with the
+           same thresholds and bins)."""
+        if other.count is None:
+            return self
+        if self.count is None:
+            self.count=np.zeros_like(other.count)
+            self.mean=np.zeros_like(other.mean)
+            self.m2=np.zeros_like(other.m2)
+            self.exceedances=np.zeros_like(other.exceedances)
+            if other.histogram is not None:
+                self.histogram=np.zeros_like(other.histogram)
+        self.combine(other.count,other.mean,other.m2)
+        self.exceedances+=other.exceedances
+        if self.histogram is not None:
+            self.histogram+=other.histogram
+        if other.ranks is not None:
+            if self.ranks is None:
+                self.n_members=other.n_members
+                self.ranks=np.zeros_like(other.ranks)
+            self.ranks+=other.ranks
+        return self
+
+    def variance(self):
+        """Sample variance at each point."""
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return np.where(self.count>1,self.m2/(self.count-1),np.nan)
+
+    def standard_deviation(self):
+        return np.sqrt(self.variance())
+
+    def exceedance_probability(self,threshold):
+        """Fraction of values over one of the thresholds."""
+        i=list(self.thresholds).index(threshold)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            return self.exceedances[i]/self.count.astype(np.float64)
+
+    def quantile(self,q):
+        """Estimate a quantile (0-1) at each point from the histogram,
+           interpolating linearly within bins. Values outside the range
+           of the bins are put at the end bins' edges."""
+        if self.histogram is None:
+            raise StandardError("Quantiles need histogram bins")
+        cumulative=np.cumsum(self.histogram,axis=0)
+        target=q*self.count
+        # First bin where the cumulative count reaches the target
+        bin_index=(cumulative<target).sum(axis=0)
+        bin_index=np.clip(bin_index,1,len(self.bins)-1)
+        lower=self.bins[bin_index-1]
+        upper=self.bins[bin_index]
+        before=np.take_along_axis(cumulative,(bin_index-1)[np.newaxis],
+                                  axis=0)[0]
+        in_bin=np.take_along_axis(self.histogram,bin_index[np.newaxis],
+                                  axis=0)[0]
+        with np.errstate(invalid='ignore',divide='ignore'):
+            fraction=np.clip(np.where(in_bin>0,(target-before)/in_bin,0),
+                             0,1)
+        return lower+fraction*(upper-lower)
+
+def accumulate_stats(variable,start,end,version,type='ensemble',
+                     thresholds=(),bins=None,member=None,region=None,
+                     block_size=8,reference=None):
+    """Statistics, over all members and data timesteps, between
+       start and end (start<=time<end).
+
+       If 'reference' (a cube with a field for each of the same times,
+       on the same grid) is given, the rank histogram of the reference
+       among the members is made too."""
+    stats=EnsembleStats(thresholds,bins)
+    cube=get_slices_for_range(variable,start,end,version,type,
+                              member,region)
+    if reference is None:
+        for first,last,block in iter_data_blocks(cube,block_size):
+            stats.update(block.reshape((-1,)+block.shape[2:]))
+        return stats
+    if (reference.shape[reference.coord_dims('time')[0]]!=
+            cube.shape[cube.coord_dims('time')[0]]):
+        raise StandardError("Reference doesn't have the same times")
+    reference_blocks=iter_data_blocks(reference,block_size)
+    for first,last,block in iter_data_blocks(cube,block_size):
+        reference_block=next(reference_blocks)[2]
+        # Ranks are per time - one update for each
+        for i in range(last-first):
+            stats.update(block[i],reference=reference_block[i,0])
+    return stats
+
+def _accumulate_stats(args):
+    # Pool.map takes one argument
+    return accumulate_stats(*args)
+
+def accumulate_stats_by_month(variable,start,end,version,type='ensemble',
+                              thresholds=(),bins=None,member=None,
+                              region=None,processes=4):
+    """As accumulate_stats, but each calendar month is done
+       separately (in parallel), and the results merged."""
+    periods=[]
+    period_start=start
+    while period_start<end:
+        if period_start.month==12:
+            period_end=datetime.datetime(period_start.year+1,1,1)
+        else:
+            period_end=datetime.datetime(period_start.year,
+                                         period_start.month+1,1)
+        if len(get_field_times(period_start,min(period_end,end),
+                               version))>0:
+            periods.append((variable,period_start,min(period_end,end),
+                            version,type,thresholds,bins,member,region))
+        period_start=period_end
+    pool=multiprocessing.Pool(processes)
+    try:
+        partials=pool.map(_accumulate_stats,periods)
+    finally:
+        pool.close()
+        pool.join()
+    stats=EnsembleStats(thresholds,bins)
+    for partial in partials:
+        stats.merge(partial)
+    return stats
@@ -0,0 +1,295 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+A memory-mapped array store for 20CR data.
+
+A variable (of one version and type) is converted from netCDF into
+one .npy file per year, plus a small JSON index. Reads then use
+numpy memory maps - no netCDF decoding, and processes reading
+the same data share the page cache.
+
+Two layouts are supported:
+ 'time'  - arrays are (time,member,lat,lon): fast for whole fields.
+ 'point' - arrays are (lat,lon,member,time): fast for time-series
+           at a point.
+"""
+
+import os
+import json
+import datetime
+from scratch.lazy import iris
+from scratch.lazy import numpy as np
+
+from .load import get_data_dir
+from .load import get_data_file_name
+from .load import get_field_step
+from .load import get_slices_for_range
+from .load import get_member_dim
+from .load import iter_data_blocks
+
+Store_layouts=('time','point')
+
+# Index files already read - keyed on (variable,version,type,layout)
+_store_indices={}
+
+def get_store_dir(variable,version,type='ensemble',layout='time'):
+    """Directory holding the store for a variable."""
+    if layout not in Store_layouts:
+        raise StandardError("Unsupported store layout %s" % layout)
+    return "%s/store/%s/%s/%s" % (get_data_dir(version),type,
+                                  variable,layout)
+
+def get_store_index(variable,version,type='ensemble',layout='time'):
+    """The index of a store - None if there's no store."""
+    key=(variable,version,type,layout)
+    if key not in _store_indices:
+        try:
+            index_file="%s/index.json" % get_store_dir(variable,version,
+                                                       type,layout)
+        except IOError:
+            return None   # No data directory
+        if not os.path.isfile(index_file):
+            return None   # Not cached - the store may be made later
+        with open(index_file) as f:
+            _store_indices[key]=json.load(f)
+    return _store_indices[key]
+
+def get_store_sources(variable,year,version,type='ensemble'):
+    """Modification time and size of each netCDF file a year's chunk
+       is made from - a list of [mtime,size] ([-1,-1] for a missing
+       file)."""
+    file_names=[]
+    for month in range(1,13):
+        file_name=get_data_file_name(variable,year,month,1,0,version,type)
+        if file_name not in file_names:
+            file_names.append(file_name)
+    sources=[]
+    for file_name in file_names:
+        try:
+            source=os.stat(file_name)
+            sources.append([source.st_mtime,source.st_size])
+        except OSError:
+            sources.append([-1,-1])
+    return sources
+
+def is_chunk_current(index,variable,year,version,type='ensemble'):
+    """True if a year's chunk is in the store, and the netCDF files it
+       was made from haven't changed since (a re-fetched file makes
+       the chunk out of date)."""
+    chunk=index['chunks'].get("%04d" % year)
+    if chunk is None:
+        return False
+    return chunk.get('sources')==get_store_sources(variable,year,
+                                                   version,type)
+
+def convert_to_store(variable,year,version,type='ensemble',
+                     layout='time',block_size=8,band_bytes=2**28):
+    """Copy a year's data from netCDF into the store.
+
+       Data are read 'block_size' timesteps at a time, so memory use
+       stays small. For the 'point' layout, a band of latitudes (of
+       up to 'band_bytes') is put together in memory, and written
+       once."""
+    store_dir=get_store_dir(variable,version,type,layout)
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    sources=get_store_sources(variable,year,version,type)
+    span=get_slices_for_range(variable,datetime.datetime(year,1,1),
+                              datetime.datetime(year+1,1,1),
+                              version,type)
+    time_dim=span.coord_dims('time')[0]
+    try:
+        n_member=span.shape[get_member_dim(span)]
+    except StandardError:
+        n_member=1   # No members (mean or spread)
+    n_time=span.shape[time_dim]
+    shape=(n_time,n_member,span.shape[span.coord_dims('latitude')[0]],
+           span.shape[span.coord_dims('longitude')[0]])
+    if layout=='point':
+        shape=(shape[2],shape[3],shape[1],shape[0])
+    chunk_file="%s/%04d.npy" % (store_dir,year)
+    tmp_file="%s.%d.tmp" % (chunk_file,os.getpid())
+    chunk=np.lib.format.open_memmap(tmp_file,mode='w+',
+                                    dtype=span.dtype,shape=shape)
+    if layout=='time':
+        for first,last,block in iter_data_blocks(span,block_size):
+            chunk[first:last]=block
+    else:
+        # Time varies fastest, so writing a block of times would touch
+        #  every page of the file - write whole latitude bands instead.
+        lat_dim=span.coord_dims('latitude')[0]
+        row_bytes=shape[1]*shape[2]*shape[3]*chunk.dtype.itemsize
+        band_rows=max(1,int(band_bytes//row_bytes))
+        for lat_first in range(0,shape[0],band_rows):
+            lat_last=min(shape[0],lat_first+band_rows)
+            keys=[slice(None)]*span.ndim
+            keys[lat_dim]=slice(lat_first,lat_last)
+            band=np.empty((lat_last-lat_first,)+shape[1:],dtype=chunk.dtype)
+            for first,last,block in iter_data_blocks(span[tuple(keys)],
+                                                     block_size):
+                band[:,:,:,first:last]=np.transpose(block,(2,3,1,0))
+            chunk[lat_first:lat_last]=band
+    chunk.flush()
+    del chunk
+    os.rename(tmp_file,chunk_file)
+    time_coord=span.coord('time')
+    first=time_coord.units.num2date(time_coord.points[0])
+    update_store_index(variable,version,type,layout,span,year,
+                       datetime.datetime(first.year,first.month,first.day,
+                                         first.hour),n_time,n_member,sources)
+
+def update_store_index(variable,version,type,layout,cube,year,
+                       first,n_time,n_member,sources=None):
+    """Add a year's chunk to the index of a store - with the 'sources'
+       it was made from (see get_store_sources)."""
+    store_dir=get_store_dir(variable,version,type,layout)
+    index_file="%s/index.json" % store_dir
+    index=None
+    if os.path.isfile(index_file):
+        with open(index_file) as f:
+            index=json.load(f)
+    if index is None:
+        index={'variable':variable,'version':version,'type':type,
+               'layout':layout,
+               'step':get_field_step(version),
+               'n_member':n_member,
+               'latitude':cube.coord('latitude').points.tolist(),
+               'longitude':cube.coord('longitude').points.tolist(),
+               'standard_name':cube.standard_name,
+               'long_name':cube.long_name,
+               'var_name':cube.var_name,
+               'units':str(cube.units),
+               'time_units':str(cube.coord('time').units),
+               'chunks':{}}
+    index['chunks']["%04d" % year]={'first':first.strftime("%Y%m%d%H"),
+                                    'n_time':n_time,'sources':sources}
+    tmp_file="%s.%d.tmp" % (index_file,os.getpid())
+    with open(tmp_file,'w') as f:
+        json.dump(index,f)
+    os.rename(tmp_file,index_file)
+    _store_indices.pop((variable,version,type,layout),None)
+
+def get_store_time_index(index,dt):
+    """Chunk year and index in that chunk for a time - or None if the
+       time isn't in the store."""
+    chunk=index['chunks'].get("%04d" % dt.year)
+    if chunk is None:
+        return None
+    first=datetime.datetime.strptime(chunk['first'],"%Y%m%d%H")
+    offset=(dt-first).total_seconds()/3600.0
+    if offset<0 or offset%index['step']!=0:
+        return None
+    idx=int(offset/index['step'])
+    if idx>=chunk['n_time']:
+        return None
+    return (dt.year,idx)
+
+def open_store_chunk(variable,version,type,layout,year):
+    """Memory map of one year of a store (read-only)."""
+    return np.load("%s/%04d.npy" % (get_store_dir(variable,version,
+                                                   type,layout),year),
+                   mmap_mode='r')
+
+def get_slice_from_store(variable,year,month,day,hour,version,
+                         type='ensemble'):
+    """Get the cube for one data timestep from the store - or None
+       if there is no store with that time in it."""
+    dt=datetime.datetime(year,month,day,int(hour))
+    for layout in Store_layouts:
+        index=get_store_index(variable,version,type,layout)
+        if index is None:
+            continue
+        location=get_store_time_index(index,dt)
+        if location is None or not is_chunk_current(index,variable,
+                                                    location[0],version,
+                                                    type):
+            continue
+        chunk=open_store_chunk(variable,version,type,layout,location[0])
+        # Copy out of the (read-only) memory map
+        if layout=='time':
+            data=np.array(chunk[location[1]])
+        else:
+            data=np.transpose(chunk[:,:,:,location[1]],(2,0,1)).copy()
+        return make_store_cube(index,data,dt)
+    return None
+
+def make_store_cube(index,data,dt):
+    """Make an iris cube from (member,lat,lon) data from the store."""
+    if index['n_member']==1:
+        data=data[0]
+    cube=iris.cube.Cube(data,standard_name=index['standard_name'],
+                        long_name=index['long_name'],
+                        var_name=index['var_name'],
+                        units=index['units'])
+    dim=0
+    if index['n_member']>1:
+        cube.add_dim_coord(iris.coords.DimCoord(
+                               np.arange(index['n_member']),
+                               long_name='member'),0)
+        dim=1
+    cube.add_dim_coord(iris.coords.DimCoord(
+                           np.array(index['latitude']),
+                           standard_name='latitude',
+                           units='degrees'),dim)
+    cube.add_dim_coord(iris.coords.DimCoord(
+                           np.array(index['longitude']),
+                           standard_name='longitude',
+                           units='degrees'),dim+1)
+    time_coord=iris.coords.DimCoord([0],standard_name='time',
+                                    units=index['time_units'])
+    time_coord.points=[time_coord.units.date2num(dt)]
+    cube.add_aux_coord(time_coord)
+    return cube
+
+def get_point_series_from_store(variable,lat,lon,start,end,version,
+                                type='ensemble'):
+    """Time-series, at the grid point nearest to lat:lon, of all the
+       data timesteps between start and end (start<=time<end).
+
+       Returns a tuple of (times,data) where data is (time,member)."""
+    layouts=('point','time')
+    for layout in layouts:
+        index=get_store_index(variable,version,type,layout)
+        if index is not None:
+            break
+    else:
+        raise StandardError("No store for %s %s %s" % (variable,version,type))
+    lat_idx=np.argmin(np.abs(np.array(index['latitude'])-lat))
+    lon_idx=np.argmin(np.abs((np.array(index['longitude'])-lon+180)%360-180))
+    times=[]
+    series=[]
+    # end is excluded - a period ending on 1st January needs no data
+    #  from that year
+    last=end-datetime.timedelta(microseconds=1)
+    for year in range(start.year,last.year+1):
+        if not is_chunk_current(index,variable,year,version,type):
+            raise StandardError("No data for %04d in store (or out of date)"
+                                % year)
+        chunk_info=index['chunks']["%04d" % year]
+        first=datetime.datetime.strptime(chunk_info['first'],"%Y%m%d%H")
+        chunk_times=[first+datetime.timedelta(hours=index['step']*i)
+                     for i in range(chunk_info['n_time'])]
+        wanted=[i for i,t in enumerate(chunk_times) if start<=t<end]
+        if len(wanted)==0:
+            continue
+        chunk=open_store_chunk(variable,version,type,layout,year)
+        if layout=='point':
+            data=chunk[lat_idx,lon_idx,:,wanted[0]:wanted[-1]+1].T
+        else:
+            data=chunk[wanted[0]:wanted[-1]+1,:,lat_idx,lon_idx]
+        times.extend(chunk_times[wanted[0]:wanted[-1]+1])
+        series.append(np.array(data))
+    if len(series)==0:
+        raise StandardError("No data between %s and %s in store" %
+                            (start,end))
+    return (times,np.concatenate(series))
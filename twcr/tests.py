@@ -0,0 +1,874 @@
+# (C) British Crown Copyright 2017, Met Office
+#
+# This code is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the
+# Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+"""
+Test cases for the twcr module.
+
+Run python on this file to run all the tests.
+"""
+import twcr
+import twcr.benchmarks
+import os
+import sys
+import time
+import datetime
+import contextlib
+import numpy
+import pandas
+import shutil
+import tempfile
+import unittest
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4=None   # Rechunking not tested
+
+def set_scratch(dir_name):
+    """Point $SCRATCH at a different directory (None to unset it).
+       Returns the old value."""
+    old=os.environ.get('SCRATCH')
+    if dir_name is None:
+        os.environ.pop('SCRATCH',None)
+    else:
+        os.environ['SCRATCH']=dir_name
+    return old
+
+class StandInCoord(object):
+    """Enough of an iris coordinate for the stand-in cubes. Times are
+       hours since 1970."""
+
+    def __init__(self,name,points,bounds=None):
+        self._name=name
+        self.points=numpy.asarray(points)
+        self.bounds=bounds
+        self.units=self
+
+    def name(self):
+        return self._name
+
+    def date2num(self,dt):
+        return (dt-datetime.datetime(1970,1,1)).total_seconds()/3600.0
+
+    def num2date(self,hours):
+        dates=[datetime.datetime(1970,1,1)+datetime.timedelta(hours=float(h))
+               for h in numpy.atleast_1d(hours)]
+        if numpy.ndim(hours)==0:
+            return dates[0]
+        return dates
+
+class StandInCube(object):
+    """Enough of an iris cube for the functions tested - 'coords' is
+       a list of (coordinate, dimension)."""
+
+    def __init__(self,data,coords,units=None):
+        self.data=numpy.asarray(data)
+        self._coords=coords
+        self.units=units
+        self.standard_name=None
+        self.long_name=None
+        self.var_name=None
+        self.cell_methods=[]
+
+    @property
+    def ndim(self):
+        return self.data.ndim
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def coord(self,name):
+        for coord,dim in self._coords:
+            if coord.name()==name:
+                return coord
+        raise StandInIris.exceptions.CoordinateNotFoundError(name)
+
+    def coords(self,dimensions=None):
+        return [coord for coord,dim in self._coords
+                if dimensions is None or dim==dimensions]
+
+    def add_cell_method(self,method):
+        self.cell_methods.append(method)
+
+    def remove_coord(self,name):
+        self._coords=[(coord,dim) for coord,dim in self._coords
+                      if coord.name()!=name]
+
+    def coord_dims(self,coord):
+        if not isinstance(coord,StandInCoord):
+            coord=self.coord(coord)
+        for c,dim in self._coords:
+            if c is coord:
+                return () if dim is None else (dim,)
+
+    def __getitem__(self,keys):
+        coords=[]
+        for coord,dim in self._coords:
+            if dim is not None:
+                key=keys[dim]
+                bounds=coord.bounds
+                if bounds is not None:
+                    bounds=numpy.asarray(bounds)[key]
+                coord=StandInCoord(coord.name(),
+                                   numpy.atleast_1d(coord.points[key]),
+                                   bounds)
+                if isinstance(key,int):
+                    dim=None
+                else:
+                    dim=len([k for k in keys[:dim]
+                             if not isinstance(k,int)])
+            coords.append((coord,dim))
+        return StandInCube(numpy.array(self.data[keys]),coords,self.units)
+
+    def copy(self,data=None):
+        cube=self[(slice(None),)*self.ndim]
+        if data is not None:
+            cube.data=data
+        return cube
+
+class StandInIris(object):
+    """Stand-in for iris, so the loading functions can be tested without
+       data files: load_cube returns 'cube' (or raises ConstraintMismatchError
+       if it's None) and counts the calls."""
+
+    class exceptions(object):
+        class CoordinateNotFoundError(KeyError):
+            pass
+        class ConstraintMismatchError(Exception):
+            pass
+
+    class time(object):
+        PartialDateTime=dict
+
+    class coords(object):
+        CellMethod=staticmethod(lambda method,coords: (method,coords))
+
+    class FUTURE(object):
+        @staticmethod
+        @contextlib.contextmanager
+        def context(**kwargs):
+            yield
+
+    def __init__(self,cube=None):
+        self.cube=cube
+        self.loads=0
+
+    def Constraint(self,**kwargs):
+        return kwargs
+
+    def load_cube(self,file_name,constraint=None):
+        self.loads+=1
+        if self.cube is None:
+            raise self.exceptions.ConstraintMismatchError(file_name)
+        return self.cube.copy()
+
+class TestTWCR(unittest.TestCase):
+
+    def test_cache_lru(self):
+        c=twcr.ByteLRUCache(max_bytes=10)
+        c.put('a',1,4)
+        c.put('b',2,4)
+        self.assertEqual(c.get('a'),1)   # 'a' now most recent
+        c.put('c',3,4)                   # Over budget - drops 'b'
+        self.assertIsNone(c.get('b'))
+        self.assertEqual(c.get('c'),3)
+        self.assertEqual(c.stats()['bytes'],8)
+        self.assertEqual(c.stats()['hits'],2)
+        self.assertEqual(c.stats()['misses'],1)
+
+    def test_cache_too_big(self):
+        c=twcr.ByteLRUCache(max_bytes=10)
+        c.put('a',1,11)
+        self.assertFalse('a' in c)
+        self.assertEqual(c.stats()['bytes'],0)
+
+    def test_cache_invalidate(self):
+        c=twcr.ByteLRUCache(max_bytes=100)
+        c.put(('f1',1),1,4)
+        c.put(('f2',1),2,4)
+        c.invalidate(lambda key: key[0]=='f1')
+        self.assertFalse(('f1',1) in c)
+        self.assertTrue(('f2',1) in c)
+        c.resize(0)
+        self.assertEqual(len(c),0)
+
+    def test_slice_cache(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        file_name=twcr.get_data_file_name('prmsl',1903,1,1,6,'4.5.1')
+        os.makedirs(os.path.dirname(file_name))
+        open(file_name,'w').close()
+        stand_in=StandInIris(StandInCube(numpy.zeros((2,3)),[]))
+        iris=twcr.load.iris
+        twcr.load.iris=stand_in
+        twcr.clear_slice_cache()
+        hits=twcr.get_slice_cache_stats()['hits']
+        try:
+            for i in range(2):
+                twcr.get_slice_at_hour_at_timestep('prmsl',1903,1,1,6,
+                                                   '4.5.1')
+            self.assertEqual(stand_in.loads,1)
+            self.assertEqual(twcr.get_slice_cache_stats()['hits'],hits+1)
+            # Sized from the shape and type (2x3 float64)
+            self.assertEqual(twcr.get_slice_cache_stats()['bytes'],48)
+            # No data - the error is passed on, and nothing cached
+            stand_in.cube=None
+            with self.assertRaises(
+                         StandInIris.exceptions.ConstraintMismatchError):
+                twcr.get_slice_at_hour_at_timestep('prmsl',1903,1,1,9,
+                                                   '4.5.1')
+            self.assertEqual(twcr.get_slice_cache_stats()['items'],1)
+        finally:
+            twcr.load.iris=iris
+            twcr.clear_slice_cache()
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_get_field_times(self):
+        times=twcr.get_field_times(datetime.datetime(1987,3,31,13),
+                                   datetime.datetime(1987,4,1,6),
+                                   '3.5.1')
+        self.assertEqual(times,[datetime.datetime(1987,3,31,18),
+                                datetime.datetime(1987,4,1,0)])
+        times=twcr.get_field_times(datetime.datetime(1987,3,31,12),
+                                   datetime.datetime(1987,3,31,18),
+                                   '4.5.1')
+        self.assertEqual(times,[datetime.datetime(1987,3,31,12),
+                                datetime.datetime(1987,3,31,15)])
+
+    def test_interpolation_weights(self):
+        times=[datetime.datetime(1903,1,1,6),
+               datetime.datetime(1903,1,1,7,30),
+               datetime.datetime(1903,1,1,23)]
+        previous,next_step,weight=twcr.get_interpolation_weights(times,
+                                                                 '4.5.1')
+        self.assertEqual(list(previous.astype(datetime.datetime)),
+                         [datetime.datetime(1903,1,1,6),
+                          datetime.datetime(1903,1,1,6),
+                          datetime.datetime(1903,1,1,21)])
+        self.assertEqual(next_step[2].astype(datetime.datetime),
+                         datetime.datetime(1903,1,2,0))
+        self.assertTrue(numpy.allclose(weight,[0,0.5,2.0/3]))
+
+    def test_slices_at_times(self):
+        start=datetime.datetime(1903,1,1,6)
+        hours=StandInCoord('time',[]).date2num(start)+numpy.arange(3)*3
+        span=StandInCube(numpy.arange(3*2,dtype=float).reshape(3,2),
+                         [(StandInCoord('time',hours,
+                                        numpy.transpose([hours-1.5,
+                                                         hours+1.5])),0)])
+        def get_slices_for_range(variable,start,end,version,type,
+                                 member,region):
+            return span
+        get_span=twcr.load.get_slices_for_range
+        twcr.load.get_slices_for_range=get_slices_for_range
+        try:
+            frames=list(twcr.iter_slices_at_times('prmsl',
+                             [start,start+datetime.timedelta(hours=4),
+                              start+datetime.timedelta(hours=6)],'4.5.1'))
+        finally:
+            twcr.load.get_slices_for_range=get_span
+        self.assertTrue(numpy.allclose([f.data for f in frames],
+                                       [[0,1],[8.0/3,11.0/3],[4,5]]))
+        self.assertEqual([f.coord('time').points[0] for f in frames],
+                         [hours[0],hours[0]+4,hours[2]])
+        # Interpolated or not, none have bounds - so they will merge
+        self.assertEqual([f.coord('time').bounds for f in frames],
+                         [None]*3)
+
+    def test_subset_cube(self):
+        cube=StandInCube(numpy.arange(3*4*6).reshape(3,4,6),
+                         [(StandInCoord('latitude',[60,30,0,-30]),1),
+                          (StandInCoord('longitude',numpy.arange(0,360,60)),2),
+                          (StandInCoord('time',[0]),None)])
+        self.assertEqual(twcr.get_member_dim(cube),0)
+        with self.assertRaises(StandardError):
+            twcr.get_member_dim(cube[0,:,:])
+        iris=twcr.load.iris
+        twcr.load.iris=StandInIris()
+        try:
+            subset=twcr.subset_cube(cube,member=[0,2],
+                                    region=(20,70,50,130))
+            self.assertTrue(numpy.array_equal(subset.data,
+                                              cube.data[[0,2],:2,1:3]))
+            self.assertEqual(list(subset.coord('longitude').points),
+                             [60,120])
+            subset=twcr.subset_cube(cube,member=1,region=(-90,90,-180,180))
+            self.assertTrue(numpy.array_equal(subset.data,cube.data[1]))
+            with self.assertRaises(ValueError):
+                twcr.subset_cube(cube,region=(70,80,0,360))
+        finally:
+            twcr.load.iris=iris
+
+    def test_anomalies(self):
+        def hours(*times):
+            return [StandInCoord('time',[]).date2num(datetime.datetime(*t))
+                    for t in times]
+        # Climatology dimensions in a different order from the data's
+        climatology=(StandInCube(numpy.arange(2*3*3.0).reshape(2,3,3),
+                          [(StandInCoord('latitude',[10,0]),0),
+                           (StandInCoord('longitude',[0,1,2]),1),
+                           (StandInCoord('time',hours((1981,1,1,6),
+                                                      (1981,1,1,12),
+                                                      (1981,2,28,6))),2)]),
+                     {(1,1,6):0,(1,1,12):1,(2,28,6):2})
+        self.assertEqual(list(twcr.get_climatology_for_times(climatology,
+                                 [datetime.datetime(1904,2,29,6),
+                                  datetime.datetime(1903,1,1,6)])),[2,0])
+        with self.assertRaises(StandardError):
+            twcr.get_climatology_for_times(climatology,
+                                           [datetime.datetime(1903,1,1,9)])
+        cube=StandInCube(numpy.ones((2,4,2,3)),
+                         [(StandInCoord('time',hours((1903,1,1,12),
+                                                     (1904,2,29,6))),0),
+                          (StandInCoord('latitude',[10,0]),2),
+                          (StandInCoord('longitude',[0,1,2]),3)],
+                         units='Pa')
+        aligned=twcr.align_climatology(climatology,cube)
+        self.assertEqual(aligned.shape,(2,1,2,3))
+        self.assertTrue(numpy.array_equal(aligned[:,0],
+                        numpy.transpose(climatology[0].data[:,:,[1,2]],
+                                        (2,0,1))))
+        def get_slices_for_range(*args):
+            return cube
+        def get_climatology(variable,version,type,region,month=1):
+            if type=='normal':
+                return climatology
+            return (climatology[0].copy(data=numpy.full((2,3,3),2.0)),
+                    climatology[1])
+        originals=(twcr.anomaly.get_slices_for_range,
+                   twcr.anomaly.get_climatology)
+        twcr.anomaly.get_slices_for_range=get_slices_for_range
+        twcr.anomaly.get_climatology=get_climatology
+        try:
+            anomalies=twcr.get_anomalies('prmsl',None,None,'3.5.1')
+            self.assertEqual(anomalies.units,'Pa')
+            self.assertTrue(numpy.allclose(anomalies.data,1-aligned))
+            anomalies=twcr.get_anomalies('prmsl',None,None,'3.5.1',
+                                         standardise=True)
+            self.assertEqual(anomalies.units,'1')
+            self.assertTrue(numpy.allclose(anomalies.data,(1-aligned)/2))
+            # Version 3 - a climatology file for each month
+            def get_climatology(variable,version,type,region,month=1):
+                times=hours((1981,month,1,12),(1981,month,2,12))
+                return (StandInCube(numpy.full((2,2,3),float(month)),
+                            [(StandInCoord('time',times),0),
+                             (StandInCoord('latitude',[10,0]),1),
+                             (StandInCoord('longitude',[0,1,2]),2)]),
+                        {(month,1,12):0,(month,2,12):1})
+            twcr.anomaly.get_climatology=get_climatology
+            cube=StandInCube(numpy.ones((3,4,2,3)),
+                             [(StandInCoord('time',hours((1903,1,2,12),
+                                                         (1903,2,1,12),
+                                                         (1903,1,1,12))),0),
+                              (StandInCoord('latitude',[10,0]),2),
+                              (StandInCoord('longitude',[0,1,2]),3)])
+            anomalies=twcr.get_anomalies('prmsl',None,None,'4.5.1')
+            self.assertEqual(anomalies.data.shape,(3,4,2,3))
+            self.assertTrue(numpy.allclose(anomalies.data[:,0,0,0],
+                                           [0,-1,0]))
+        finally:
+            (twcr.anomaly.get_slices_for_range,
+             twcr.anomaly.get_climatology)=originals
+
+    def test_obs_times(self):
+        times=twcr.get_obs_file_times(datetime.datetime(1987,3,31,5,30),
+                                      datetime.datetime(1987,4,1,0))
+        self.assertEqual(times,[datetime.datetime(1987,3,31,6),
+                                datetime.datetime(1987,3,31,12),
+                                datetime.datetime(1987,3,31,18)])
+        self.assertEqual(twcr.get_obs_time_key(
+                              datetime.datetime(1987,3,31,18)),1987033118)
+        self.assertEqual(twcr.get_obs_time_key(
+                              datetime.datetime(1987,3,31,23,1)),1987040100)
+        o=pandas.DataFrame({'UID':['1987033118xxxxx',numpy.nan,
+                                   '1987040100xxxxx']})
+        self.assertEqual(list(twcr.select_obs_in_range(o,
+                                  datetime.datetime(1987,3,31,18),
+                                  datetime.datetime(1987,4,1)).index),[0])
+
+    def test_read_fwf_numpy(self):
+        tmp_dir=tempfile.mkdtemp()
+        try:
+            for format in ('v2','v3'):
+                file_name=os.path.join(tmp_dir,'obs.txt')
+                twcr.benchmarks.make_synthetic_obs_file(file_name,format,500)
+                self.assertTrue(twcr.benchmarks.frames_match(
+                            twcr.read_obs_file(file_name,format,'pandas',
+                                               use_sidecar=False),
+                            twcr.read_obs_file(file_name,format,'numpy',
+                                               use_sidecar=False)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_obs_sidecar(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        try:
+            file_name=os.path.join(tmp_dir,'obs.txt')
+            twcr.benchmarks.make_synthetic_obs_file(file_name,'v3',100)
+            parsed=twcr.read_obs_file(file_name,'v3')
+            self.assertTrue(os.path.isfile(
+                                twcr.get_obs_sidecar_name(file_name)))
+            self.assertTrue(twcr.benchmarks.frames_match(parsed,
+                                twcr.read_obs_sidecar(file_name)))
+            o=twcr.read_obs_file(file_name,'v3',columns=['Latitude','Name'])
+            self.assertEqual(list(o.columns),['Latitude','Name'])
+            # Made by a different engine - not used
+            self.assertIsNone(twcr.read_obs_sidecar(file_name,
+                                                    engine='numpy'))
+            # Changed source file - sidecar is out of date
+            twcr.benchmarks.make_synthetic_obs_file(file_name,'v3',101)
+            self.assertIsNone(twcr.read_obs_sidecar(file_name))
+            # Not on $SCRATCH - no sidecar
+            set_scratch(os.path.join(tmp_dir,'elsewhere'))
+            os.remove(twcr.get_obs_sidecar_name(file_name))
+            twcr.read_obs_file(file_name,'v3')
+            self.assertFalse(os.path.isfile(
+                                twcr.get_obs_sidecar_name(file_name)))
+        finally:
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_obs_index(self):
+        obs=pandas.DataFrame({'Latitude':[50,51,52,60,-10],
+                              'Longitude':[355,1,-2,10,355]})
+        index=twcr.ObsIndex(obs,resolution=2.0)
+        # Box crossing the 0/360 line
+        self.assertEqual(list(index.in_box(45,55,350,5).index),[0,1,2])
+        # Whole globe, in either longitude convention
+        self.assertEqual(len(index.in_box(-90,90,0,360)),5)
+        self.assertEqual(len(index.in_box(-90,90,-180,180)),5)
+        self.assertEqual(list(index.within(51,0,200).index),[1,2])
+        nearest=index.nearest(59,10,k=2)
+        self.assertEqual(list(nearest.index),[3,1])
+        self.assertAlmostEqual(nearest['Distance'].values[0],111.2,
+                               places=0)
+
+    def test_get_obs_index(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        def write_obs(hour,n_obs):
+            file_name=twcr.get_data_file_name('observations',1903,1,1,
+                                              hour,'4.5.1')
+            if not os.path.isdir(os.path.dirname(file_name)):
+                os.makedirs(os.path.dirname(file_name))
+            with open(file_name,'w') as f:
+                for i in range(n_obs):
+                    f.write("%-19s %3d %1s %7.2f %6.2f\n" %
+                            ("19030101%02dX" % hour,180,'P',355.0,51.0))
+        start=datetime.datetime(1903,1,1,0)
+        end=datetime.datetime(1903,1,1,12)
+        try:
+            write_obs(0,3)
+            write_obs(6,2)
+            self.assertEqual(len(twcr.get_obs_index(start,end,
+                                                    '4.5.1').obs),5)
+            index_file=twcr.get_obs_index_file_name(start,end,'4.5.1')
+            self.assertTrue(index_file.startswith(tmp_dir))
+            self.assertTrue(os.path.isfile(index_file))
+            # Obs file changed - index made again
+            write_obs(6,4)
+            self.assertEqual(len(twcr.get_obs_index(start,end,
+                                                    '4.5.1').obs),7)
+            with self.assertRaises(StandardError):
+                twcr.get_obs_index(start,start,'4.5.1')
+            # Only kept on $SCRATCH
+            set_scratch(None)
+            self.assertIsNone(twcr.get_obs_index_file_name(start,end,
+                                                           '4.5.1'))
+        finally:
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_store(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_3.5.1'))
+        start=datetime.datetime(1903,1,1)
+        hours=StandInCoord('time',[]).date2num(start)+numpy.arange(10)*6
+        data=numpy.random.RandomState(0).rand(10,3,4,5).astype('float32')
+        span=StandInCube(data,[(StandInCoord('time',hours),0),
+                               (StandInCoord('latitude',[60,30,0,-30]),2),
+                               (StandInCoord('longitude',
+                                             numpy.arange(0,360,72)),3)],
+                         units='Pa')
+        def get_slices_for_range(*args):
+            return span
+        get_span=twcr.store.get_slices_for_range
+        make_store_cube=twcr.store.make_store_cube
+        twcr.store.get_slices_for_range=get_slices_for_range
+        try:
+            self.assertIsNone(twcr.get_store_index('prmsl','3.5.1'))
+            # Not remembered - the store is made later
+            self.assertEqual(twcr.store._store_indices,{})
+            twcr.convert_to_store('prmsl',1903,'3.5.1',layout='time')
+            # Small bands - several for the 4 latitudes
+            twcr.convert_to_store('prmsl',1903,'3.5.1',layout='point',
+                                  block_size=3,band_bytes=500)
+            for layout in ('time','point'):
+                chunk=twcr.open_store_chunk('prmsl','3.5.1','ensemble',
+                                            layout,1903)
+                if layout=='point':
+                    chunk=numpy.transpose(chunk,(3,2,0,1))
+                self.assertTrue(numpy.array_equal(chunk,data))
+            times,series=twcr.get_point_series_from_store('prmsl',30,72,
+                                 start,start+datetime.timedelta(days=1),
+                                 '3.5.1')
+            self.assertEqual(len(times),4)
+            self.assertTrue(numpy.array_equal(series,data[:4,:,1,1]))
+            with self.assertRaises(StandardError):
+                twcr.get_point_series_from_store('prmsl',30,72,
+                                 datetime.datetime(1903,6,1),
+                                 datetime.datetime(1903,6,2),'3.5.1')
+            # Up to 1st January - 1904 not needed
+            times,series=twcr.get_point_series_from_store('prmsl',30,72,
+                                 start,datetime.datetime(1904,1,1),'3.5.1')
+            self.assertEqual(len(times),10)
+            # Fields from the store can be changed, like loaded ones
+            twcr.store.make_store_cube=lambda index,data,dt: data
+            field=twcr.get_slice_from_store('prmsl',1903,1,1,6,'3.5.1')
+            field+=1
+            self.assertTrue(numpy.allclose(field,data[1]+1))
+            # Source file (re-)fetched - the store is out of date
+            source=twcr.get_data_file_name('prmsl',1903,1,1,6,'3.5.1')
+            os.makedirs(os.path.dirname(source))
+            open(source,'w').close()
+            self.assertIsNone(twcr.get_slice_from_store('prmsl',1903,1,1,
+                                                        6,'3.5.1'))
+            with self.assertRaises(StandardError):
+                twcr.get_point_series_from_store('prmsl',30,72,
+                                 start,start+datetime.timedelta(days=1),
+                                 '3.5.1')
+        finally:
+            twcr.store.make_store_cube=make_store_cube
+            twcr.store.get_slices_for_range=get_span
+            twcr.store._store_indices.clear()
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_derived(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        ensemble_file=twcr.get_data_file_name('prmsl',1903,1,1,0,'4.5.1')
+        os.makedirs(os.path.dirname(ensemble_file))
+        open(ensemble_file,'w').close()
+        data=numpy.random.RandomState(0).rand(4,3,2,5)
+        cube=StandInCube(data,[(StandInCoord('time',numpy.arange(4)*3),0),
+                               (StandInCoord('member',numpy.arange(3)),1),
+                               (StandInCoord('latitude',[10,0]),2),
+                               (StandInCoord('longitude',
+                                             numpy.arange(5)),3)])
+        saved={}
+        def save_derived(cube,file_name):
+            # Stand-in for iris.save
+            saved[os.path.basename(os.path.dirname(
+                      os.path.dirname(os.path.dirname(file_name))))]=cube
+            os.makedirs(os.path.dirname(file_name))
+            open(file_name,'w').close()
+        originals=(twcr.derived.iris,twcr.derived.save_derived)
+        twcr.derived.iris=StandInIris(cube)
+        twcr.derived.save_derived=save_derived
+        try:
+            self.assertFalse(twcr.is_derived('3.5.1','mean'))
+            self.assertFalse(twcr.is_derived_current('prmsl',1903,1,
+                                                     '4.5.1','mean'))
+            twcr.make_derived_if_needed('prmsl',1903,1,'4.5.1','mean')
+            self.assertTrue(numpy.allclose(saved['mean'].data,
+                                           data.mean(axis=1)))
+            self.assertTrue(numpy.allclose(saved['spread'].data,
+                                           data.std(axis=1,ddof=1)))
+            self.assertEqual(saved['spread'].cell_methods,
+                             [('standard_deviation','member')])
+            self.assertEqual([c.name() for c in saved['mean'].coords()],
+                             ['time','latitude','longitude'])
+            self.assertTrue(twcr.is_derived_current('prmsl',1903,1,
+                                                    '4.5.1','spread'))
+            # Newer ensemble - made again
+            mtime=os.path.getmtime(ensemble_file)+10
+            os.utime(ensemble_file,(mtime,mtime))
+            self.assertFalse(twcr.is_derived_current('prmsl',1903,1,
+                                                     '4.5.1','mean'))
+        finally:
+            twcr.derived.iris,twcr.derived.save_derived=originals
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_bilinear_weights(self):
+        grid_lats=numpy.arange(90,-91,-2.0)
+        grid_lons=numpy.arange(0,360,2.0)
+        field=numpy.add.outer(3*grid_lats,0.5*grid_lons)
+        indices,weights=twcr.get_bilinear_weights(grid_lats,grid_lons,
+                                                  [51.3,0],[3,181.1])
+        values=(field.ravel()[indices]*weights).sum(axis=0)
+        self.assertAlmostEqual(values[0],3*51.3+0.5*3)
+        self.assertAlmostEqual(values[1],0.5*181.1)
+        # Across the 0/360 line
+        indices,weights=twcr.get_bilinear_weights(grid_lats,grid_lons,
+                                                  [0],[-1])
+        self.assertAlmostEqual((field.ravel()[indices]*weights).sum(),
+                               0.5*0.5*358)
+
+    def test_ensemble_stats(self):
+        values=numpy.random.RandomState(0).normal(size=(40,3,4))
+        bins=numpy.linspace(-4,4,161)
+        stats=twcr.EnsembleStats(thresholds=(1.0,),bins=bins)
+        for block in range(0,40,8):
+            stats.update(values[block:block+8])
+        self.assertTrue(numpy.allclose(stats.mean,values.mean(axis=0)))
+        self.assertTrue(numpy.allclose(stats.variance(),
+                                       values.var(axis=0,ddof=1)))
+        self.assertTrue(numpy.array_equal(
+                            stats.exceedance_probability(1.0),
+                            (values>1.0).mean(axis=0)))
+        self.assertTrue(numpy.all(numpy.abs(stats.quantile(0.5)-
+                            numpy.median(values,axis=0))<0.1))
+        # Partial statistics merge to the same result
+        first=twcr.EnsembleStats(thresholds=(1.0,),bins=bins)
+        first.update(values[:15])
+        second=twcr.EnsembleStats(thresholds=(1.0,),bins=bins)
+        second.update(values[15:])
+        first.merge(second)
+        self.assertTrue(numpy.allclose(first.mean,stats.mean))
+        self.assertTrue(numpy.allclose(first.variance(),stats.variance()))
+        self.assertTrue(numpy.array_equal(first.histogram,stats.histogram))
+        # Rank histogram, sized from the members
+        ranks=twcr.EnsembleStats()
+        ranks.update(values[:4],reference=values[4])
+        self.assertEqual(ranks.n_members,4)
+        self.assertEqual(ranks.ranks.sum(),12)
+
+    def test_accumulate_stats(self):
+        data=numpy.random.RandomState(0).rand(5,3,2,2)
+        cube=StandInCube(data,[(StandInCoord('time',numpy.arange(5)*6.0),0),
+                               (StandInCoord('member',numpy.arange(3)),1),
+                               (StandInCoord('latitude',[10,0]),2),
+                               (StandInCoord('longitude',[0,1]),3)])
+        # Reference above all the members at the first point
+        reference_data=numpy.full((5,2,2),0.5)
+        reference_data[:,0,0]=2.0
+        reference=StandInCube(reference_data,
+                              [(StandInCoord('time',numpy.arange(5)*6.0),0),
+                               (StandInCoord('latitude',[10,0]),1),
+                               (StandInCoord('longitude',[0,1]),2)])
+        def get_slices_for_range(*args):
+            return cube
+        get_span=twcr.stats.get_slices_for_range
+        twcr.stats.get_slices_for_range=get_slices_for_range
+        try:
+            stats=twcr.accumulate_stats('prmsl',None,None,'3.5.1',
+                                        block_size=2,reference=reference)
+            self.assertTrue(numpy.allclose(stats.mean,
+                                           data.mean(axis=(0,1))))
+            below=(data<reference_data[:,numpy.newaxis]).sum(axis=1)
+            self.assertTrue(numpy.array_equal(stats.ranks,
+                                   numpy.bincount(below.ravel(),minlength=4)))
+            self.assertGreaterEqual(stats.ranks[3],5)
+            self.assertIsNone(twcr.accumulate_stats('prmsl',None,None,
+                                                    '3.5.1').ranks)
+        finally:
+            twcr.stats.get_slices_for_range=get_span
+
+    def test_fetch_many(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        calls=[]
+        def transfer(remote_file,local_file,recursive):
+            # Stand-in for rsync: February missing, March fails once
+            calls.append(remote_file)
+            if '/1903/02/' in remote_file:
+                return 23
+            if '/1903/03/' in remote_file and len(calls)<5:
+                return 1
+            with open(local_file,'wb') as f:
+                f.write(b'CDF\x01'+b'\x00'*96)
+            return 0
+        try:
+            results=twcr.fetch_many([('prmsl',1903,1,'4.5.1'),
+                                     ('prmsl',1903,1,'4.5.1','ensemble'),
+                                     ('prmsl',1903,2,'4.5.1'),
+                                     ('prmsl',1903,3,'4.5.1')],
+                                    backoff=0,transfer=transfer,
+                                    progress=False)
+            status=dict((r['job']['remote'].split('/')[-2],r['status'])
+                        for r in results)
+            self.assertEqual(status,{'01':'done','02':'unavailable',
+                                     '03':'done'})
+            self.assertEqual(sum(r['bytes'] for r in results),200)
+            # Already on disc - nothing to do
+            self.assertEqual(twcr.fetch_many([('prmsl',1903,1,'4.5.1')],
+                                             transfer=transfer,
+                                             progress=False),[])
+        finally:
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_fetch_batched(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        batches=[]
+        def transfer(source,paths,staging_dir):
+            # Stand-in for rsync: February missing
+            batches.append(paths)
+            for path in paths:
+                if '/1903/02/' in path:
+                    continue
+                staged=os.path.join(staging_dir,path.strip('/'))
+                os.makedirs(os.path.dirname(staged))
+                with open(staged,'wb') as f:
+                    f.write(b'CDF\x01'+b'\x00'*96)
+            return 23
+        try:
+            results=twcr.fetch_batched([('prmsl',1903,month,'4.5.1')
+                                        for month in (1,2,3)],
+                                       transfer=transfer,progress=False)
+            self.assertEqual(len(batches),1)
+            self.assertEqual([r['status'] for r in results],
+                             ['done','unavailable','done'])
+            self.assertTrue(os.path.isfile(twcr.get_data_file_name(
+                                'prmsl',1903,3,1,6,'4.5.1','ensemble')))
+        finally:
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_sync_obs(self):
+        tmp_dir=tempfile.mkdtemp()
+        scratch=set_scratch(tmp_dir)
+        os.makedirs(os.path.join(tmp_dir,'20CR','version_4.5.1'))
+        # A file for each run in the month (size, modification time)
+        mtime=1.0e9
+        remote=dict(("psobfile_190302%02d%02d" % (day,hour),(10,mtime))
+                    for day in range(1,29) for hour in (0,6,12,18))
+        copied=[]
+        def list_remote(remote_dir):
+            return (0,dict(remote))
+        def batch_transfer(source,paths,local_dir,append=True):
+            # Stand-in for rsync -t
+            self.assertFalse(append)
+            for path in paths:
+                copied.append(path)
+                file_name=os.path.join(local_dir,path)
+                with open(file_name,'wb') as f:
+                    f.write(b'x'*remote[path][0])
+                os.utime(file_name,(remote[path][1],remote[path][1]))
+            return 0
+        try:
+            listed=time.mktime((2017,1,1,12,0,0,0,0,-1))
+            self.assertEqual(twcr.parse_rsync_listing(
+                 "drwxr-xr-x          4,096 2017/01/01 12:00:00 .\n"+
+                 "-rw-r--r--      1,234,567 2017/01/01 12:00:00 psobfile_x"),
+                 {'psobfile_x':(1234567,listed)})
+            job=twcr.get_fetch_job('observations',1903,2,'4.5.1')
+            # A run missing from the archive doesn't stop the month
+            #  being complete
+            del remote['psobfile_1903022818']
+            self.assertEqual(twcr.sync_obs(job,list_remote,batch_transfer),0)
+            self.assertEqual(len(copied),28*4-1)
+            self.assertIsNone(twcr.get_fetch_job('observations',
+                                                 1903,2,'4.5.1'))
+            twcr.fetch_obs_for_cycle(1903,2,1,6,'4.5.1')
+            # A file changed here - the month is synchronised again
+            with open(twcr.get_data_file_name('observations',1903,2,1,6,
+                                              '4.5.1'),'ab') as f:
+                f.write(b'x')
+            self.assertIsNotNone(twcr.get_fetch_job('observations',
+                                                    1903,2,'4.5.1'))
+            # Only new and changed files are copied - including ones
+            #  that shrank, or changed without changing size
+            del copied[:]
+            remote['psobfile_1903020112']=(5,mtime)
+            remote['psobfile_1903020118']=(10,mtime+60)
+            remote['psobfile_1903022818']=(10,mtime)
+            self.assertEqual(twcr.sync_obs(job,list_remote,batch_transfer),0)
+            self.assertEqual(copied,['psobfile_1903020106',
+                                     'psobfile_1903020112',
+                                     'psobfile_1903020118',
+                                     'psobfile_1903022818'])
+            self.assertEqual(os.path.getsize(twcr.get_data_file_name(
+                        'observations',1903,2,1,12,'4.5.1')),5)
+            self.assertIsNone(twcr.get_fetch_job('observations',
+                                                 1903,2,'4.5.1'))
+            # Up to date - nothing copied
+            self.assertEqual(twcr.sync_obs(job,list_remote,batch_transfer),0)
+            self.assertEqual(len(copied),4)
+        finally:
+            shutil.rmtree(tmp_dir)
+            set_scratch(scratch)
+
+    def test_drop_page_cache(self):
+        tmp_dir=tempfile.mkdtemp()
+        file_name=os.path.join(tmp_dir,'x.nc')
+        with open(file_name,'wb') as f:
+            f.write(b'x'*10000)
+        try:
+            self.assertEqual(twcr.drop_page_cache(file_name),
+                             twcr.get_posix_fadvise() is not None)
+            if sys.platform.startswith('linux'):
+                self.assertTrue(twcr.drop_page_cache(file_name))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipUnless(netCDF4 is not None,"needs netCDF4")
+    def test_rechunk(self):
+        tmp_dir=tempfile.mkdtemp()
+        file_name=os.path.join(tmp_dir,'prmsl.nc')
+        data=numpy.random.RandomState(0).rand(6,3,4,5).astype('float32')
+        with netCDF4.Dataset(file_name,'w',format='NETCDF3_CLASSIC') as f:
+            f.title='test'
+            for name,size in (('time',None),('ensemble',3),
+                              ('lat',4),('lon',5)):
+                f.createDimension(name,size)
+            times=f.createVariable('time','f8',('time',))
+            times.units='hours since 1800-01-01 00:00:0.0'
+            times[:]=numpy.arange(6)*6.0
+            prmsl=f.createVariable('prmsl','f4',
+                                   ('time','ensemble','lat','lon'))
+            prmsl.units='Pa'
+            prmsl[:]=data
+        try:
+            self.assertFalse(twcr.is_rechunked(file_name))
+            result=twcr.rechunk_if_needed(file_name,measure=True)
+            self.assertEqual(result['status'],'rechunked')
+            self.assertIsNotNone(result['read_before'])
+            self.assertIsNotNone(result['read_after'])
+            # Reads from disc, where the page cache can be dropped
+            self.assertEqual(result['read_warm'],
+                             twcr.get_posix_fadvise() is None)
+            with netCDF4.Dataset(file_name) as f:
+                self.assertEqual(f.title,'test')
+                self.assertEqual(f.variables['prmsl'].units,'Pa')
+                self.assertEqual(f.variables['prmsl'].chunking(),[1,3,4,5])
+                self.assertTrue(numpy.array_equal(
+                                      f.variables['prmsl'][:],data))
+            self.assertEqual(twcr.rechunk_if_needed(file_name)['status'],
+                             'unchanged')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_import_is_lazy(self):
+        # Importing the package must not import iris, numpy or pandas
+        for package in ('twcr','mopd'):
+            seconds,heavy=twcr.benchmarks.time_import(package)
+            self.assertEqual(heavy,[])
+
+if __name__ == '__main__':
+    unittest.main()